@@ -0,0 +1,473 @@
+import argparse
+import contextlib
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import metrics
+import transfer
+from device import Device
+from proxy import ImpairmentProxy
+
+HOST = "127.0.0.1"
+BASE_PORT = 7000
+# as fachadas do proxy ficam em BASE_PORT + FRONT_OFFSET + i
+FRONT_OFFSET = 1000
+DEFAULT_SIZES = "1K,64K,1M,16M,128M"
+QUICK_SIZES = "1K,64K,1M"
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+WRITE_BLOCK = 1024 * 1024
+POLL_INTERVAL = 0.005
+# TALK: sem chegadas novas por esse tempo, o que faltou conta como perdido
+TALK_IDLE = 3.0
+# prazo para o proxy ler os datagramas que ainda estão no buffer do socket dele
+PROXY_SETTLE = 1.0
+
+
+class BenchDevice(Device):
+    """Device que anota a chegada de cada TALK e o fim de cada envio, em vez de imprimir"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (mensagem, instante)
+        self.arrivals: List[tuple] = []
+        # arquivo -> (status, instante, id da transferência)
+        self.finished: Dict[str, tuple] = {}
+
+    def _show_talk(self, message: str, addr: tuple):
+        self.arrivals.append((message, time.monotonic()))
+
+    def _close_outgoing(self, t: transfer.OutgoingTransfer, status: str):
+        self.finished[t.filename] = (status, time.monotonic(), t.msg_id)
+        super()._close_outgoing(t, status)
+
+    def take_arrivals(self) -> List[tuple]:
+        return self._call_in_loop(self._take_arrivals)
+
+    def _take_arrivals(self) -> List[tuple]:
+        arrivals, self.arrivals = self.arrivals, []
+        return arrivals
+
+    def finished_at(self, filename: str) -> Optional[tuple]:
+        return self._call_in_loop(self.finished.get, filename)
+
+    def known(self) -> List[str]:
+        return self._call_in_loop(lambda: [d.name for d in self.known_devices.values()])
+
+    def usage(self) -> dict:
+        """CPU da thread do event loop; a memória só é separável no modo --subprocess"""
+        return {"cpu": self._call_in_loop(time.thread_time), "memoria_max": None}
+
+
+def process_usage() -> dict:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss vem em KB no Linux
+    return {"cpu": usage.ru_utime + usage.ru_stime, "memoria_max": usage.ru_maxrss * 1024}
+
+
+def _child_main(name: str, port: int, options: dict, workdir: str, conn):
+    """Processo de um dispositivo no modo --subprocess: executa os comandos que chegam pelo pipe"""
+    os.chdir(workdir)
+    sys.stdout = open(os.devnull, "w")
+    device = BenchDevice(name, port, **options)
+    device.start()
+    conn.send(True)
+    while True:
+        command, args = conn.recv()
+        if command == "stop":
+            break
+        try:
+            result = process_usage() if command == "usage" else getattr(device, command)(*args)
+            conn.send((True, result))
+        except Exception as e:
+            conn.send((False, repr(e)))
+    device.stop()
+    conn.send((True, None))
+
+
+class LocalNode:
+    """Dispositivo no mesmo processo do benchmark"""
+
+    def __init__(self, name: str, port: int, options: dict):
+        self.name = name
+        self.device = BenchDevice(name, port, **options)
+
+    def start(self):
+        self.device.start()
+
+    def call(self, command: str, *args):
+        return getattr(self.device, command)(*args)
+
+    def stop(self):
+        self.device.stop()
+
+
+class ChildNode:
+    """Dispositivo em um processo próprio, com CPU e memória medidas separadamente"""
+
+    def __init__(self, name: str, port: int, options: dict, workdir: str):
+        self.name = name
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_child_main, args=(name, port, options, workdir, child_conn),
+                                       daemon=True)
+
+    def start(self):
+        self.process.start()
+        self.conn.recv()
+
+    def call(self, command: str, *args):
+        self.conn.send((command, args))
+        ok, result = self.conn.recv()
+        if not ok:
+            raise RuntimeError(f"{self.name}: {result}")
+        return result
+
+    def stop(self):
+        if self.process.is_alive():
+            self.conn.send(("stop", ()))
+            self.conn.recv()
+        self.process.join(5)
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def percentile(samples: List[float], fraction: float) -> Optional[float]:
+    """Percentil exato (nearest-rank) de uma lista já ordenada"""
+    if not samples:
+        return None
+    rank = max(1, int(fraction * len(samples) + 0.999999))
+    return samples[min(rank, len(samples)) - 1]
+
+
+def summarize(samples: List[float]) -> dict:
+    samples = sorted(samples)
+    return {
+        "amostras": len(samples),
+        "media": sum(samples) / len(samples) if samples else None,
+        "min": samples[0] if samples else None,
+        "p50": percentile(samples, 0.5),
+        "p90": percentile(samples, 0.9),
+        "p99": percentile(samples, 0.99),
+        "max": samples[-1] if samples else None,
+    }
+
+
+def report(text: str):
+    # o stdout dos dispositivos locais vai para /dev/null; o progresso sai pelo original
+    print(text, file=sys.__stdout__, flush=True)
+
+
+class Benchmark:
+    """Sobe N dispositivos em localhost, opcionalmente atrás do ImpairmentProxy, e mede
+    descoberta, transferências de arquivo e latência de TALK entre d0 e d1."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="bench_")
+        self.source_dir = os.path.join(self.workdir, "origem")
+        os.makedirs(self.source_dir)
+        self.nodes: List = []
+        self.proxy: Optional[ImpairmentProxy] = None
+        # cenários em que algum datagrama não passou pelo proxy
+        self.bypassed: List[str] = []
+
+    @property
+    def impaired(self) -> bool:
+        a = self.args
+        return any((a.loss, a.duplicate, a.reorder, a.delay, a.jitter)) or a.proxy
+
+    def recv_dir(self, node) -> str:
+        return os.path.join(self.workdir, node.name if self.args.subprocess else "recebidos")
+
+    def start(self) -> float:
+        """Sobe os dispositivos e devolve o instante de início (referência da descoberta)"""
+        a = self.args
+        ports = [a.port + i for i in range(a.devices)]
+        addrs = [(HOST, port) for port in ports]
+        if self.impaired:
+            routes = {port + FRONT_OFFSET: port for port in ports}
+            self.proxy = ImpairmentProxy(routes, HOST, a.loss, a.duplicate, a.reorder, a.delay, a.jitter,
+                                         seed=a.seed)
+            self.proxy.start()
+            addrs = [self.proxy.front(port) for port in ports]
+        started = time.monotonic()
+        for i, port in enumerate(ports):
+            options = {
+                "multicast_group": None,
+                # todos conhecem d0; d0 aprende os outros pelos heartbeats e o gossip espalha o resto
+                "seeds": [addrs[0]] if i else [],
+                # sem store: o receptor não aproveita blocos de arquivos anteriores, cada envio é medido inteiro
+                "store_dir": None,
+                "fanout_port": None,
+                "compression": a.compression,
+            }
+            name = f"d{i}"
+            if a.subprocess:
+                workdir = os.path.join(self.workdir, name)
+                os.makedirs(workdir)
+                node = ChildNode(name, port, options, workdir)
+            else:
+                node = LocalNode(name, port, options)
+            node.start()
+            self.nodes.append(node)
+        return started
+
+    def stop(self):
+        for node in self.nodes:
+            node.stop()
+        if self.proxy is not None:
+            self.proxy.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def usage(self) -> Dict[str, dict]:
+        return {node.name: node.call("usage") for node in self.nodes}
+
+    def resources(self, before: Dict[str, dict], cpu_before: float) -> dict:
+        after = self.usage()
+        devices = {name: {"cpu": after[name]["cpu"] - before[name]["cpu"],
+                          "memoria_max": after[name]["memoria_max"]} for name in after}
+        result = {"dispositivos": devices}
+        if not self.args.subprocess:
+            result["processo"] = {"cpu": time.process_time() - cpu_before,
+                                  "memoria_max": process_usage()["memoria_max"]}
+        return result
+
+    def traffic(self) -> tuple:
+        """Datagramas enviados pelos dispositivos e recebidos pelo proxy até agora"""
+        sent = 0
+        for node in self.nodes:
+            total = node.call("stats")["total"]
+            sent += total["pacotes_enviados"] - total.get("descartados_no_envio", 0)
+        return sent, self.proxy.counters["recebidos"] if self.proxy else 0
+
+    def check_proxy(self, scenario: str, before: tuple, result: dict):
+        """Confere que tudo o que os dispositivos enviaram no cenário passou pelo proxy"""
+        if self.proxy is None:
+            return
+        sent = self.traffic()[0] - before[0]
+        deadline = time.monotonic() + PROXY_SETTLE
+        while True:
+            received = self.proxy.counters["recebidos"] - before[1]
+            if received >= sent or time.monotonic() >= deadline:
+                break
+            time.sleep(POLL_INTERVAL)
+        result["proxy"] = {"enviados": sent, "recebidos": received}
+        if received < sent:
+            self.bypassed.append(scenario)
+            report(f"{scenario}: {sent - received} de {sent} datagramas não passaram pelo proxy")
+
+    def discovery(self, started: float) -> dict:
+        expected = len(self.nodes) - 1
+        deadline = started + self.args.timeout
+        converged = False
+        while time.monotonic() < deadline:
+            if all(len(node.call("known")) >= expected for node in self.nodes):
+                converged = True
+                break
+            time.sleep(POLL_INTERVAL)
+        elapsed = time.monotonic() - started
+        report(f"Descoberta de {len(self.nodes)} dispositivos: "
+               + (f"{elapsed:.2f}s" if converged else f"não convergiu em {self.args.timeout:.0f}s"))
+        result = {"dispositivos": len(self.nodes), "segundos": elapsed, "convergiu": converged}
+        # o proxy sobe antes dos dispositivos: a contagem dos dois começa do zero
+        self.check_proxy("Descoberta", (0, 0), result)
+        return result
+
+    def _write_file(self, path: str, size: int):
+        with open(path, "wb") as f:
+            remaining = size
+            while remaining:
+                block = os.urandom(min(WRITE_BLOCK, remaining))
+                f.write(block)
+                remaining -= len(block)
+
+    def send_file(self, label: str, size: int, index: int) -> dict:
+        sender, receiver = self.nodes[0], self.nodes[1]
+        basename = f"bench_{index}_{label}.bin"
+        path = os.path.join(self.source_dir, basename)
+        self._write_file(path, size)
+        traffic_before = self.traffic()
+        before, cpu_before = self.usage(), time.process_time()
+        started = time.monotonic()
+        ok = sender.call("send_file", receiver.name, path)
+        finished = None
+        deadline = started + self.args.timeout
+        while ok and time.monotonic() < deadline:
+            finished = sender.call("finished_at", path)
+            if finished is not None:
+                break
+            time.sleep(POLL_INTERVAL)
+        status, elapsed = (finished[0], finished[1] - started) if finished else ("tempo_esgotado", None)
+        result = {"rotulo": label, "tamanho": size, "status": status, "segundos": elapsed,
+                  "mb_por_segundo": size / elapsed / 1024 ** 2 if elapsed and status == transfer.CONCLUIDA else None}
+        t = sender.call("stats")["transferencias"].get(finished[2]) if finished else None
+        if t is not None:
+            result.update(pacotes=t["pacotes_enviados"], retransmissoes=t["retransmissoes"],
+                          nacks=t["nacks_recebidos"], latencia_blocos=t["latencia_blocos"])
+        result["recursos"] = self.resources(before, cpu_before)
+        self.check_proxy(f"Arquivo {label}", traffic_before, result)
+        os.remove(path)
+        with contextlib.suppress(OSError):
+            os.remove(os.path.join(self.recv_dir(receiver), basename))
+        speed = f"{result['mb_por_segundo']:.1f} MB/s" if result["mb_por_segundo"] else "-"
+        report(f"Arquivo {label}: {status} em {elapsed or 0:.3f}s ({speed})")
+        return result
+
+    def talk(self, paced: bool) -> dict:
+        """TALK de d0 para d1: com ritmo fixo mede a latência, em rajada mede a vazão"""
+        a = self.args
+        sender, receiver = self.nodes[0], self.nodes[1]
+        receiver.call("take_arrivals")
+        packets_before = {node.name: node.call("stats")["total"]["pacotes_enviados"] for node in (sender, receiver)}
+        traffic_before = self.traffic()
+        before, cpu_before = self.usage(), time.process_time()
+        sent: Dict[str, float] = {}
+        started = time.monotonic()
+        for i in range(a.messages):
+            if paced:
+                wait = started + i / a.rate - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            text = f"bench-{i}"
+            sent[text] = time.monotonic()
+            sender.call("send_message", receiver.name, text)
+        arrivals: Dict[str, float] = {}
+        duplicates = 0
+        last_arrival = time.monotonic()
+        while len(arrivals) < len(sent) and time.monotonic() - last_arrival < TALK_IDLE:
+            batch = receiver.call("take_arrivals")
+            for text, when in batch:
+                if text in arrivals:
+                    duplicates += 1
+                else:
+                    arrivals[text] = when
+            if batch:
+                last_arrival = time.monotonic()
+            else:
+                time.sleep(POLL_INTERVAL)
+        latencies = [arrivals[text] - sent[text] for text in arrivals if text in sent]
+        elapsed = max(arrivals.values()) - started if arrivals else None
+        packets = sum(node.call("stats")["total"]["pacotes_enviados"] - packets_before[node.name]
+                      for node in (sender, receiver))
+        result = {
+            "mensagens": len(sent),
+            "entregues": len(arrivals),
+            "duplicadas": duplicates,
+            "segundos": elapsed,
+            "mensagens_por_segundo": len(arrivals) / elapsed if elapsed else None,
+            # nos dois sentidos: lotes de TALK e ACKs
+            "datagramas": packets,
+            "latencia": summarize(latencies),
+            "recursos": self.resources(before, cpu_before),
+        }
+        if paced:
+            result["ritmo"] = a.rate
+        self.check_proxy(f"TALK {'com ritmo' if paced else 'em rajada'}", traffic_before, result)
+        h = result["latencia"]
+        p50 = f"{h['p50'] * 1000:.2f}" if h["p50"] is not None else "-"
+        p99 = f"{h['p99'] * 1000:.2f}" if h["p99"] is not None else "-"
+        report(f"TALK {'com ritmo' if paced else 'em rajada'}: {len(arrivals)}/{len(sent)} entregues, "
+               f"p50 {p50} ms, p99 {p99} ms, {packets} datagramas")
+        return result
+
+    def run(self) -> dict:
+        a = self.args
+        result = {
+            "instante": time.time(),
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "configuracao": {
+                "modo": "subprocess" if a.subprocess else "processo_unico",
+                "dispositivos": a.devices,
+                "proxy": self.impaired,
+                "perda": a.loss,
+                "duplicacao": a.duplicate,
+                "reordenacao": a.reorder,
+                "atraso": a.delay,
+                "variacao": a.jitter,
+                "semente": a.seed,
+                "compressao": a.compression,
+            },
+        }
+        cpu_before = time.process_time()
+        started = self.start()
+        result["descoberta"] = self.discovery(started)
+        result["descoberta"]["recursos"] = self.resources({name: {"cpu": 0.0} for name in self.usage()}, cpu_before)
+        if not result["descoberta"]["convergiu"]:
+            return result
+        result["transferencias"] = [self.send_file(label, parse_size(label), i)
+                                    for i, label in enumerate(a.sizes.split(","))]
+        if a.messages:
+            result["talk"] = {"com_ritmo": self.talk(paced=True), "rajada": self.talk(paced=False)}
+        if self.proxy is not None:
+            result["proxy"] = dict(self.proxy.counters)
+        return result
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark do protocolo em localhost, com perdas simuladas")
+    parser.add_argument("--devices", type=int, default=4, help="dispositivos iniciados (mínimo 2)")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="tamanhos dos arquivos, ex.: 1K,1M,1G")
+    parser.add_argument("--messages", type=int, default=1000, help="mensagens TALK por cenário (0 desliga)")
+    parser.add_argument("--rate", type=float, default=500.0, help="mensagens por segundo no cenário com ritmo")
+    parser.add_argument("--loss", type=float, default=0.0, help="probabilidade de descarte de cada datagrama")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="probabilidade de duplicação")
+    parser.add_argument("--reorder", type=float, default=0.0, help="probabilidade de chegar fora de ordem")
+    parser.add_argument("--delay", type=float, default=0.0, help="atraso fixo em segundos")
+    parser.add_argument("--jitter", type=float, default=0.0, help="atraso extra aleatório máximo em segundos")
+    parser.add_argument("--seed", type=int, default=None, help="semente do gerador de perdas")
+    parser.add_argument("--proxy", action="store_true", help="passa pelo proxy mesmo sem perdas configuradas")
+    parser.add_argument("--subprocess", action="store_true", help="um processo por dispositivo")
+    parser.add_argument("--compression", default="auto", help="codec oferecido nos envios")
+    parser.add_argument("--port", type=int, default=BASE_PORT, help="porta do primeiro dispositivo")
+    parser.add_argument("--timeout", type=float, default=600.0, help="limite de cada cenário em segundos")
+    parser.add_argument("--quick", action="store_true", help="poucos tamanhos e mensagens, para um teste rápido")
+    parser.add_argument("--output", default="benchmark.json", help="arquivo JSON com os resultados")
+    args = parser.parse_args(argv)
+    if args.devices < 2:
+        parser.error("são necessários pelo menos 2 dispositivos")
+    if args.quick:
+        args.sizes = QUICK_SIZES
+        args.messages = min(args.messages, 200)
+    return args
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    bench = Benchmark(args)
+    cwd = os.getcwd()
+    output = os.path.abspath(args.output)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            if not args.subprocess:
+                # os dispositivos locais salvam o que recebem no diretório atual
+                os.makedirs(os.path.join(bench.workdir, "recebidos"))
+                os.chdir(os.path.join(bench.workdir, "recebidos"))
+            result = bench.run()
+    finally:
+        os.chdir(cwd)
+        bench.stop()
+    metrics.export(result, output)
+    report(f"Resultados gravados em {output}")
+    if bench.bypassed:
+        # com datagramas por fora do proxy, as perdas configuradas não valem para tudo
+        report("Falha: tráfego por fora do proxy em " + ", ".join(bench.bypassed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import asyncio
+import random
+import socket
+import threading
+from typing import Dict, Optional
+
+RECV_BUFFER_SIZE = 65535
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+# atraso extra dos datagramas escolhidos para chegar fora de ordem
+REORDER_DELAY = 0.005
+
+
+class ImpairmentProxy:
+    """Relay UDP local que imita uma rede ruim entre dispositivos da mesma máquina.
+
+    Cada dispositivo (porta real R) ganha uma porta de fachada F no proxy,
+    e os outros falam com ele só pela fachada. Um datagrama que chega em
+    F_X vindo de R_Y sai pelo socket F_Y para R_X: X vê Y em F_Y, responde
+    para lá, e o caminho de volta passa pelo proxy do mesmo jeito. As seeds
+    são fachadas e a entrada própria de cada dispositivo no gossip não leva
+    endereço: quem a recebe usa a origem do datagrama, que também é uma
+    fachada. Isso depende do protocolo, então counters["recebidos"] conta
+    o que chegou dos dispositivos, para quem usa o proxy conferir que nada
+    passou por fora. No caminho, cada datagrama pode ser descartado,
+    duplicado, atrasado (atraso fixo mais variação uniforme) ou segurado
+    por REORDER_DELAY para chegar depois dos seguintes.
+    """
+
+    def __init__(self, routes: Dict[int, int], host: str = "127.0.0.1", loss: float = 0.0,
+                 duplicate: float = 0.0, reorder: float = 0.0, delay: float = 0.0, jitter: float = 0.0,
+                 reorder_delay: float = REORDER_DELAY, seed: Optional[int] = None):
+        # porta de fachada -> porta real do dispositivo
+        self.routes = dict(routes)
+        self.fronts = {real: front for front, real in self.routes.items()}
+        self.host = host
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder_delay = reorder_delay
+        self.random = random.Random(seed)
+        self.counters = dict.fromkeys(("recebidos", "encaminhados", "descartados", "duplicados",
+                                       "reordenados", "desconhecidos", "perdidos_no_envio"), 0)
+        self.sockets: Dict[int, socket.socket] = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        for front in self.routes:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+            sock.bind((self.host, front))
+            sock.setblocking(False)
+            self.sockets[front] = sock
+        for front, sock in self.sockets.items():
+            self.loop.call_soon_threadsafe(self.loop.add_reader, sock.fileno(), self._readable, front)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+        for sock in self.sockets.values():
+            sock.close()
+        self.loop.close()
+
+    def front(self, real_port: int) -> tuple:
+        """Endereço pelo qual os outros devem falar com o dispositivo da porta real_port"""
+        return self.host, self.fronts[real_port]
+
+    def _readable(self, front: int):
+        sock = self.sockets[front]
+        while True:
+            try:
+                data, addr = sock.recvfrom(RECV_BUFFER_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue  # erro ICMP de um envio anterior
+            self._forward(data, addr, front)
+
+    def _forward(self, data: bytes, addr: tuple, front: int):
+        source_front = self.fronts.get(addr[1])
+        if source_front is None:
+            self.counters["desconhecidos"] += 1
+            return
+        self.counters["recebidos"] += 1
+        if self.random.random() < self.loss:
+            self.counters["descartados"] += 1
+            return
+        out = self.sockets[source_front]
+        dest = (self.host, self.routes[front])
+        copies = 1
+        if self.random.random() < self.duplicate:
+            copies = 2
+            self.counters["duplicados"] += 1
+        for _ in range(copies):
+            wait = self.delay + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+            if self.random.random() < self.reorder:
+                wait += self.reorder_delay
+                self.counters["reordenados"] += 1
+            if wait > 0:
+                self.loop.call_later(wait, self._send, out, data, dest)
+            else:
+                self._send(out, data, dest)
+
+    def _send(self, sock: socket.socket, data: bytes, dest: tuple):
+        try:
+            sock.sendto(data, dest)
+            self.counters["encaminhados"] += 1
+        except OSError:
+            # buffer cheio ou destino fora do ar: para o protocolo, é mais uma perda
+            self.counters["perdidos_no_envio"] += 1
@@ -0,0 +1,324 @@
+import ctypes
+import logging
+import multiprocessing
+import os
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set
+
+import metrics
+import transfer
+from device import Device
+from membership import DeviceInfo
+from store import STORE_DIR
+
+# Valor de <asm-generic/socket.h>; o módulo socket do Python não exporta a constante
+SO_ATTACH_REUSEPORT_CBPF = getattr(socket, "SO_ATTACH_REUSEPORT_CBPF", 51)
+SYNC_INTERVAL = 0.5
+# transferências encerradas que cada worker mantém no coordenador; as mais antigas saem
+FINISHED_RETENTION = metrics.MAX_TRANSFERS
+START_TIMEOUT = 10.0
+# métodos do Device que o processo principal pode chamar em um worker
+WORKER_COMMANDS = ("send_message", "send_file", "send_file_many", "pause_transfer", "resume_transfer",
+                   "cancel_transfer", "stats")
+
+# Instruções cBPF (código, jt, jf, k)
+BPF_LD_B_ABS = 0x30
+BPF_LD_W_ABS = 0x20
+BPF_JEQ_K = 0x15
+BPF_MOD_K = 0x94
+BPF_RET_A = 0x16
+BPF_RET_K = 0x06
+SOCK_FILTER = struct.Struct("HBBI")
+
+
+def attach_transfer_router(sock: socket.socket, workers: int):
+    """Instala no grupo SO_REUSEPORT da porta um programa cBPF que entrega cada
+    datagrama ao socket de índice (id da transferência mod workers).
+
+    O programa olha o byte mágico do formato binário e os 32 bits menos
+    significativos do id (offset 8 do payload UDP). Mensagens do formato
+    texto e as que não têm id (gossip) vão para o worker 0, o único que
+    faz descoberta. Os índices seguem a ordem em que os sockets fizeram
+    bind, por isso os workers sobem um de cada vez.
+    """
+    program = [
+        (BPF_LD_B_ABS, 0, 0, 0),
+        (BPF_JEQ_K, 0, 3, 0xD1),
+        (BPF_LD_W_ABS, 0, 0, 8),
+        (BPF_MOD_K, 0, 0, workers),
+        (BPF_RET_A, 0, 0, 0),
+        (BPF_RET_K, 0, 0, 0),
+    ]
+    filters = ctypes.create_string_buffer(b"".join(SOCK_FILTER.pack(*insn) for insn in program))
+    fprog = struct.pack("HP", len(program), ctypes.addressof(filters))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+
+
+class _WorkerSync(threading.Thread):
+    """Copia membros e transferências entre o worker e o coordenador.
+
+    Só as transferências que mudaram desde a última cópia passam pelo
+    proxy do Manager, e das encerradas o coordenador guarda as
+    FINISHED_RETENTION mais recentes de cada worker.
+    """
+
+    def __init__(self, device: Device, index: int, members, transfers):
+        super().__init__(daemon=True)
+        self.device = device
+        self.index = index
+        self.members = members
+        self.transfers = transfers
+        # o que o coordenador tem deste worker
+        self.pushed: Dict[str, dict] = {}
+        # encerradas, na ordem em que terminaram, e as já retiradas do coordenador
+        self.finished: Deque[str] = deque()
+        self.retired: Set[str] = set()
+
+    def run(self):
+        while self.device.running:
+            time.sleep(SYNC_INTERVAL)
+            try:
+                self.sync()
+            except (EOFError, OSError):
+                return  # coordenador encerrado
+
+    def sync(self):
+        device = self.device
+        if self.index == 0:
+            now = time.monotonic()
+            snapshot = {d.name: (d.ip, d.port, d.protocol_version, d.heartbeat, d.age(now))
+                        for d in device.known_devices.values()}
+            for name in set(self.members.keys()) - snapshot.keys():
+                self.members.pop(name, None)
+            self.members.update(snapshot)
+        else:
+            self.pull_members()
+        changed = {}
+        for t in device.list_transfers():
+            msg_id = t['id']
+            if msg_id in self.retired:
+                continue
+            entry = dict(t, worker=self.index)
+            previous = self.pushed.get(msg_id)
+            if entry == previous:
+                continue
+            changed[msg_id] = entry
+            if entry['status'] in transfer.FINAL_STATES and (
+                    previous is None or previous['status'] not in transfer.FINAL_STATES):
+                self.finished.append(msg_id)
+        if changed:
+            self.transfers.update(changed)
+            self.pushed.update(changed)
+        while len(self.finished) > FINISHED_RETENTION:
+            msg_id = self.finished.popleft()
+            self.transfers.pop(msg_id, None)
+            self.pushed.pop(msg_id, None)
+            self.retired.add(msg_id)
+
+    def pull_members(self):
+        self.device._call_in_loop(self._apply_members, self.members.copy())
+
+    def _apply_members(self, snapshot: dict):
+        known = self.device.known_devices
+        now = time.monotonic()
+        for name, (ip, port, version, heartbeat, age) in snapshot.items():
+            known.update(name, ip, port, version, heartbeat, now - age)
+        for info in known.values():
+            if info.name not in snapshot:
+                known.remove(info.name)
+
+
+def _worker_main(index: int, count: int, name: str, port: int, options: dict, members, transfers, conn,
+                 log_level: int = logging.WARNING):
+    """Processo worker: um Device na porta compartilhada, atendendo comandos do processo principal"""
+    # o processo é criado com spawn e não herda a configuração de logging
+    metrics.setup_logging(log_level)
+    device = None
+    store_dir = options.get("store_dir", STORE_DIR)
+    if store_dir and count > 1:
+        # cada worker tem o seu índice: os índices em memória não se enxergam, e o descarte
+        # de um worker apagaria entradas que outro ainda usa
+        options = dict(options, store_dir=os.path.join(store_dir, f"worker{index}"))
+    try:
+        device = Device(name, port, reuse_port=True, shard=(index, count), run_discovery=index == 0, **options)
+        if index == 0 and count > 1:
+            attach_transfer_router(device.socket, count)
+        device.start()
+    except Exception as e:
+        conn.send(("erro", str(e)))
+        if device:
+            device.stop()
+        return
+    sync = _WorkerSync(device, index, members, transfers)
+    sync.start()
+    conn.send(("pronto", None))
+    try:
+        while True:
+            command = conn.recv()
+            if command is None:
+                break
+            method, args = command
+            try:
+                if index and method in ("send_message", "send_file", "send_file_many"):
+                    # o destino pode ter sido descoberto depois da última cópia
+                    sync.pull_members()
+                conn.send(getattr(device, method)(*args) if method in WORKER_COMMANDS else None)
+            except Exception as e:
+                print(f"Erro no worker {index}: {e}")
+                conn.send(None)
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        device.stop()
+
+
+class DeviceCluster:
+    """Um dispositivo servido por vários processos na mesma porta (SO_REUSEPORT).
+
+    Cada worker roda um Device completo; um programa cBPF no grupo da porta
+    roteia cada transferência sempre para o mesmo worker, e os ids gerados
+    por um worker são escolhidos para cair nele mesmo. Só o worker 0 faz
+    descoberta; a tabela de membros e o resumo das transferências ficam em
+    um processo coordenador (multiprocessing.Manager), lido pelos demais
+    workers e por este objeto. Para os peers, é um único dispositivo.
+
+    A interface é a mesma do Device usada pela linha de comando.
+    """
+
+    def __init__(self, name: str, port: int = 5000, workers: Optional[int] = None, **options):
+        self.name = name
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.options = options
+        self.context = multiprocessing.get_context("spawn")
+        self.manager = None
+        self.members = None
+        self.transfers = None
+        self.processes = []
+        self.conns = []
+        self.locks: List[threading.Lock] = []
+        self.next_worker = 0
+
+    def start(self):
+        """Sobe o coordenador e os workers, um de cada vez para fixar a ordem no grupo SO_REUSEPORT"""
+        self.manager = self.context.Manager()
+        self.members = self.manager.dict()
+        self.transfers = self.manager.dict()
+        for index in range(self.workers):
+            conn, child_conn = self.context.Pipe()
+            process = self.context.Process(
+                target=_worker_main, daemon=True,
+                args=(index, self.workers, self.name, self.port, self.options,
+                      self.members, self.transfers, child_conn, logging.getLogger().getEffectiveLevel()))
+            process.start()
+            if not conn.poll(START_TIMEOUT):
+                self.stop()
+                raise RuntimeError(f"worker {index} não iniciou")
+            status, error = conn.recv()
+            if status != "pronto":
+                self.stop()
+                raise RuntimeError(f"worker {index} falhou ao iniciar: {error}")
+            self.processes.append(process)
+            self.conns.append(conn)
+            self.locks.append(threading.Lock())
+        print(f"Dispositivo {self.name} rodando com {self.workers} workers na porta {self.port}")
+
+    def stop(self):
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join(START_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        self.processes.clear()
+        self.conns.clear()
+        if self.manager:
+            self.manager.shutdown()
+            self.manager = None
+
+    def _call(self, index: int, method: str, *args):
+        with self.locks[index]:
+            self.conns[index].send((method, args))
+            return self.conns[index].recv()
+
+    def list_devices(self) -> List[DeviceInfo]:
+        """Lista dispositivos ativos, conforme a tabela do coordenador"""
+        now = time.monotonic()
+        active_devices = []
+        for name, (ip, port, version, heartbeat, age) in sorted(self.members.copy().items()):
+            active_devices.append(DeviceInfo(name, ip, port, version, heartbeat, now - age))
+            print(f"Nome: {name} | IP: {ip} | Porta: {port} | Tempo desde o último heartbeat: {age:.1f}s")
+        return active_devices
+
+    def send_message(self, target_name: str, message: str) -> bool:
+        return self._call(0, "send_message", target_name, message)
+
+    def send_file(self, target_name: str, filename: str) -> bool:
+        """Entrega o envio ao worker com menos envios em andamento"""
+        member = self.members.get(target_name)
+        if member is not None and not member[2]:
+            # peers antigos falam o formato texto, que o roteador sempre entrega ao worker 0
+            index = 0
+        else:
+            index = self._least_loaded()
+        return self._call(index, "send_file", target_name, filename)
+
+    def send_file_many(self, target_names: List[str], filename: str) -> bool:
+        """O envio em grupo inteiro fica em um worker; peers antigos do grupo recebem envios individuais dele"""
+        legacy = any(name in self.members and not self.members[name][2] for name in target_names)
+        index = 0 if legacy else self._least_loaded()
+        return self._call(index, "send_file_many", list(target_names), filename)
+
+    def _least_loaded(self) -> int:
+        load = [0] * self.workers
+        for t in self.transfers.values():
+            if t['direcao'] == 'envio' and t['status'] not in transfer.FINAL_STATES:
+                load[t['worker']] += 1
+        index = min(range(self.workers), key=lambda i: (load[i], (i - self.next_worker) % self.workers))
+        self.next_worker = (index + 1) % self.workers
+        return index
+
+    def stats(self) -> dict:
+        """Métricas de todos os workers, somadas"""
+        snapshots = [self._call(index, "stats") for index in range(self.workers)]
+        return metrics.merge_snapshots([s for s in snapshots if s is not None])
+
+    def export_stats(self, filename: str) -> bool:
+        try:
+            metrics.export(self.stats(), filename)
+            return True
+        except OSError as e:
+            print(f"Erro ao gravar as métricas: {e}")
+            return False
+
+    def list_transfers(self) -> List[dict]:
+        return list(self.transfers.values())
+
+    def _owner(self, msg_id: str) -> Optional[int]:
+        snapshot = self.transfers.copy()
+        if msg_id in snapshot:
+            return snapshot[msg_id]['worker']
+        matches = [t for t in snapshot.values() if t['id'].startswith(msg_id)]
+        return matches[0]['worker'] if len(matches) == 1 else None
+
+    def pause_transfer(self, msg_id: str) -> bool:
+        return self._call_owner(msg_id, "pause_transfer")
+
+    def resume_transfer(self, msg_id: str) -> bool:
+        return self._call_owner(msg_id, "resume_transfer")
+
+    def cancel_transfer(self, msg_id: str) -> bool:
+        return self._call_owner(msg_id, "cancel_transfer")
+
+    def _call_owner(self, msg_id: str, method: str) -> bool:
+        index = self._owner(msg_id)
+        if index is None:
+            return False
+        return self._call(index, method, msg_id)
@@ -0,0 +1,100 @@
+import os
+import zlib
+from typing import List, Optional
+
+try:
+    import lzma
+except ImportError:  # Python compilado sem liblzma
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Identificadores dos codecs no FILE e no ACK do FILE
+STORED = 0
+ZLIB = 1
+LZMA = 2
+ZSTD = 3
+
+NAMES = {STORED: "none", ZLIB: "zlib", LZMA: "lzma", ZSTD: "zstd"}
+BY_NAME = {name: codec for codec, name in NAMES.items()}
+
+DEFAULT_LEVELS = {ZLIB: 6, LZMA: 1, ZSTD: 3}
+
+# Amostra usada para decidir se vale a pena comprimir: alguns blocos espalhados pelo arquivo
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_COUNT = 3
+# abaixo desta economia o arquivo é enviado sem compressão (já comprimido, mídia etc.)
+MIN_SAVINGS = 0.1
+
+
+def available() -> List[int]:
+    codecs = [ZLIB]
+    if lzma is not None:
+        codecs.append(LZMA)
+    if zstandard is not None:
+        codecs.append(ZSTD)
+    return codecs
+
+
+def parse(name: str) -> int:
+    """Converte o nome configurado em codec; "auto" escolhe o melhor disponível"""
+    if name == "auto":
+        return ZSTD if zstandard is not None else ZLIB
+    codec = BY_NAME.get(name)
+    if codec is None:
+        raise ValueError(f"codec desconhecido: {name}")
+    if codec != STORED and codec not in available():
+        raise ValueError(f"codec {name} não está disponível")
+    return codec
+
+
+def compress(codec: int, data: bytes, level: Optional[int] = None) -> bytes:
+    """Comprime um bloco de forma independente dos demais"""
+    level = DEFAULT_LEVELS.get(codec) if level is None else level
+    if codec == ZLIB:
+        return zlib.compress(data, level)
+    if codec == LZMA:
+        return lzma.compress(data, preset=level)
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return data
+
+
+def decompress(codec: int, data: bytes, max_size: int) -> bytes:
+    """Descomprime um bloco, recusando saída maior que max_size"""
+    if codec == ZLIB:
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError("bloco comprimido inválido")
+        return result
+    if codec == LZMA:
+        decompressor = lzma.LZMADecompressor()
+        result = decompressor.decompress(data, max_size)
+        if not decompressor.eof:
+            raise ValueError("bloco comprimido inválido")
+        return result
+    if codec == ZSTD:
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+    return data
+
+
+def offer(filename: str, codec: int, level: Optional[int] = None) -> List[int]:
+    """Codecs a oferecer no FILE, em ordem de preferência; vazio se a amostra não comprime"""
+    if codec == STORED:
+        return []
+    size = os.path.getsize(filename)
+    if size == 0:
+        return []
+    sample = bytearray()
+    with open(filename, 'rb') as f:
+        for i in range(SAMPLE_COUNT):
+            f.seek(size * i // SAMPLE_COUNT)
+            sample += f.read(SAMPLE_SIZE)
+    if len(compress(codec, bytes(sample), level)) > len(sample) * (1 - MIN_SAVINGS):
+        return []
+    # zlib sempre existe do outro lado, então serve de alternativa
+    return [codec] if codec == ZLIB else [codec, ZLIB]
@@ -0,0 +1,99 @@
+import time
+from typing import Callable, Optional
+
+# Valores do RFC 6298, com mínimo menor que o do TCP porque o alvo é LAN/loopback
+INITIAL_RTO = 1.0
+MIN_RTO = 0.02
+MAX_RTO = 30.0
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+CLOCK_GRANULARITY = 0.001
+
+MAX_RETRIES = 8
+
+INITIAL_CWND = 4.0
+MIN_SSTHRESH = 2.0
+# rajada máxima (em blocos) permitida pelo pacing depois de um período ocioso
+PACING_BURST = 4
+
+
+class RttEstimator:
+    """Estimativa de RTT suavizado e de sua variação (Jacobson/Karels) para um peer"""
+
+    def __init__(self, on_sample: Optional[Callable[[float], None]] = None):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.samples = 0
+        # chamado a cada medida (histograma de RTT das métricas)
+        self.on_sample = on_sample
+
+    def update(self, sample: float):
+        """Incorpora uma medida de RTT (só de mensagens não retransmitidas, algoritmo de Karn)"""
+        if sample <= 0:
+            return
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - sample)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * sample
+        self.samples += 1
+        if self.on_sample:
+            self.on_sample(sample)
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + max(CLOCK_GRANULARITY, 4 * self.rttvar)))
+
+    def timeout(self, retries: int) -> float:
+        """Prazo para a tentativa de número retries (backoff exponencial)"""
+        return min(MAX_RTO, self.rto * (2 ** retries))
+
+
+class CongestionControl:
+    """Janela de congestionamento AIMD (slow start + congestion avoidance) com pacing"""
+
+    def __init__(self, initial_cwnd: float = INITIAL_CWND):
+        self.cwnd = initial_cwnd
+        self.ssthresh = float('inf')
+        # enquanto acked_until não passar deste seq, novas perdas fazem parte do mesmo episódio
+        self.recovery_point = -1
+        self.next_send_time = 0.0
+
+    def on_ack(self, acked_chunks: int):
+        if acked_chunks <= 0:
+            return
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked_chunks
+        else:
+            self.cwnd += acked_chunks / self.cwnd
+
+    def on_loss(self, acked_until: int, next_seq: int) -> bool:
+        """Perda detectada por ACKs duplicados: redução multiplicativa, uma vez por janela"""
+        if acked_until <= self.recovery_point:
+            return False
+        self.ssthresh = max(self.cwnd / 2, MIN_SSTHRESH)
+        self.cwnd = self.ssthresh
+        self.recovery_point = next_seq
+        return True
+
+    def on_timeout(self, acked_until: int, next_seq: int) -> bool:
+        """Timeout de retransmissão: volta ao slow start, uma vez por janela"""
+        if acked_until <= self.recovery_point:
+            return False
+        self.ssthresh = max(self.cwnd / 2, MIN_SSTHRESH)
+        self.cwnd = 1.0
+        self.recovery_point = next_seq
+        return True
+
+    def pacing_delay(self, srtt: float, now: float = None) -> float:
+        """Segundos até o próximo bloco poder sair (0 se já pode)"""
+        if srtt is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.next_send_time - now - PACING_BURST * srtt / self.cwnd)
+
+    def on_send(self, srtt: float, now: float = None):
+        """Espaça os envios em srtt / cwnd, distribuindo a janela ao longo de um RTT"""
+        if srtt is None:
+            return
+        now = time.monotonic() if now is None else now
+        self.next_send_time = max(self.next_send_time, now) + srtt / self.cwnd
@@ -0,0 +1,114 @@
+import asyncio
+import socket
+from collections import deque
+from typing import Callable, Deque, List, Optional, Sequence, Union
+
+import protocol
+
+# Quantos datagramas são lidos por vez quando o socket fica pronto
+RECV_BATCH = 16
+# Envios enfileirados enquanto o buffer do kernel está cheio; além disso, descarta (como o próprio UDP)
+MAX_SEND_QUEUE = 1024
+
+Buffers = Union[bytes, bytearray, memoryview, Sequence[bytes]]
+
+
+def buffer_size(data: Buffers) -> int:
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return len(data)
+    return sum(len(part) for part in data)
+
+
+class DatagramEndpoint:
+    """Socket UDP atendido direto pelo event loop, sem alocar por datagrama.
+
+    A cada vez que o socket fica legível, lê com recvfrom_into até RECV_BATCH
+    datagramas em buffers pré-alocados e só então os entrega ao handler, como
+    memoryviews desses buffers. O handler precisa copiar o que quiser guardar:
+    os buffers são reaproveitados na próxima leitura.
+
+    sendto aceita bytes ou uma sequência de buffers, enviada com sendmsg sem
+    concatenar (cabeçalho + payload de um bloco, por exemplo).
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, sock: socket.socket,
+                 handler: Callable[[memoryview, tuple], None],
+                 on_error: Optional[Callable[[Exception], None]] = None,
+                 batch: int = RECV_BATCH, buffer_size: int = protocol.RECV_BUFFER_SIZE):
+        self.loop = loop
+        self.sock = sock
+        self.handler = handler
+        self.on_error = on_error
+        self.buffers: List[bytearray] = [bytearray(buffer_size) for _ in range(batch)]
+        self.views: List[memoryview] = [memoryview(buf) for buf in self.buffers]
+        self.send_queue: Deque[tuple] = deque()
+        self.dropped = 0
+        self.closed = False
+
+    def start(self):
+        self.loop.add_reader(self.sock.fileno(), self._read_ready)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.sock.fileno())
+        self.loop.remove_writer(self.sock.fileno())
+        self.send_queue.clear()
+
+    def _read_ready(self):
+        received = []
+        for buf, view in zip(self.buffers, self.views):
+            try:
+                size, addr = self.sock.recvfrom_into(buf)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # erro ICMP de um envio anterior (porta inalcançável etc.)
+                self._error(e)
+                continue
+            received.append((view[:size], addr))
+        for data, addr in received:
+            self.handler(data, addr)
+
+    def sendto(self, data: Buffers, addr: tuple):
+        if self.closed:
+            return
+        if self.send_queue:
+            self._enqueue(data, addr)
+            return
+        try:
+            self._send(data, addr)
+        except (BlockingIOError, InterruptedError):
+            self._enqueue(data, addr)
+            self.loop.add_writer(self.sock.fileno(), self._write_ready)
+        except OSError as e:
+            self._error(e)
+
+    def _send(self, data: Buffers, addr: tuple):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            self.sock.sendto(data, addr)
+        else:
+            self.sock.sendmsg(data, (), 0, addr)
+
+    def _enqueue(self, data: Buffers, addr: tuple):
+        if len(self.send_queue) >= MAX_SEND_QUEUE:
+            self.dropped += 1
+            return
+        self.send_queue.append((data, addr))
+
+    def _write_ready(self):
+        while self.send_queue:
+            data, addr = self.send_queue[0]
+            try:
+                self._send(data, addr)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self._error(e)
+            self.send_queue.popleft()
+        self.loop.remove_writer(self.sock.fileno())
+
+    def _error(self, exc: Exception):
+        if self.on_error:
+            self.on_error(exc)
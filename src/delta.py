@@ -0,0 +1,145 @@
+import hashlib
+import mmap
+import os
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import protocol
+from source import FileSource
+from store import ChunkStore
+
+ADLER_MOD = 65521
+# Bytes percorridos um a um por arquivo base; esgotado o orçamento, só as posições alinhadas são testadas
+ROLL_BUDGET = 2 * 1024 * 1024
+COPY_BLOCK = 1024 * 1024
+
+
+def signature(filename: str, chunk_size: int) -> bytes:
+    """Assinatura do arquivo: Adler-32 (checksum fraco, deslizante) e hash forte de cada bloco"""
+    source = FileSource(filename, chunk_size, hashing=False)
+    try:
+        total = (source.size + chunk_size - 1) // chunk_size
+        entries = []
+        for seq in range(total):
+            block = source.chunk(seq)
+            entries.append(protocol.SIG_ENTRY.pack(zlib.adler32(block), protocol.chunk_hash(block)))
+            block.release()
+        return b"".join(entries)
+    finally:
+        source.close()
+
+
+def find_blocks(signatures: bytes, chunk_size: int, filesize: int, bases: Iterable[str],
+                store: Optional[ChunkStore] = None, budget: int = ROLL_BUDGET) -> Dict[int, Tuple[str, int]]:
+    """Procura, para cada bloco do arquivo novo, um lugar (caminho, offset) onde o conteúdo já existe aqui.
+
+    Primeiro consulta o store pelo hash forte; depois percorre cada arquivo
+    base com o Adler-32 deslizante, como no rsync, o que encontra blocos
+    deslocados por inserções e remoções. Quem usa o resultado ainda confere
+    o hash forte ao copiar o bloco.
+    """
+    entries = list(protocol.SIG_ENTRY.iter_unpack(signatures))
+    found: Dict[int, Tuple[str, int]] = {}
+    if store is not None:
+        for seq, (_, strong) in enumerate(entries):
+            location = store.find_block(strong)
+            if location is not None:
+                found[seq] = location
+    # checksum fraco -> blocos completos (o último, mais curto, só vem do store)
+    weak_index: Dict[int, List[int]] = {}
+    for seq, (weak, _) in enumerate(entries):
+        if (seq + 1) * chunk_size <= filesize:
+            weak_index.setdefault(weak, []).append(seq)
+    for path in bases:
+        if all(seq in found for seqs in weak_index.values() for seq in seqs):
+            break
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < chunk_size:
+                    continue
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            continue
+        try:
+            _scan(data, path, chunk_size, entries, weak_index, found, budget)
+        finally:
+            data.close()
+    return found
+
+
+def _scan(data: mmap.mmap, path: str, chunk_size: int, entries: List[tuple],
+          weak_index: Dict[int, List[int]], found: Dict[int, Tuple[str, int]], budget: int):
+    last = len(data) - chunk_size
+    missing = sum(1 for seqs in weak_index.values() for seq in seqs if seq not in found)
+    pos = 0
+    weak = None
+    rolled = 0
+    a = b = 0
+    while pos <= last and missing:
+        if weak is None:
+            weak = zlib.adler32(data[pos:pos + chunk_size])
+            a, b = weak & 0xFFFF, weak >> 16
+        seqs = weak_index.get(weak)
+        if seqs:
+            strong = protocol.chunk_hash(data[pos:pos + chunk_size])
+            matched = [seq for seq in seqs if entries[seq][1] == strong]
+            if matched:
+                for seq in matched:
+                    if seq not in found:
+                        found[seq] = (path, pos)
+                        missing -= 1
+                # mesmo um bloco já localizado (pelo store, por exemplo) mostra onde a
+                # sequência continua: pula o bloco inteiro em vez de deslizar por ele
+                pos += chunk_size
+                weak = None
+                continue
+        if rolled >= budget:
+            pos = (pos // chunk_size + 1) * chunk_size
+            weak = None
+            continue
+        if pos == last:
+            break
+        # desliza a janela um byte: tira data[pos], entra data[pos + chunk_size]
+        out, into = data[pos], data[pos + chunk_size]
+        a = (a - out + into) % ADLER_MOD
+        b = (b - chunk_size * out + a - 1) % ADLER_MOD
+        weak = (b << 16) | a
+        pos += 1
+        rolled += 1
+
+
+def read_block(path: str, offset: int, length: int, digest: bytes) -> Optional[bytes]:
+    """Lê um bloco local e só o devolve se bater com o hash esperado"""
+    try:
+        with open(path, 'rb') as f:
+            data = os.pread(f.fileno(), length, offset)
+    except OSError:
+        return None
+    if len(data) != length or protocol.chunk_hash(data) != digest:
+        return None
+    return data
+
+
+def copy_file(src: str, temp_filename: str, dest_filename: str, file_hash: str) -> bool:
+    """Copia um arquivo local conferindo o SHA-256; o destino só aparece com o rename atômico"""
+    sha256 = hashlib.sha256()
+    try:
+        with open(src, 'rb') as fin, open(temp_filename, 'wb') as fout:
+            while True:
+                data = fin.read(COPY_BLOCK)
+                if not data:
+                    break
+                sha256.update(data)
+                fout.write(data)
+            fout.flush()
+            os.fsync(fout.fileno())
+        if sha256.hexdigest() == file_hash:
+            os.replace(temp_filename, dest_filename)
+            return True
+    except OSError:
+        pass
+    try:
+        os.remove(temp_filename)
+    except OSError:
+        pass
+    return False
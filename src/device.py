@@ -1,126 +1,257 @@
+import asyncio
+import logging
 import socket
 import threading
-import time
-import uuid
 import os
 import base64
-import hashlib
-from typing import Dict, List, Optional
-from dataclasses import dataclass
-from datetime import datetime
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
 
-CHUNK_SIZE = 512
+import codec
+import datagram
+import delta
+import discovery
+import fanout
+import metrics
+import protocol
+import source
+import talk
+import transfer
+from congestion import MAX_RETRIES, RttEstimator
+from membership import DeviceInfo, Membership
+from receiver import FileReceiver
+from store import STORE_DIR, STORE_SIZE, ChunkStore
+from transfer import IncomingTransfer, OutgoingTransfer, TransferManager
 
-@dataclass
-class DeviceInfo:
-    name: str
-    ip: str
-    port: int
-    last_heartbeat: datetime
+log = logging.getLogger(__name__)
+
+# Tamanho de bloco do formato texto (base64 precisa caber no datagrama dos peers antigos)
+CHUNK_SIZE = 512
+WINDOW_SIZE = 64
+DUP_ACK_THRESHOLD = 3
+MAX_SACK_RANGES = 4
+# intervalos de blocos listados no ACK do FILE (retomada) e nos pedidos de reparo
+MAX_RESUME_RANGES = 1024
+# espera máxima entre duas passadas pelo heap de expiração
+EXPIRY_CHECK_INTERVAL = 1.0
+# buffers do socket pedidos ao kernel (limitados por net.core.rmem_max/wmem_max)
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+# páginas de assinatura pedidas ao mesmo tempo numa transferência delta
+SIG_WINDOW = 8
+# sem notícias do receptor durante a comparação, o remetente reenvia o FILE
+DELTA_WAIT = 1.0
+# nomes de parcial tentados por transferência quando os anteriores estão em uso
+MAX_PARTIALS = 64
 
 class Device:
-    def __init__(self, name: str, port: int = 5000):
+    def __init__(self, name: str, port: int = 5000, window_size: int = WINDOW_SIZE,
+                 max_chunk_size: int = protocol.MAX_CHUNK_SIZE,
+                 max_transfers: int = transfer.MAX_ACTIVE_TRANSFERS,
+                 max_bytes_in_flight: int = transfer.MAX_BYTES_IN_FLIGHT,
+                 gossip_interval: float = discovery.GOSSIP_INTERVAL,
+                 gossip_fanout: int = discovery.GOSSIP_FANOUT,
+                 multicast_group: Optional[str] = discovery.MULTICAST_GROUP,
+                 multicast_port: int = discovery.MULTICAST_PORT,
+                 seeds: Optional[List[tuple]] = None,
+                 device_timeout: float = discovery.DEVICE_TIMEOUT,
+                 compression: str = "auto",
+                 compression_level: Optional[int] = None,
+                 rcvbuf: Optional[int] = SOCKET_BUFFER_SIZE,
+                 sndbuf: Optional[int] = SOCKET_BUFFER_SIZE,
+                 recv_batch: int = datagram.RECV_BATCH,
+                 reuse_port: bool = False,
+                 shard: Tuple[int, int] = (0, 1),
+                 run_discovery: bool = True,
+                 store_dir: Optional[str] = STORE_DIR,
+                 store_size: int = STORE_SIZE,
+                 fanout_port: Optional[int] = fanout.FANOUT_PORT):
         self.name = name
         self.port = port
+        self.window_size = window_size
+        self.max_chunk_size = max_chunk_size
+        # codec oferecido nos envios binários ("none", "zlib", "lzma", "zstd" ou "auto")
+        self.compression = codec.parse(compression)
+        self.compression_level = compression_level
+        # índice dos arquivos recebidos, usado para não receber de novo o que já está aqui
+        self.store = ChunkStore(store_dir, store_size) if store_dir else None
         
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # vários processos (workers de um DeviceCluster) na mesma porta
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # buffers maiores absorvem rajadas de blocos sem descartes; o receptor anuncia
+        # metade do SO_RCVBUF como janela no ACK do FILE
+        self.rcvbuf = rcvbuf
+        if rcvbuf:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        if sndbuf:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
         self.socket.bind(('', port))
+        self.socket.setblocking(False)
+        self.recv_batch = recv_batch
+        # (índice, total): os ids gerados aqui caem no worker de mesmo índice
+        self.shard = shard
+        self.run_discovery = run_discovery
         
-        self.known_devices: Dict[str, DeviceInfo] = {}
+        self.known_devices = Membership(device_timeout, on_join=self._on_device_join,
+                                        on_leave=self._on_device_leave)
+        self.expiry_timer: Optional[asyncio.TimerHandle] = None
         
+        # msg_id -> (mensagem, endereço, timer de retransmissão, instante do envio, tentativas)
         self.pending_acks: Dict[str, tuple] = {}
+        # RTT suavizado por peer, usado para calcular os prazos de retransmissão
+        self.peer_rtt: Dict[tuple, RttEstimator] = {}
+        self.pacing_timer: Optional[asyncio.TimerHandle] = None
+        # contadores e histogramas do protocolo (comando stats)
+        self.metrics = metrics.Metrics()
         
-        self.receive_thread = threading.Thread(target=self._receive_loop)
-        self.heartbeat_thread = threading.Thread(target=self._heartbeat_loop)
-        self.ack_thread = threading.Thread(target=self._ack_loop)
+        # Todo o protocolo roda em um único event loop; os prazos de
+        # retransmissão ficam no heap de timers do loop (call_later), então
+        # não há varredura periódica das mensagens pendentes.
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.endpoint: Optional[datagram.DatagramEndpoint] = None
+        self.discovery = discovery.Discovery(self, gossip_interval, gossip_fanout,
+                                             multicast_group, multicast_port, seeds, device_timeout)
+        # envios para vários destinos e, do lado do receptor, os grupos multicast desses envios
+        self.fanout = fanout.FanOut(self, fanout_port)
+        # mensagens TALK dos peers binários, em sessões com seqs por peer
+        self.talk = talk.TalkSessions(self)
         
         self.running = True
         
-        self.file_send_state = None 
-        self.file_recv_state = {}  
+        self.transfers = TransferManager(max_active=max_transfers,
+                                         max_bytes_in_flight=max_bytes_in_flight)
+        self._pumping = False
         
     def start(self):
-        """Inicia o dispositivo e suas threads"""
-        self.receive_thread.start()
-        self.heartbeat_thread.start()
-        self.ack_thread.start()
+        """Inicia o event loop do dispositivo"""
+        self.loop_thread.start()
+        self._call_in_loop(self._open_endpoint)
         print(f"Dispositivo {self.name} iniciado na porta {self.port}")
-        self._send_heartbeat()  
+        if self.run_discovery:
+            asyncio.run_coroutine_threadsafe(self.discovery.start(), self.loop).result()
+        self._call_in_loop(self._expiry_tick)
         
     def stop(self):
-        """Para o dispositivo e suas threads"""
+        """Para o event loop e libera o socket"""
         self.running = False
+        if self.loop_thread.is_alive():
+            self._call_in_loop(self._shutdown)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
         self.socket.close()
-        self.receive_thread.join()
-        self.heartbeat_thread.join()
-        self.ack_thread.join()
-        
-    def _receive_loop(self):
-        """Loop principal de recebimento de mensagens"""
-        while self.running:
-            try:
-                data, addr = self.socket.recvfrom(1024)
-                self._handle_message(data, addr)
-            except Exception as e:
-                if self.running:
-                    print(f"Erro ao receber mensagem: {e}")
-                    
-    def _heartbeat_loop(self):
-        """Loop de envio de mensagens HEARTBEAT"""
-        while self.running:
+        self.loop.close()
+
+    def _open_endpoint(self):
+        self.endpoint = datagram.DatagramEndpoint(self.loop, self.socket, self._handle_message,
+                                                  self._on_socket_error, self.recv_batch)
+        self.endpoint.start()
+
+    def _on_socket_error(self, exc: Exception):
+        if self.running:
+            print(f"Erro ao receber mensagem: {exc}")
+
+    def _shutdown(self):
+        self.discovery.stop()
+        self.fanout.stop()
+        self.talk.stop()
+        if self.expiry_timer:
+            self.expiry_timer.cancel()
+        for entry in self.pending_acks.values():
+            entry[2].cancel()
+        self.pending_acks.clear()
+        if self.pacing_timer:
+            self.pacing_timer.cancel()
+        for t in list(self.transfers.outgoing.values()):
+            self._close_outgoing(t, transfer.CANCELADA)
+        for t in self.transfers.incoming.values():
+            if t.status in (transfer.ATIVA, transfer.COMPARANDO, transfer.RETOMANDO):
+                # o parcial fica no disco para a transferência ser retomada
+                self._cancel_sig_requests(t)
+                self.fanout.release(t)
+                if t.receiver is not None:
+                    t.receiver.close()
+                t.status = transfer.CANCELADA
+        if self.endpoint:
+            self.endpoint.close()
+
+    def _call_in_loop(self, func, *args):
+        """Executa func dentro do event loop e devolve o resultado para a thread chamadora"""
+        if threading.current_thread() is self.loop_thread:
+            return func(*args)
+        future = Future()
+
+        def call():
             try:
-                self._send_heartbeat()
+                future.set_result(func(*args))
             except Exception as e:
-                print(f"Erro ao enviar HEARTBEAT: {e}")
-            time.sleep(5)
-            
-    def _ack_loop(self):
-        """Loop para verificar ACKs pendentes"""
-        while self.running:
-            current_time = time.time()
-          
-            for msg_id, (message, addr, timestamp) in list(self.pending_acks.items()):
-                if current_time - timestamp > 2.0:
-                    self.socket.sendto(message.encode(), addr)
-                    self.pending_acks[msg_id] = (message, addr, time.time())
-            
-            if self.file_send_state:
-                for seq, (chunk_msg, addr, timestamp) in list(self.file_send_state['pending_chunks'].items()):
-                    if current_time - timestamp > 2.0:
-                        self.socket.sendto(chunk_msg.encode(), addr)
-                        self.file_send_state['pending_chunks'][seq] = (chunk_msg, addr, time.time())
-            time.sleep(0.1)
-            
-    def _send_heartbeat(self):
-        """Envia mensagem HEARTBEAT para dispositivos conhecidos"""
-        message = f"HEARTBEAT {self.name}"
-        try:
-            
-            for device in self.known_devices.values():
-                if device.port != self.port: 
-                    self.socket.sendto(message.encode(), ('127.0.0.1', device.port))
-            
-            
-            if not self.known_devices and self.port != 5000:
-                self.socket.sendto(message.encode(), ('127.0.0.1', 5000))
-                
-        except Exception as e:
-            print(f"Erro ao enviar HEARTBEAT: {e}")
-            
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(call)
+        return future.result()
+
+    def _sendto(self, data: datagram.Buffers, addr: tuple):
+        self.metrics.sent(addr, datagram.buffer_size(data))
+        self.endpoint.sendto(data, addr)
+
+    def _rtt_for(self, addr: tuple) -> RttEstimator:
+        rtt = self.peer_rtt.get(addr)
+        if rtt is None:
+            rtt = self.peer_rtt[addr] = RttEstimator(self.metrics.peer(addr).rtt.observe)
+        return rtt
+
+    def _send_reliable(self, msg_id: str, message: bytes, addr: tuple, retries: int = 0):
+        """Envia uma mensagem e agenda sua retransmissão até chegar o ACK"""
+        self._sendto(message, addr)
+        timeout = self._rtt_for(addr).timeout(retries)
+        timer = self.loop.call_later(timeout, self._on_ack_timeout, msg_id)
+        self.pending_acks[msg_id] = (message, addr, timer, self.loop.time(), retries)
+
+    def _on_ack_timeout(self, msg_id: str):
+        if msg_id not in self.pending_acks:
+            return
+        message, addr, _, _, retries = self.pending_acks[msg_id]
+        if retries >= MAX_RETRIES:
+            self._clear_pending_ack(msg_id)
+            print(f"Mensagem {msg_id} não confirmada após {retries + 1} tentativas")
+            self._reliable_failed(msg_id)
+            return
+        self.metrics.retransmitted(addr)
+        self._send_reliable(msg_id, message, addr, retries + 1)
+
+    def _clear_pending_ack(self, msg_id: str) -> Optional[tuple]:
+        entry = self.pending_acks.pop(msg_id, None)
+        if entry:
+            entry[2].cancel()
+        return entry
+
+    def _reliable_failed(self, msg_id: str):
+        """Desiste de uma mensagem; se ela abria ou fechava um envio de arquivo, o envio falha"""
+        t = self.transfers.outgoing.get(msg_id[:-4] if msg_id.endswith('_END') else msg_id)
+        if t and t.status not in transfer.FINAL_STATES:
+            print(f"Transferência {t.msg_id} falhou: o destino não responde")
+            self._close_outgoing(t, transfer.FALHOU)
+
     def send_message(self, target_name: str, message: str) -> bool:
         """Envia uma mensagem para um dispositivo específico"""
+        return self._call_in_loop(self._send_message, target_name, message)
+
+    def _send_message(self, target_name: str, message: str) -> bool:
         if target_name not in self.known_devices:
             print(f"Dispositivo {target_name} não encontrado")
             return False
             
         target = self.known_devices[target_name]
-        msg_id = str(uuid.uuid4())
-        talk_message = f"TALK {msg_id} {message}"
+        if target.protocol_version:
+            return self.talk.send((target.ip, target.port), message.encode())
+        msg_id = protocol.new_transfer_id(*self.shard)
+        talk_message = f"TALK {msg_id} {message}".encode()
         
         try:
-            self.socket.sendto(talk_message.encode(), ('127.0.0.1', target.port))
-            self.pending_acks[msg_id] = (talk_message, ('127.0.0.1', target.port), time.time())
+            self._send_reliable(msg_id, talk_message, (target.ip, target.port))
             return True
         except Exception as e:
             print(f"Erro ao enviar mensagem: {e}")
@@ -128,6 +259,9 @@ class Device:
         
     def send_file(self, target_name: str, filename: str) -> bool:
         """Inicia o envio de um arquivo para um dispositivo específico"""
+        return self._call_in_loop(self._send_file, target_name, filename)
+
+    def _send_file(self, target_name: str, filename: str) -> bool:
         if target_name not in self.known_devices:
             print(f"Dispositivo {target_name} não encontrado")
             return False
@@ -135,254 +269,1053 @@ class Device:
             print(f"Arquivo '{filename}' não encontrado")
             return False
         target = self.known_devices[target_name]
-        msg_id = str(uuid.uuid4())
-        filesize = os.path.getsize(filename)
-        total_chunks = (filesize + CHUNK_SIZE - 1) // CHUNK_SIZE
-        file_message = f"FILE {msg_id} {os.path.basename(filename)} {filesize}"
+        addr = (target.ip, target.port)
+        binary = bool(target.protocol_version)
+        # proposta de tamanho de bloco; o receptor pode reduzi-la no ACK do FILE
+        chunk_size = min(self.max_chunk_size, protocol.max_chunk_size(addr)) if binary else CHUNK_SIZE
+        t = OutgoingTransfer(
+            msg_id=protocol.new_transfer_id(*self.shard),
+            filename=filename,
+            filesize=os.path.getsize(filename),
+            target_name=target_name,
+            addr=addr,
+            binary=binary,
+            chunk_size=chunk_size,
+            # no formato texto, começa em stop-and-wait: o receptor original confirma
+            # cada bloco com um ACK sem seq, que só identifica o único bloco pendente
+            window=self.window_size if binary else 1,
+            rtt=self._rtt_for(addr)
+        )
+        if not self.transfers.add_outgoing(t):
+            print(f"Limite de transferências atingido; envio {t.msg_id} aguardando na fila")
+            return True
         try:
-            self.socket.sendto(file_message.encode(), ('127.0.0.1', target.port))
-            self.pending_acks[msg_id] = (file_message, ('127.0.0.1', target.port), time.time())
-            self.file_send_state = {
-                'msg_id': msg_id,
-                'filename': filename,
-                'filesize': filesize,
-                'target': target,
-                'next_seq': 0,
-                'pending_chunks': {},
-                'acknowledged': False,
-                'total_chunks': total_chunks
-            }
+            self._send_file_request(t)
             print(f"Solicitação de envio de arquivo enviada para {target_name}")
             return True
         except Exception as e:
             print(f"Erro ao enviar FILE: {e}")
+            self._close_outgoing(t, transfer.FALHOU)
+            return False
+
+    def send_file_many(self, target_names: List[str], filename: str) -> bool:
+        """Envia um arquivo a vários dispositivos, lendo e montando cada bloco uma única vez"""
+        return self._call_in_loop(self.fanout.send, target_names, filename)
+
+    def _send_file_request(self, t: OutgoingTransfer):
+        """Envia o FILE que abre a transferência"""
+        if t.binary and t.file_hash is None:
+            # o hash vai no FILE para o receptor poder retomar uma tentativa anterior
+            self.loop.create_task(self._prepare_file_request(t))
+            return
+        basename = os.path.basename(t.filename)
+        if t.binary:
+            payload, flags = protocol.encode_file_info(basename, t.filesize, t.chunk_size,
+                                                       bytes.fromhex(t.file_hash), t.codecs, delta=True)
+            file_message = protocol.encode(protocol.FILE, t.msg_id, payload=payload, flags=flags)
+        else:
+            file_message = f"FILE {t.msg_id} {basename} {t.filesize}".encode()
+        self._send_reliable(t.msg_id, file_message, t.addr)
+
+    async def _prepare_file_request(self, t: OutgoingTransfer):
+        """Calcula o hash e testa uma amostra do arquivo com o codec fora do loop, depois envia o FILE"""
+        try:
+            t.codecs = await self.loop.run_in_executor(None, codec.offer, t.filename,
+                                                       self.compression, self.compression_level)
+            t.file_hash = await self.loop.run_in_executor(None, source.file_hash, t.filename)
+        except Exception as e:
+            print(f"Erro ao enviar FILE: {e}")
+            self._close_outgoing(t, transfer.FALHOU)
+            return
+        if t.status == transfer.AGUARDANDO:
+            self._send_file_request(t)
+
+    def _wait_delta(self, t: OutgoingTransfer):
+        """O receptor está comparando com arquivos locais; sem notícias dele por DELTA_WAIT, reenvia o FILE"""
+        self._stop_delta_wait(t)
+        t.delta_timer = self.loop.call_later(DELTA_WAIT, self._on_delta_wait, t)
+
+    def _stop_delta_wait(self, t: OutgoingTransfer):
+        if t.delta_timer:
+            t.delta_timer.cancel()
+            t.delta_timer = None
+
+    def _on_delta_wait(self, t: OutgoingTransfer):
+        t.delta_timer = None
+        if t.status == transfer.AGUARDANDO and t.msg_id not in self.pending_acks:
+            # a resposta é outro ACK do FILE: de espera, definitivo ou do END
+            self._send_file_request(t)
+
+    def _send_sig_page(self, msg_id: str, page: int, addr: tuple):
+        """Responde ao pedido de uma página da assinatura dos blocos"""
+        t = self.transfers.outgoing.get(msg_id)
+        if t is None or t.status != transfer.AGUARDANDO:
+            return
+        self._wait_delta(t)
+        if t.signatures is None:
+            if not t.sig_waiting:
+                self.loop.create_task(self._compute_signatures(t))
+            t.sig_waiting.add(page)
+            return
+        size = protocol.sig_entries_per_page(t.chunk_size) * protocol.SIG_ENTRY.size
+        payload = t.signatures[page * size:(page + 1) * size]
+        if payload:
+            self._sendto(protocol.encode(protocol.SIG, msg_id, page, payload=payload), addr)
+
+    async def _compute_signatures(self, t: OutgoingTransfer):
+        try:
+            signatures = await self.loop.run_in_executor(None, delta.signature, t.filename, t.chunk_size)
+        except Exception as e:
+            print(f"Erro ao calcular a assinatura de {t.filename}: {e}")
+            self._close_outgoing(t, transfer.FALHOU)
+            self._send_nack(t.msg_id, t.addr, t.binary, "erro_de_leitura")
+            return
+        t.signatures = signatures
+        waiting, t.sig_waiting = t.sig_waiting, set()
+        for page in sorted(waiting):
+            self._send_sig_page(t.msg_id, page, t.addr)
+
+    def stats(self) -> dict:
+        """Snapshot das métricas do protocolo: contadores, histogramas e vazão recente"""
+        return self._call_in_loop(self._stats)
+
+    def _stats(self) -> dict:
+        names = {(d.ip, d.port): d.name for d in self.known_devices.values()}
+        snapshot = self.metrics.snapshot(names)
+        snapshot["dispositivo"] = self.name
+        snapshot["total"]["descartados_no_envio"] = self.endpoint.dropped if self.endpoint else 0
+        for addr, rtt in self.peer_rtt.items():
+            peer = snapshot["peers"].get(f"{addr[0]}:{addr[1]}")
+            if peer is not None:
+                peer["srtt"] = rtt.srtt
+                peer["rto"] = rtt.rto
+        return snapshot
+
+    def export_stats(self, filename: str) -> bool:
+        """Grava o snapshot das métricas em JSON"""
+        try:
+            metrics.export(self.stats(), filename)
+            return True
+        except OSError as e:
+            print(f"Erro ao gravar as métricas: {e}")
+            return False
+
+    def list_transfers(self) -> List[dict]:
+        """Lista as transferências de arquivo (envio e recebimento)"""
+        return self._call_in_loop(self._list_transfers)
+
+    def _list_transfers(self) -> List[dict]:
+        return self.transfers.list() + self.fanout.list()
+
+    def pause_transfer(self, msg_id: str) -> bool:
+        """Suspende o envio de blocos novos de uma transferência"""
+        return self._call_in_loop(self._pause_transfer, msg_id)
+
+    def _pause_transfer(self, msg_id: str) -> bool:
+        g = self.fanout.find(msg_id)
+        if g is not None:
+            return self.fanout.pause(g)
+        t = self.transfers.find(msg_id)
+        if not isinstance(t, OutgoingTransfer) or t.status != transfer.ATIVA:
+            return False
+        t.status = transfer.PAUSADA
+        return True
+
+    def resume_transfer(self, msg_id: str) -> bool:
+        """Retoma uma transferência pausada"""
+        return self._call_in_loop(self._resume_transfer, msg_id)
+
+    def _resume_transfer(self, msg_id: str) -> bool:
+        g = self.fanout.find(msg_id)
+        if g is not None:
+            return self.fanout.resume(g)
+        t = self.transfers.find(msg_id)
+        if not isinstance(t, OutgoingTransfer) or t.status != transfer.PAUSADA:
             return False
+        t.status = transfer.ATIVA
+        self._pump()
+        return True
+
+    def cancel_transfer(self, msg_id: str) -> bool:
+        """Cancela uma transferência e avisa o outro lado com um NACK"""
+        return self._call_in_loop(self._cancel_transfer, msg_id)
+
+    def _cancel_transfer(self, msg_id: str) -> bool:
+        g = self.fanout.find(msg_id)
+        if g is not None:
+            return self.fanout.cancel(g)
+        t = self.transfers.find(msg_id)
+        if t is None or t.status in transfer.FINAL_STATES:
+            return False
+        was_queued = t.status == transfer.NA_FILA
+        if isinstance(t, OutgoingTransfer):
+            self._close_outgoing(t, transfer.CANCELADA)
+        else:
+            self._cancel_sig_requests(t)
+            self.fanout.release(t)
+            if t.receiver is not None:
+                t.receiver.abort()
+            t.status = transfer.CANCELADA
+        if not was_queued:
+            self._send_nack(t.msg_id, t.addr, t.binary, "cancelado")
+        print(f"Transferência {t.msg_id} cancelada")
+        return True
         
     def _handle_message(self, data: bytes, addr: tuple):
         """Processa mensagens recebidas"""
+        self.metrics.received(addr, len(data))
         try:
-            message = data.decode()
+            if protocol.is_binary(data):
+                self._handle_packet(protocol.decode(data), addr)
+                return
+
+            message = bytes(data).decode()
             parts = message.split()
             
             if parts[0] == "HEARTBEAT":
-                self._handle_heartbeat(parts[1], addr)
+                version = int(parts[2][1:]) if len(parts) > 2 and parts[2].startswith("v") else 0
+                self._handle_heartbeat(parts[1], addr, version)
             elif parts[0] == "TALK":
-                self._handle_talk(parts[1], parts[2:], addr)
+                self._handle_talk(parts[1], ' '.join(parts[2:]), addr, False)
             elif parts[0] == "ACK":
-                self._handle_ack(parts[1])
+                if len(parts) > 2:
+                    ranges = protocol.parse_ranges(parts[3]) if len(parts) > 3 else []
+                    t = self.transfers.outgoing.get(parts[1])
+                    if t is not None:
+                        # o receptor confirma com seq: não é o original, a janela pode abrir
+                        t.window = self.window_size
+                    self._handle_chunk_ack(parts[1], int(parts[2]), ranges)
+                else:
+                    self._handle_ack(parts[1])
             elif parts[0] == "FILE":
-                self._handle_file(parts[1], parts[2:], addr)
+                self._handle_file(parts[1], parts[2], int(parts[3]), CHUNK_SIZE, addr, False)
             elif parts[0] == "CHUNK":
-                self._handle_chunk(parts[1], parts[2:], addr)
+                try:
+                    chunk = base64.b64decode(parts[3])
+                except Exception:
+                    print(f"Erro ao processar bloco {parts[2]} do arquivo (id {parts[1]}): Incorrect padding")
+                    return
+                self._handle_chunk(parts[1], int(parts[2]), chunk, addr)
             elif parts[0] == "END":
-                self._handle_end(parts[1], parts[2:], addr)
+                self._handle_end(parts[1], parts[2], addr)
             elif parts[0] == "NACK":
-                self._handle_nack(parts[1], parts[2:], addr)
+                self._handle_nack(parts[1], ' '.join(parts[2:]), addr)
                 
         except Exception as e:
             print(f"Erro ao processar mensagem: {e}")
+
+    def _handle_packet(self, packet: protocol.Packet, addr: tuple):
+        """Despacha uma mensagem do formato binário"""
+        kind = packet.kind
+        if kind == protocol.CHUNK:
+            if packet.flags & protocol.FLAG_HASH:
+                digest = packet.payload[:protocol.CHUNK_HASH_SIZE]
+                self._handle_chunk(packet.msg_id, packet.seq, packet.payload[protocol.CHUNK_HASH_SIZE:], addr, digest,
+                                   bool(packet.flags & protocol.FLAG_COMPRESSED))
+            else:
+                self._handle_chunk(packet.msg_id, packet.seq, packet.payload, addr)
+        elif kind == protocol.ACK:
+            if packet.flags & protocol.FLAG_SESSION:
+                self.talk.handle_ack(packet.payload, addr)
+            elif packet.flags & protocol.FLAG_CHUNK_ACK:
+                self._handle_chunk_ack(packet.msg_id, packet.seq, protocol.decode_sack(packet.payload))
+            else:
+                self._handle_ack(packet.msg_id, packet.payload, packet.flags, addr)
+        elif kind == protocol.GOSSIP_SYN:
+            self.discovery.handle_syn(packet.payload, addr)
+        elif kind == protocol.GOSSIP_ACK:
+            self.discovery.handle_ack(packet.payload, addr)
+        elif kind == protocol.GOSSIP_ACK2:
+            self.discovery.handle_ack2(packet.payload, addr)
+        elif kind == protocol.HEARTBEAT:
+            self._handle_heartbeat(bytes(packet.payload).decode(), addr, protocol.PROTOCOL_VERSION)
+        elif kind == protocol.TALK:
+            if packet.flags & protocol.FLAG_SESSION:
+                self.talk.handle_batch(packet, addr)
+            else:
+                self._handle_talk(packet.msg_id, bytes(packet.payload).decode(), addr, True)
+        elif kind == protocol.FILE:
+            filename, filesize, chunk_size, file_hash, codecs, group = protocol.decode_file_info(packet.payload,
+                                                                                                packet.flags)
+            self._handle_file(packet.msg_id, filename, filesize, chunk_size, addr, True, file_hash, codecs,
+                              bool(packet.flags & protocol.FLAG_DELTA), group)
+        elif kind == protocol.END:
+            self._handle_end(packet.msg_id, packet.payload.hex(), addr)
+        elif kind == protocol.NACK:
+            if packet.flags & protocol.FLAG_CHUNK_ACK:
+                self.fanout.handle_report(packet.msg_id, packet.seq, protocol.decode_sack(packet.payload), addr)
+            else:
+                self._handle_nack(packet.msg_id, bytes(packet.payload).decode(), addr)
+        elif kind == protocol.SIG:
+            if packet.payload:
+                self._handle_sig_page(packet.msg_id, packet.seq, bytes(packet.payload))
+            else:
+                self._send_sig_page(packet.msg_id, packet.seq, addr)
+
+    def _send_ack(self, msg_id: str, addr: tuple, binary: bool, payload: bytes = b"", flags: int = 0):
+        """Envia um ACK simples no mesmo formato da mensagem confirmada"""
+        if binary:
+            ack_message = protocol.encode(protocol.ACK, msg_id, payload=payload, flags=flags)
+        else:
+            ack_message = f"ACK {msg_id}".encode()
+        self._sendto(ack_message, addr)
             
-    def _handle_heartbeat(self, device_name: str, addr: tuple):
+    def _handle_heartbeat(self, device_name: str, addr: tuple, protocol_version: int = 0):
         """Atualiza lista de dispositivos com novo HEARTBEAT"""
         if device_name != self.name:  
-            device_info = DeviceInfo(
-                name=device_name,
-                ip=addr[0],
-                port=addr[1],
-                last_heartbeat=datetime.now()
-            )
-        
-            if device_name not in self.known_devices:
-                print(f"Novo dispositivo {device_name} detectado em {addr[0]}:{addr[1]}")
-            self.known_devices[device_name] = device_info
+            known = self.known_devices.get(device_name)
+            heartbeat = known.heartbeat if known else 0
+            self.known_devices.update(device_name, addr[0], addr[1], protocol_version, heartbeat)
+
+    def _on_device_join(self, info: DeviceInfo):
+        if not self.run_discovery:
+            return  # membro copiado do coordenador; quem descobre e avisa é o worker principal
+        print(f"Novo dispositivo {info.name} detectado em {info.ip}:{info.port}")
+        self.discovery.on_new_device(info)
+
+    def _on_device_leave(self, info: DeviceInfo):
+        self.talk.forget((info.ip, info.port))
+        if self.run_discovery:
+            print(f"Dispositivo {info.name} removido por inatividade")
+
+    def _expiry_tick(self):
+        """Remove os dispositivos expirados e agenda a próxima passada pelo prazo mais próximo"""
+        self.known_devices.expire()
+        if not self.running:
+            return
+        delay = EXPIRY_CHECK_INTERVAL
+        deadline = self.known_devices.next_deadline()
+        if deadline is not None:
+            delay = min(delay, max(0.0, deadline - time.monotonic()))
+        self.expiry_timer = self.loop.call_later(delay, self._expiry_tick)
             
-    def _handle_talk(self, msg_id: str, message_parts: List[str], addr: tuple):
+    def _handle_talk(self, msg_id: str, message: str, addr: tuple, binary: bool):
         """Processa mensagem TALK recebida"""
-        message = ' '.join(message_parts)
-        print(f"\nMensagem recebida: {message}\n")
-        
-        ack_message = f"ACK {msg_id}"
+        self._show_talk(message, addr)
         try:
-            self.socket.sendto(ack_message.encode(), addr)
+            self._send_ack(msg_id, addr, binary)
         except Exception as e:
             print(f"Erro ao enviar ACK: {e}")
             
-    def _handle_ack(self, msg_id: str):
+    def _show_talk(self, message: str, addr: tuple):
+        sender = self.known_devices.by_addr(addr)
+        if sender:
+            print(f"\nMensagem recebida de {sender.name}: {message}\n")
+        else:
+            print(f"\nMensagem recebida: {message}\n")
+
+    def _handle_ack(self, msg_id: str, payload: bytes = b"", flags: int = 0, addr: tuple = None):
         """Processa ACK recebido"""
-        if msg_id in self.pending_acks:
-            del self.pending_acks[msg_id]
-            print(f"Mensagem {msg_id} confirmada")
-            if self.file_send_state and self.file_send_state['msg_id'] == msg_id and not self.file_send_state['acknowledged']:
-                self.file_send_state['acknowledged'] = True
-                threading.Thread(target=self._send_file_chunks).start()
-            if self.file_send_state and msg_id == self.file_send_state['msg_id'] + '_END':
+        if addr is not None and self.fanout.handle_ack(msg_id, payload, flags, addr):
+            return
+        entry = self._clear_pending_ack(msg_id)
+        if entry:
+            _, addr, _, sent_at, retries = entry
+            if retries == 0:
+                # algoritmo de Karn: só mede RTT de mensagens não retransmitidas
+                self._rtt_for(addr).update(self.loop.time() - sent_at)
+            log.debug("Mensagem %s confirmada", msg_id)
+        t = self.transfers.outgoing.get(msg_id)
+        if t and not t.binary:
+            if entry is None and t.status == transfer.ATIVA:
+                self._handle_bare_chunk_ack(t)
+                return
+            if entry and entry[4]:
+                self._wait_stray_acks(t)
+        # numa transferência delta o ACK definitivo do FILE chega depois, sem mensagem pendente
+        if t and t.status == transfer.AGUARDANDO and (entry or t.delta_timer):
+            if payload:
+                # o receptor pode ter aceito um bloco menor que o proposto e
+                # limita quantos bytes podem estar em trânsito sem estourar seu buffer
+                chunk_size, recv_window, chosen, held = protocol.decode_file_ack(payload, flags)
+                if 0 < chunk_size < t.chunk_size:
+                    t.chunk_size = chunk_size
+                t.window = max(1, min(self.window_size, recv_window // t.chunk_size))
+                if chosen in t.codecs:
+                    t.codec = chosen
+                if flags & protocol.FLAG_DELTA:
+                    # o receptor vai pedir a assinatura e procurar os blocos localmente
+                    self._wait_delta(t)
+                    return
+                # blocos que o receptor guardou de uma tentativa anterior (ou achou
+                # em arquivos locais) não são reenviados
+                for a, b in held:
+                    t.held.update(range(a, b + 1))
+                if t.held:
+                    t.skip_held(0)
+                    t.acked_until = t.next_seq
+                    print(f"Retomando transferência {t.msg_id}: o destino já tem "
+                          f"{len(t.held)} de {t.total_chunks} blocos")
+            self._stop_delta_wait(t)
+            self._start_file_chunks(t)
+        if msg_id.endswith('_END'):
+            t = self.transfers.outgoing.get(msg_id[:-4])
+            if t and t.status == transfer.FINALIZANDO:
                 print("Transferência de arquivo finalizada com sucesso!")
-                self.file_send_state = None
+                self._close_outgoing(t, transfer.CONCLUIDA)
+            elif t and t.status == transfer.AGUARDANDO and t.binary:
+                # o destino já tinha o conteúdo e o salvou sem receber nenhum bloco
+                print(f"O destino já tinha {os.path.basename(t.filename)}; nada a enviar")
+                self._close_outgoing(t, transfer.CONCLUIDA)
         
-    def _handle_file(self, msg_id: str, file_parts: list, addr: tuple):
+    def _handle_file(self, msg_id: str, filename: str, filesize: int, chunk_size: int, addr: tuple, binary: bool,
+                     file_hash: Optional[bytes] = None, codecs: List[int] = (), delta_offered: bool = False,
+                     group: Optional[tuple] = None):
         """Processa mensagem FILE recebida"""
-        filename = file_parts[0]
-        filesize = int(file_parts[1])
-        total_chunks = (filesize + CHUNK_SIZE - 1) // CHUNK_SIZE
-        print(f"\nSolicitação de recebimento de arquivo: {filename} ({filesize} bytes) de {addr[0]}:{addr[1]}")
-        ack_message = f"ACK {msg_id}"
+        filename = os.path.basename(filename)
+        chunk_size = max(1, min(chunk_size, self.max_chunk_size))
+        t = self.transfers.incoming.get(msg_id)
+        if t is None:
+            if not self.transfers.can_accept_incoming():
+                print(f"Recusando arquivo {filename}: limite de transferências atingido")
+                self._send_nack(msg_id, addr, binary, "limite_de_transferencias")
+                return
+            print(f"\nSolicitação de recebimento de arquivo: {filename} ({filesize} bytes) de {addr[0]}:{addr[1]}")
+            delta = group is None and delta_offered and file_hash and filesize and self.store is not None
+            # conteúdo idêntico já salvo aqui: nada a receber, então nem cria o parcial
+            stored = self.store.find_file(file_hash.hex()) if delta else None
+            receiver = None
+            if stored is None:
+                try:
+                    receiver = self._open_receiver(msg_id, filename, filesize, chunk_size, file_hash)
+                except Exception as e:
+                    print(f"Erro ao criar arquivo temporário: {e}")
+                    self._send_nack(msg_id, addr, binary, "erro_de_escrita")
+                    return
+                if receiver.resumed:
+                    print(f"Retomando {filename}: {receiver.received_count} de {receiver.total_chunks} "
+                          f"blocos já recebidos")
+            t = self.transfers.incoming[msg_id] = IncomingTransfer(
+                msg_id=msg_id,
+                filename=filename,
+                filesize=filesize,
+                addr=addr,
+                binary=binary,
+                receiver=receiver,
+                # primeiro codec da oferta que este lado sabe descomprimir
+                codec=next((c for c in codecs if c in codec.available()), codec.STORED),
+                file_hash=file_hash,
+                chunk_size=chunk_size
+            )
+            if group is not None:
+                self.fanout.accept(t, group)
+            if stored is not None:
+                self._start_restore(t, stored)
+            elif receiver.resumed:
+                # o prefixo recuperado precisa passar pelo hash; relê-lo pode levar segundos
+                t.status = transfer.RETOMANDO
+                self.loop.create_task(self._catch_up(t, delta_offered))
+            elif delta:
+                self._start_delta(t)
+        if t.committed and binary:
+            # já salvo (talvez sem receber nenhum bloco): o ACK do END encerra o envio do outro lado
+            self._send_ack(msg_id + "_END", addr, binary)
+            return
+        self._send_file_ack(t)
+
+    async def _catch_up(self, t: IncomingTransfer, delta_offered: bool):
+        """Retomada: passa o prefixo já recebido pelo hash fora do loop, depois confirma o FILE"""
+        try:
+            await self.loop.run_in_executor(None, t.receiver.catch_up)
+        except Exception as e:
+            if t.status != transfer.RETOMANDO:
+                return  # cancelada enquanto isso
+            print(f"Erro ao ler o arquivo parcial: {e}")
+            self.fanout.release(t)
+            t.receiver.close()
+            t.status = transfer.FALHOU
+            self._send_nack(t.msg_id, t.addr, t.binary, "erro_de_leitura")
+            return
+        if t.status != transfer.RETOMANDO:
+            return
+        t.status = transfer.ATIVA
+        if t.group is None and delta_offered and self.store is not None and not t.receiver.complete:
+            self._start_delta(t)
+        self._send_file_ack(t)
+
+    def _send_file_ack(self, t: IncomingTransfer):
+        """ACK do FILE; durante a comparação com arquivos locais, pede ao remetente que espere"""
+        if t.status == transfer.RETOMANDO and t.group is not None:
+            return  # o envio em grupo não tem ACK de espera: ele reenvia o FILE até a retomada acabar
         try:
-            self.socket.sendto(ack_message.encode(), addr)
-            self.file_recv_state[msg_id] = {
-                'filename': filename,
-                'filesize': filesize,
-                'received_chunks': {},
-                'data_chunks': {},
-                'total_chunks': total_chunks
-            }
+            payload, flags = b"", 0
+            if t.binary:
+                recv_window = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2
+                comparing = t.status in (transfer.COMPARANDO, transfer.RETOMANDO)
+                receiver = t.receiver
+                held = receiver.held_ranges(MAX_RESUME_RANGES) if receiver and receiver.fd is not None \
+                    and not comparing else []
+                chunk_size = receiver.chunk_size if receiver else t.chunk_size
+                payload, flags = protocol.encode_file_ack(chunk_size, recv_window, t.codec, held,
+                                                          delta=comparing, group=t.joined)
+            self._send_ack(t.msg_id, t.addr, t.binary, payload, flags)
         except Exception as e:
             print(f"Erro ao enviar ACK de FILE: {e}")
+
+    def _delta_bases(self, filename: str) -> List[str]:
+        """Versões anteriores do arquivo que podem ter blocos em comum com a nova"""
+        bases = []
+        if os.path.isfile(filename):
+            bases.append(os.path.realpath(filename))
+        for path in self.store.files_named(filename):
+            if path not in bases:
+                bases.append(path)
+        return bases
+
+    def _start_delta(self, t: IncomingTransfer):
+        """Procura o conteúdo anunciado no FILE entre os arquivos já salvos aqui"""
+        stored = self.store.find_file(t.file_hash.hex())
+        if stored is not None:
+            self._start_restore(t, stored)
+        elif self._delta_bases(t.filename):
+            print(f"Comparando {t.filename} com a versão local antes de receber os blocos")
+            t.status = transfer.COMPARANDO
+            self._request_signatures(t)
+
+    def _start_restore(self, t: IncomingTransfer, stored):
+        print(f"{t.filename} já existe aqui ({stored.path}); copiando sem receber blocos")
+        t.status = transfer.COMPARANDO
+        self.loop.create_task(self._restore_identical(t, stored))
+
+    async def _restore_identical(self, t: IncomingTransfer, stored):
+        """O arquivo inteiro já está aqui: copia (se preciso) e encerra com o ACK do END"""
+        if t.receiver is not None:
+            # parcial de uma tentativa anterior, que deixou de ser necessário
+            t.chunk_size = t.receiver.chunk_size
+            t.receiver.abort()
+            t.receiver = None
+        copied = True
+        if os.path.realpath(t.filename) != stored.path:
+            copied = await self.loop.run_in_executor(None, delta.copy_file, stored.path,
+                                                     f"temp_{t.msg_id}.copy", t.filename, stored.file_hash)
+        if t.status != transfer.COMPARANDO:
+            return
+        if not copied:
+            # a cópia local mudou no meio do caminho: recebe normalmente
+            try:
+                t.receiver = self._open_receiver(t.msg_id, t.filename, t.filesize, t.chunk_size, t.file_hash)
+            except Exception as e:
+                print(f"Erro ao criar arquivo temporário: {e}")
+                t.status = transfer.FALHOU
+                self._send_nack(t.msg_id, t.addr, t.binary, "erro_de_escrita")
+                return
+            if t.receiver.resumed:
+                # ainda havia um parcial de uma tentativa anterior
+                t.status = transfer.RETOMANDO
+                self.loop.create_task(self._catch_up(t, False))
+                return
+            t.status = transfer.ATIVA
+            self._send_file_ack(t)
+            return
+        t.status = transfer.CONCLUIDA
+        self._index_saved(t.filename, stored.file_hash, stored.chunk_size, stored.digests)
+        print(f"Arquivo salvo como {t.filename}")
+        self._send_ack(t.msg_id + "_END", t.addr, t.binary)
+
+    def _request_signatures(self, t: IncomingTransfer):
+        """Pede as próximas páginas da assinatura, até SIG_WINDOW pendentes"""
+        per_page = protocol.sig_entries_per_page(t.receiver.chunk_size)
+        pages = (t.total_chunks + per_page - 1) // per_page
+        while len(t.sig_requests) < SIG_WINDOW and t.next_sig_page < pages:
+            self._send_sig_request(t, t.next_sig_page)
+            t.next_sig_page += 1
+        if len(t.signatures) == pages:
+            signatures = b"".join(t.signatures[page] for page in range(pages))
+            t.signatures.clear()
+            self.loop.create_task(self._match_blocks(t, signatures))
+
+    def _send_sig_request(self, t: IncomingTransfer, page: int, retries: int = 0):
+        self._sendto(protocol.encode(protocol.SIG, t.msg_id, page), t.addr)
+        timer = self.loop.call_later(self._rtt_for(t.addr).timeout(retries), self._on_sig_timeout, t, page)
+        t.sig_requests[page] = (timer, retries)
+
+    def _on_sig_timeout(self, t: IncomingTransfer, page: int):
+        if page not in t.sig_requests or t.status != transfer.COMPARANDO:
+            return
+        retries = t.sig_requests[page][1]
+        if retries >= MAX_RETRIES:
+            # sem assinatura, recebe o arquivo inteiro
+            print(f"Assinatura de {t.filename} não chegou; recebendo todos os blocos")
+            self._cancel_sig_requests(t)
+            t.status = transfer.ATIVA
+            self._send_file_ack(t)
+            return
+        self._send_sig_request(t, page, retries + 1)
+
+    def _cancel_sig_requests(self, t: IncomingTransfer):
+        for timer, _ in t.sig_requests.values():
+            timer.cancel()
+        t.sig_requests.clear()
+        t.signatures.clear()
+
+    def _handle_sig_page(self, msg_id: str, page: int, payload: bytes):
+        t = self.transfers.incoming.get(msg_id)
+        if t is None or t.status != transfer.COMPARANDO or page not in t.sig_requests:
+            return
+        timer, retries = t.sig_requests.pop(page)
+        timer.cancel()
+        t.signatures[page] = payload
+        self._request_signatures(t)
+
+    async def _match_blocks(self, t: IncomingTransfer, signatures: bytes):
+        """Acha os blocos nas versões locais, copia-os para o parcial e libera o remetente"""
+        receiver = t.receiver
+        try:
+            plan = await self.loop.run_in_executor(None, delta.find_blocks, signatures, receiver.chunk_size,
+                                                   t.filesize, self._delta_bases(t.filename), self.store)
+            found = await self.loop.run_in_executor(None, self._copy_blocks, receiver, plan, signatures)
+        except Exception as e:
+            print(f"Erro ao comparar {t.filename} com a versão local: {e}")
+            found = 0
+        if t.status != transfer.COMPARANDO:
+            return
+        t.status = transfer.ATIVA
+        print(f"{found} de {receiver.total_chunks} blocos de {t.filename} encontrados localmente")
+        if receiver.complete and receiver.hexdigest() == t.file_hash.hex():
+            if self.save_received_file(t.msg_id, t.filename):
+                self._send_ack(t.msg_id + "_END", t.addr, t.binary)
+                return
+        self._send_file_ack(t)
+
+    @staticmethod
+    def _copy_blocks(receiver: FileReceiver, plan: Dict[int, tuple], signatures: bytes) -> int:
+        found = 0
+        for seq, (path, offset) in sorted(plan.items()):
+            if seq in receiver:
+                continue
+            _, digest = protocol.SIG_ENTRY.unpack_from(signatures, seq * protocol.SIG_ENTRY.size)
+            length = min(receiver.chunk_size, receiver.filesize - seq * receiver.chunk_size)
+            data = delta.read_block(path, offset, length, digest)
+            if data is not None and receiver.write(seq, data, digest):
+                found += 1
+        return found
+
+    def _open_receiver(self, msg_id: str, filename: str, filesize: int, chunk_size: int,
+                       file_hash: Optional[bytes]) -> FileReceiver:
+        """Com o hash do conteúdo, o parcial é nomeado por ele e pode ser retomado depois de uma interrupção"""
+        if file_hash:
+            key = file_hash.hex()[:16]
+            try:
+                return FileReceiver(filename, filesize, chunk_size, f"temp_{key}.part",
+                                    file_hash, f"temp_{key}.state")
+            except FileExistsError:
+                # outro receptor (talvez outro dispositivo ou worker neste diretório) está com o parcial
+                pass
+        # sem retomada; os destinos de um envio em grupo têm o mesmo id, daí o sufixo
+        for attempt in range(MAX_PARTIALS):
+            suffix = f".{attempt}" if attempt else ""
+            try:
+                return FileReceiver(filename, filesize, chunk_size, f"temp_{msg_id}{suffix}.part")
+            except FileExistsError:
+                continue
+        raise FileExistsError(f"parciais temp_{msg_id}.*.part em uso")
         
-    def _handle_chunk(self, msg_id: str, chunk_parts: list, addr: tuple):
-        seq = int(chunk_parts[0])
-        b64data = chunk_parts[1]
-        if msg_id not in self.file_recv_state:
+    def _handle_chunk(self, msg_id: str, seq: int, data: bytes, addr: tuple, digest: bytes = None,
+                      compressed: bool = False):
+        t = self.transfers.incoming.get(msg_id)
+        if t is None or t.status in (transfer.FALHOU, transfer.CANCELADA, transfer.COMPARANDO,
+                                      transfer.RETOMANDO):
             return
-        state = self.file_recv_state[msg_id]
-        total = state['total_chunks']
+        total = t.total_chunks
         if seq >= total:
             return  # ignora blocos extras
+        if compressed:
+            try:
+                data = codec.decompress(t.codec, data, t.receiver.chunk_size)
+            except Exception as e:
+                log.warning("Erro ao descomprimir bloco %d do arquivo (id %s): %s", seq, msg_id, e)
+                return
+        if digest is not None and protocol.chunk_hash(data) != digest:
+            # sem ACK: o remetente retransmite o bloco como se ele tivesse se perdido
+            log.warning("Bloco %d do arquivo (id %s) corrompido; descartado", seq, msg_id)
+            return
+        self.metrics.chunk_received(msg_id, len(data))
+        receiver = t.receiver
+        if not t.committed and receiver.write(seq, data, digest):
+            log.debug("Recebido bloco %d/%d do arquivo (id %s)", seq + 1, total, msg_id)
+        else:
+            self.metrics.duplicate(addr, msg_id)
+        if t.group is not None:
+            self.fanout.on_chunk(t, seq)
+            return
+        ranges = self._sack_ranges(receiver, seq)
+        if t.binary:
+            ack_message = protocol.encode(protocol.ACK, msg_id, receiver.next_expected,
+                                          protocol.encode_sack(ranges), protocol.FLAG_CHUNK_ACK)
+        else:
+            ack_message = f"ACK {msg_id} {receiver.next_expected}"
+            if ranges:
+                ack_message += " " + ",".join(f"{a}-{b}" for a, b in ranges)
+            ack_message = ack_message.encode()
         try:
-            data = base64.b64decode(b64data)
-        except Exception:
-            print(f"Erro ao processar bloco {seq} do arquivo (id {msg_id}): Incorrect padding")
-            return
-        if seq not in state['received_chunks']:
-            state['received_chunks'][seq] = True
-            state['data_chunks'][seq] = data
-            print(f"Recebido bloco {seq+1}/{total} do arquivo (id {msg_id})")
-        ack_message = f"ACK {msg_id}"
-        try:
-            self.socket.sendto(ack_message.encode(), addr)
+            self._sendto(ack_message, addr)
         except Exception as e:
             print(f"Erro ao enviar ACK de CHUNK: {e}")
         
     def list_devices(self):
         """Lista dispositivos ativos"""
-        current_time = datetime.now()
-        active_devices = []
-        inactive_devices = []
-        
-        for device in self.known_devices.values():
-            tempo = (current_time - device.last_heartbeat).total_seconds()
-            if tempo <= 10:  
-                active_devices.append(device)
-            else:
-                inactive_devices.append(device.name)
-                
-        for device_name in inactive_devices:
-            del self.known_devices[device_name]
-            print(f"Dispositivo {device_name} removido por inatividade")
+        return self._call_in_loop(self._list_devices)
+
+    def _list_devices(self):
+        self.known_devices.expire()
+        current_time = time.monotonic()
+        active_devices = self.known_devices.values()
                 
         for dev in active_devices:
-            tempo = (current_time - dev.last_heartbeat).total_seconds()
+            tempo = dev.age(current_time)
             print(f"Nome: {dev.name} | IP: {dev.ip} | Porta: {dev.port} | Tempo desde o último heartbeat: {tempo:.1f}s")
                 
         return active_devices 
 
-    def _send_file_chunks(self):
-        state = self.file_send_state
-        if not state:
+    def _sack_ranges(self, received: FileReceiver, seq: int) -> List[Tuple[int, int]]:
+        """Monta os intervalos SACK dos blocos recebidos fora de ordem"""
+        cum = received.next_expected
+        ranges = []
+        probe = cum + 1
+        if seq > cum:
+            # o intervalo do bloco recém-recebido vai primeiro, como no SACK do TCP
+            start = seq
+            while (start - 1) in received:
+                start -= 1
+            end = seq
+            while end + 1 in received:
+                end += 1
+            ranges.append((start, end))
+            probe = end + 1
+        limit = min(received.total_chunks, cum + self.window_size * 2)
+        while len(ranges) < MAX_SACK_RANGES and probe < limit:
+            if probe in received:
+                r_start = probe
+                while probe + 1 in received:
+                    probe += 1
+                ranges.append((r_start, probe))
+            probe += 1
+        return ranges
+
+    def _handle_chunk_ack(self, msg_id: str, cum: int, ranges: List[Tuple[int, int]]):
+        """Processa ACK de bloco com confirmação cumulativa e intervalos SACK"""
+        t = self.transfers.outgoing.get(msg_id)
+        if t is None or t.source is None:
             return
-        filename = state['filename']
-        msg_id = state['msg_id']
-        target = state['target']
-        seq = 0
-        total = state['total_chunks']
+        pending = t.pending_chunks
+        acked = 0
+        newest_sent = None
+        now = self.loop.time()
+        seqs = list(range(t.acked_until, cum)) if cum > t.acked_until else []
+        seqs.extend(seq for a, b in ranges for seq in range(max(a, cum), b + 1))
+        for seq in seqs:
+            entry = self._clear_chunk(t, seq)
+            if entry:
+                acked += 1
+                if entry[1] == 0:
+                    self.metrics.chunk_acked(msg_id, now - entry[2])
+                    if newest_sent is None or entry[2] > newest_sent:
+                        newest_sent = entry[2]
+        if newest_sent is not None:
+            t.rtt.update(now - newest_sent)
+        t.cc.on_ack(acked)
+        if cum > t.acked_until:
+            t.acked_until = cum
+            t.dup_acks = 0
+        else:
+            t.dup_acks += 1
+        if ranges:
+            t.highest_sacked = max(t.highest_sacked, ranges[0][1], ranges[-1][1])
+        if t.dup_acks >= DUP_ACK_THRESHOLD and t.highest_sacked >= cum:
+            # buracos abaixo do maior bloco confirmado via SACK: retransmissão rápida,
+            # uma única vez por bloco; se ela também se perder, vale o timeout
+            t.cc.on_loss(t.acked_until, t.next_seq)
+            for seq in sorted(s for s in pending if s < t.highest_sacked):
+                if pending[seq][1] == 0:
+                    self._retransmit_chunk(t, seq)
+            t.dup_acks = 0
+        if t.acked_until >= t.total_chunks:
+            self._finish_file_chunks(t)
+        self._pump()
+
+    def _handle_bare_chunk_ack(self, t: OutgoingTransfer):
+        """ACK de bloco do receptor original ("ACK <id>", sem seq): em stop-and-wait, vale
+        para o único bloco pendente"""
+        if len(t.pending_chunks) != 1:
+            # ACK atrasado de uma cópia retransmitida, que chegou na espera
+            return
+        seq = next(iter(t.pending_chunks))
+        if t.pending_chunks[seq][1]:
+            self._wait_stray_acks(t)
+        self._handle_chunk_ack(t.msg_id, seq + 1, [])
+
+    def _wait_stray_acks(self, t: OutgoingTransfer):
+        """Cada cópia de uma mensagem retransmitida pode render um "ACK <id>" igual: o
+        próximo bloco só sai depois de um RTO, e os ACKs que chegarem até lá são descartados"""
+        t.window = 0
+        self.loop.call_later(t.rtt.timeout(0), self._end_stray_wait, t)
+
+    def _end_stray_wait(self, t: OutgoingTransfer):
+        if t.window == 0:
+            t.window = 1
+            self._pump()
+
+    def _clear_chunk(self, t: OutgoingTransfer, seq: int) -> Optional[tuple]:
+        entry = t.pending_chunks.pop(seq, None)
+        if entry:
+            entry[0].cancel()
+            self.transfers.chunks_done(t.chunk_size)
+        return entry
+
+    def _start_file_chunks(self, t: OutgoingTransfer):
+        """Mapeia o arquivo e coloca a transferência no escalonador"""
         try:
-            with open(filename, 'rb') as f:
-                while seq < total:
-                    data = f.read(CHUNK_SIZE)
-                    if not data:
-                        break
-                    b64data = base64.b64encode(data).decode()
-                    chunk_msg = f"CHUNK {msg_id} {seq} {b64data}"
-                    self.socket.sendto(chunk_msg.encode(), ('127.0.0.1', target.port))
-                    state['pending_chunks'][seq] = (chunk_msg, ('127.0.0.1', target.port), time.time())
-                    print(f"Enviando bloco {seq+1}/{total} do arquivo {os.path.basename(filename)}")
-                    acked = False
-                    for _ in range(20):
-                        if seq not in state['pending_chunks']:
-                            acked = True
-                            break
-                        time.sleep(0.1)
-                    if not acked:
-                        print(f"Timeout esperando ACK do bloco {seq}, retransmitindo...")
-                        self.socket.sendto(chunk_msg.encode(), ('127.0.0.1', target.port))
-                        state['pending_chunks'][seq] = (chunk_msg, ('127.0.0.1', target.port), time.time())
-                    seq += 1
-            print(f"Arquivo {filename} enviado com sucesso!")
-            file_hash = self._calculate_file_hash(filename)
-            end_msg = f"END {msg_id} {file_hash}"
-            self.socket.sendto(end_msg.encode(), ('127.0.0.1', target.port))
-            self.pending_acks[msg_id + '_END'] = (end_msg, ('127.0.0.1', target.port), time.time())
+            # com destino binário o hash já foi no FILE; só o texto o calcula durante o envio
+            t.source = source.FileSource(t.filename, t.chunk_size, hashing=t.file_hash is None)
         except Exception as e:
             print(f"Erro ao enviar arquivo: {e}")
+            self._close_outgoing(t, transfer.FALHOU)
+            return
+        t.status = transfer.ATIVA
+        if not t.has_chunks():
+            self._finish_file_chunks(t)
+        else:
+            self._pump()
+
+    def _pump(self):
+        """Envia blocos novos de todas as transferências, na ordem do escalonador"""
+        if self._pumping:
+            return
+        self._pumping = True
+        try:
+            self._pump_chunks()
+        finally:
+            self._pumping = False
 
-    def _calculate_file_hash(self, filename: str) -> str:
-        sha256 = hashlib.sha256()
-        with open(filename, 'rb') as f:
-            while True:
-                data = f.read(4096)
-                if not data:
-                    break
-                sha256.update(data)
-        return sha256.hexdigest()
-
-    def _handle_end(self, msg_id: str, end_parts: list, addr: tuple):
+    def _pump_chunks(self):
+        if self.pacing_timer:
+            self.pacing_timer.cancel()
+            self.pacing_timer = None
+        for t in self.transfers.schedule():
+            try:
+                seq = t.take_next_seq()
+                self._send_chunk(t, seq)
+                t.cc.on_send(t.rtt.srtt)
+                self.transfers.chunk_sent(t.chunk_size)
+                log.debug("Enviando bloco %d/%d do arquivo %s", seq + 1, t.total_chunks, t.filename)
+            except Exception as e:
+                print(f"Erro ao enviar arquivo: {e}")
+                self._close_outgoing(t, transfer.FALHOU)
+        delay = self.transfers.pacing_delay()
+        if delay is not None:
+            # há blocos prontos esperando só o pacing liberar
+            self.pacing_timer = self.loop.call_later(max(delay, 0.0005), self._pump)
+
+    def _encode_chunk(self, t: OutgoingTransfer, seq: int) -> datagram.Buffers:
+        """Monta o CHUNK a partir do arquivo mapeado; as retransmissões o remontam em vez de guardá-lo"""
+        data = t.source.chunk(seq)
+        if not t.binary:
+            return f"CHUNK {t.msg_id} {seq} {base64.b64encode(data).decode()}".encode()
+        digest = protocol.chunk_hash(data)
+        flags = protocol.FLAG_HASH
+        if t.codec:
+            # blocos que não encolhem vão crus, sem FLAG_COMPRESSED
+            level = self.compression_level if t.codec == self.compression else None
+            compressed = codec.compress(t.codec, data, level)
+            if len(compressed) < len(data):
+                data = compressed
+                flags |= protocol.FLAG_COMPRESSED
+        # cabeçalho, hash e dados saem com sendmsg, sem concatenar nem copiar o bloco
+        header = protocol.encode_header(protocol.CHUNK, t.msg_id, seq, len(digest) + len(data), flags)
+        return (header, digest, data)
+
+    def _send_chunk(self, t: OutgoingTransfer, seq: int, retries: int = 0):
+        data = self._encode_chunk(t, seq)
+        self.metrics.chunk_sent(t.msg_id, datagram.buffer_size(data))
+        self._sendto(data, t.addr)
+        timer = self.loop.call_later(t.rtt.timeout(retries), self._on_chunk_timeout, t, seq)
+        t.pending_chunks[seq] = (timer, retries, self.loop.time())
+
+    def _on_chunk_timeout(self, t: OutgoingTransfer, seq: int):
+        if seq not in t.pending_chunks:
+            return
+        retries = t.pending_chunks[seq][1]
+        if retries >= MAX_RETRIES:
+            print(f"Bloco {seq} não confirmado após {retries + 1} tentativas; abortando transferência")
+            self._close_outgoing(t, transfer.FALHOU)
+            self._send_nack(t.msg_id, t.addr, t.binary, "timeout")
+            return
+        t.cc.on_timeout(t.acked_until, t.next_seq)
+        log.debug("Timeout esperando ACK do bloco %d, retransmitindo...", seq)
+        self._retransmit_chunk(t, seq)
+
+    def _retransmit_chunk(self, t: OutgoingTransfer, seq: int):
+        timer, retries, _ = t.pending_chunks[seq]
+        timer.cancel()
+        self.metrics.retransmitted(t.addr, t.msg_id)
+        self._send_chunk(t, seq, retries + 1)
+
+    def _finish_file_chunks(self, t: OutgoingTransfer):
+        """Todos os blocos foram confirmados: envia o END"""
+        if t.file_hash is None:
+            # o hash foi calculado durante a passada de envio; só falta o que não passou por ela
+            t.file_hash = t.source.hexdigest()
+        t.source.close()
+        t.source = None
+        t.repair.clear()
+        t.status = transfer.FINALIZANDO
+        print(f"Arquivo {t.filename} enviado com sucesso!")
+        self._send_file_end(t)
+
+    def _send_file_end(self, t: OutgoingTransfer):
+        if t.binary:
+            end_msg = protocol.encode(protocol.END, t.msg_id, payload=bytes.fromhex(t.file_hash))
+        else:
+            end_msg = f"END {t.msg_id} {t.file_hash}".encode()
+        self._send_reliable(t.msg_id + '_END', end_msg, t.addr)
+
+    def _close_outgoing(self, t: OutgoingTransfer, status: str):
+        """Encerra um envio: cancela timers, fecha o arquivo e libera a vaga no gerenciador"""
+        for key in (t.msg_id, t.msg_id + '_END'):
+            self._clear_pending_ack(key)
+        for entry in t.pending_chunks.values():
+            entry[0].cancel()
+        self._stop_delta_wait(t)
+        t.signatures = None
+        promoted = self.transfers.release(t, status)
+        t.pending_chunks.clear()
+        if t.source is not None:
+            t.source.close()
+            t.source = None
+        if not self.running:
+            return
+        for next_transfer in promoted:
+            try:
+                self._send_file_request(next_transfer)
+            except Exception as e:
+                print(f"Erro ao enviar FILE: {e}")
+                self._close_outgoing(next_transfer, transfer.FALHOU)
+        self._pump()
+
+    def _handle_end(self, msg_id: str, received_hash: str, addr: tuple):
         """Processa mensagem END recebida, verifica integridade e responde com ACK ou NACK"""
-        received_hash = end_parts[0]
-        if msg_id not in self.file_recv_state:
+        t = self.transfers.incoming.get(msg_id)
+        if t is None or t.status in (transfer.FALHOU, transfer.CANCELADA):
             print(f"Arquivo com id {msg_id} não encontrado para verificação de hash.")
             return
-        state = self.file_recv_state[msg_id]
-        temp_filename = f"temp_{msg_id}.bin"
-        self.save_received_file(msg_id, temp_filename)
-        local_hash = self._calculate_file_hash(temp_filename)
+        if t.committed:
+            # o ACK anterior se perdeu e o remetente retransmitiu o END
+            self._send_ack(msg_id + "_END", addr, t.binary)
+            return
+        receiver = t.receiver
+        local_hash = receiver.hexdigest() if receiver.complete else None
         if local_hash == received_hash:
             print(f"Arquivo recebido com sucesso e verificado! Hash: {local_hash}")
             # Salvamento automático com nome original
-            final_filename = state['filename']
-            self.save_received_file(msg_id, final_filename)
-            print(f"Arquivo salvo automaticamente como {final_filename}")
-            ack_message = f"ACK {msg_id}_END"
-            self.socket.sendto(ack_message.encode(), addr)
+            if self.save_received_file(msg_id, t.filename):
+                print(f"Arquivo salvo automaticamente como {t.filename}")
+                self._send_ack(msg_id + "_END", addr, t.binary)
+            else:
+                # o remetente não pode dar o envio por concluído se o arquivo não foi salvo
+                self.fanout.release(t)
+                receiver.abort()
+                t.status = transfer.FALHOU
+                self._send_nack(msg_id + "_END", addr, t.binary, "erro_de_escrita")
         else:
+            if receiver.resumable:
+                # blocos corrompidos no disco ou perdidos: pede só esses, sem recomeçar
+                bad = receiver.verify()
+                missing = receiver.missing_ranges(MAX_RESUME_RANGES)
+                if missing:
+                    print(f"Arquivo incompleto ({bad} blocos corrompidos); pedindo reparo dos blocos faltantes")
+                    self._send_nack(msg_id + "_END", addr, t.binary, "reparar " + protocol.format_ranges(missing))
+                    return
             print(f"Arquivo corrompido! Hash esperado: {received_hash}, hash calculado: {local_hash}")
-            nack_message = f"NACK {msg_id}_END hash_invalido"
-            self.socket.sendto(nack_message.encode(), addr)
-        try:
-            os.remove(temp_filename)
-        except Exception:
-            pass
+            self.fanout.release(t)
+            receiver.abort()
+            t.status = transfer.FALHOU
+            self._send_nack(msg_id + "_END", addr, t.binary, "hash_invalido")
+
+    def _send_nack(self, msg_id: str, addr: tuple, binary: bool, reason: str):
+        if binary:
+            nack_message = protocol.encode(protocol.NACK, msg_id, payload=reason.encode())
+        else:
+            nack_message = f"NACK {msg_id} {reason}".encode()
+        self.metrics.nack_sent(addr, msg_id[:-4] if msg_id.endswith('_END') else msg_id)
+        self._sendto(nack_message, addr)
+
+    def _handle_nack(self, msg_id: str, reason: str, addr: tuple):
+        print(f"Recebido NACK para {msg_id}: {reason}")
+        base_id = msg_id[:-4] if msg_id.endswith('_END') else msg_id
+        self.metrics.nack_received(addr, base_id)
+        if self.fanout.handle_nack(msg_id, reason, addr):
+            return
+        self._clear_pending_ack(msg_id)
+        t = self.transfers.outgoing.get(base_id)
+        if t and msg_id.endswith('_END') and reason.startswith("reparar"):
+            if t.status == transfer.FINALIZANDO:
+                self._repair_outgoing(t, protocol.parse_ranges(reason[len("reparar"):].strip()))
+            return
+        if t and t.status not in transfer.FINAL_STATES:
+            if msg_id.endswith('_END'):
+                print("Transferência de arquivo falhou por integridade!")
+            self._close_outgoing(t, transfer.CANCELADA if reason == "cancelado" else transfer.FALHOU)
+            return
+        t = self.transfers.incoming.get(msg_id)
+        if t and t.status in (transfer.ATIVA, transfer.COMPARANDO, transfer.RETOMANDO):
+            # o remetente desistiu da transferência; se não foi cancelamento,
+            # o parcial fica no disco para uma nova tentativa retomar
+            self._cancel_sig_requests(t)
+            self.fanout.release(t)
+            if t.receiver is None:
+                t.status = transfer.CANCELADA if reason == "cancelado" else transfer.FALHOU
+            elif reason == "cancelado":
+                t.receiver.abort()
+                t.status = transfer.CANCELADA
+            else:
+                t.receiver.close()
+                t.status = transfer.FALHOU
 
-    def _handle_nack(self, msg_id: str, nack_parts: list, addr: tuple):
-        print(f"Recebido NACK para {msg_id}: {' '.join(nack_parts)}")
-        if self.file_send_state and msg_id == self.file_send_state['msg_id'] + '_END':
-            print("Transferência de arquivo falhou por integridade!")
-            self.file_send_state = None
+    def _repair_outgoing(self, t: OutgoingTransfer, ranges: List[Tuple[int, int]]):
+        """O receptor perdeu ou descartou blocos depois do END: reenvia só esses"""
+        seqs = [seq for a, b in ranges for seq in range(a, min(b, t.total_chunks - 1) + 1)]
+        if not seqs:
+            return
+        try:
+            t.source = source.FileSource(t.filename, t.chunk_size, hashing=False)
+        except Exception as e:
+            print(f"Erro ao reenviar blocos: {e}")
+            self._close_outgoing(t, transfer.FALHOU)
+            return
+        print(f"Reenviando {len(seqs)} blocos pedidos pelo destino")
+        self.metrics.retransmitted(t.addr, t.msg_id, len(seqs))
+        t.repair.extend(seqs)
+        t.acked_until = min(t.acked_until, seqs[0])
+        t.highest_sacked = -1
+        t.dup_acks = 0
+        t.status = transfer.ATIVA
+        self._pump()
 
     def save_received_file(self, msg_id: str, dest_filename: str) -> bool:
-        """Salva o arquivo recebido em disco a partir dos blocos armazenados"""
-        if msg_id not in self.file_recv_state:
+        """Move o arquivo recebido (já gravado bloco a bloco) para o nome final"""
+        t = self.transfers.incoming.get(msg_id)
+        if t is None or t.status != transfer.ATIVA:
             print(f"Arquivo com id {msg_id} não encontrado.")
             return False
-        state = self.file_recv_state[msg_id]
-        data_chunks = state['data_chunks']
-        if not data_chunks:
-            print(f"Nenhum bloco recebido para o arquivo {msg_id}.")
-            return False
         try:
-            with open(dest_filename, 'wb') as f:
-                for seq in sorted(data_chunks.keys()):
-                    f.write(data_chunks[seq])
+            file_hash = t.receiver.hexdigest()
+            digests = t.receiver.block_digests()
+            t.receiver.commit(dest_filename)
+            t.status = transfer.CONCLUIDA
+            self.fanout.release(t)
             print(f"Arquivo salvo como {dest_filename}")
+            if digests is not None:
+                self._index_saved(dest_filename, file_hash, t.receiver.chunk_size, digests)
             return True
         except Exception as e:
             print(f"Erro ao salvar arquivo: {e}")
-            return False 
\ No newline at end of file
+            return False
+
+    def _index_saved(self, filename: str, file_hash: str, chunk_size: int, digests: bytes):
+        """Registra o arquivo salvo no store, para que envios futuros do mesmo conteúdo sejam evitados"""
+        if self.store is None:
+            return
+        try:
+            self.store.add(filename, file_hash, chunk_size, digests)
+        except OSError as e:
+            print(f"Erro ao indexar {filename}: {e}") 
\ No newline at end of file
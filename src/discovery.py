@@ -0,0 +1,211 @@
+import asyncio
+import random
+import socket
+import struct
+import time
+from typing import List, Optional
+
+import protocol
+from membership import DEVICE_TIMEOUT
+
+MULTICAST_GROUP = "239.255.42.99"
+MULTICAST_PORT = 5999
+GOSSIP_INTERVAL = 1.0
+GOSSIP_FANOUT = 3
+# HEARTBEAT em texto, mantido para peers que não falam gossip
+HEARTBEAT_INTERVAL = 5.0
+ANNOUNCE_INTERVAL = 30.0
+# o intervalo dos anúncios multicast cresce com o grupo para manter constante
+# o total de anúncios que cada nó recebe
+ANNOUNCE_GROUP_SIZE = 16
+JITTER = 0.2
+SEEDS = [("127.0.0.1", 5000)]
+
+
+def jittered(interval: float) -> float:
+    return interval * random.uniform(1 - JITTER, 1 + JITTER)
+
+
+class _MulticastProtocol(asyncio.DatagramProtocol):
+    """Entrega ao dispositivo os anúncios recebidos pelo grupo multicast"""
+
+    def __init__(self, device):
+        self.device = device
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        self.device._handle_message(data, addr)
+
+
+class Discovery:
+    """Descoberta de dispositivos por anúncios multicast e gossip de digests.
+
+    Cada nó anuncia sua presença no grupo multicast (HEARTBEAT em texto) ao
+    iniciar e, depois, em intervalos longos. A vivacidade se propaga por
+    gossip no estilo Scuttlebutt: a cada rodada o nó incrementa seu contador
+    de heartbeat e envia a `fanout` peers sorteados um digest com
+    (nome, contador) de cada membro; o outro lado responde só com as entradas
+    mais novas que ele tem e pede as que lhe faltam. Com isso o número de
+    pacotes por nó e por rodada não depende do tamanho do grupo.
+    """
+
+    def __init__(self, device, interval: float = GOSSIP_INTERVAL, fanout: int = GOSSIP_FANOUT,
+                 multicast_group: Optional[str] = MULTICAST_GROUP, multicast_port: int = MULTICAST_PORT,
+                 seeds: Optional[List[tuple]] = None, device_timeout: float = DEVICE_TIMEOUT):
+        self.device = device
+        self.interval = interval
+        self.fanout = fanout
+        self.multicast_group = multicast_group
+        self.multicast_port = multicast_port
+        self.seeds = SEEDS if seeds is None else seeds
+        self.device_timeout = device_timeout
+        # o contador começa no relógio em ms, então um nó reiniciado nunca volta atrás
+        self.heartbeat = time.time_ns() // 1_000_000
+        self.multicast_transport: Optional[asyncio.DatagramTransport] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.next_legacy_heartbeat = 0.0
+        self.next_announce = 0.0
+
+    async def start(self):
+        """Entra no grupo multicast (se possível) e começa as rodadas de gossip"""
+        if self.multicast_group:
+            try:
+                sock = self._multicast_socket()
+                self.multicast_transport, _ = await self.device.loop.create_datagram_endpoint(
+                    lambda: _MulticastProtocol(self.device), sock=sock)
+                self.device.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+                self.device.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            except OSError as e:
+                print(f"Multicast indisponível ({e}); usando apenas os seeds")
+                self.multicast_group = None
+        self._tick()
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+        if self.multicast_transport:
+            self.multicast_transport.close()
+
+    def _multicast_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        # vários dispositivos na mesma máquina escutam a mesma porta do grupo
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', self.multicast_port))
+        mreq = struct.pack("4s4s", socket.inet_aton(self.multicast_group), socket.inet_aton("0.0.0.0"))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        sock.setblocking(False)
+        return sock
+
+    def _heartbeat_message(self) -> bytes:
+        # HEARTBEAT continua em texto para ser entendido por peers antigos;
+        # o campo extra anuncia a versão do formato binário suportada
+        return f"HEARTBEAT {self.device.name} v{protocol.PROTOCOL_VERSION}".encode()
+
+    def _tick(self):
+        """Uma rodada: gossip com peers sorteados, HEARTBEAT para peers antigos e anúncio periódico"""
+        device = self.device
+        if not device.running:
+            return
+        self.heartbeat += 1
+        now = device.loop.time()
+        try:
+            peers = [d for d in device.known_devices.values() if d.protocol_version]
+            for peer in random.sample(peers, min(self.fanout, len(peers))):
+                self.send_syn((peer.ip, peer.port))
+
+            if now >= self.next_legacy_heartbeat:
+                self.next_legacy_heartbeat = now + jittered(HEARTBEAT_INTERVAL)
+                message = self._heartbeat_message()
+                for peer in device.known_devices.values():
+                    if not peer.protocol_version:
+                        device._sendto(message, (peer.ip, peer.port))
+                if not device.known_devices:
+                    for seed in self.seeds:
+                        if seed[1] != device.port:
+                            device._sendto(message, seed)
+
+            if now >= self.next_announce:
+                group_size = len(device.known_devices) + 1
+                self.next_announce = now + jittered(ANNOUNCE_INTERVAL * max(1, group_size / ANNOUNCE_GROUP_SIZE))
+                self.announce()
+        except Exception as e:
+            print(f"Erro ao enviar HEARTBEAT: {e}")
+        self.timer = device.loop.call_later(jittered(self.interval), self._tick)
+
+    def announce(self):
+        """Anuncia o dispositivo no grupo multicast"""
+        if self.multicast_group:
+            self.device._sendto(self._heartbeat_message(), (self.multicast_group, self.multicast_port))
+
+    def _own_entry(self) -> tuple:
+        # sem ip nem porta: quem recebe usa o endereço de origem do datagrama, que é o
+        # que ele enxerga mesmo atrás de NAT (a porta local pode não ser alcançável)
+        return (self.device.name, None, 0, protocol.PROTOCOL_VERSION, self.heartbeat, 0)
+
+    def _entry(self, info, now: float) -> tuple:
+        age_ms = int(info.age(now) * 1000)
+        return (info.name, info.ip, info.port, info.protocol_version, info.heartbeat, max(age_ms, 0))
+
+    def on_new_device(self, info):
+        """Responde a um recém-chegado com um digest, com probabilidade fanout/N,
+        para que ele aprenda o grupo sem que todos os nós respondam ao mesmo tempo"""
+        if info.protocol_version and random.random() < self.fanout / max(1, len(self.device.known_devices)):
+            self.send_syn((info.ip, info.port))
+
+    def send_syn(self, addr: tuple):
+        digest = [(self.device.name, self.heartbeat)]
+        digest.extend((d.name, d.heartbeat) for d in self.device.known_devices.values() if d.protocol_version)
+        self.device._sendto(protocol.encode(protocol.GOSSIP_SYN, "", payload=protocol.encode_digest(digest)), addr)
+
+    def handle_syn(self, payload: bytes, addr: tuple):
+        digest = protocol.decode_digest(payload)
+        if not digest:
+            return
+        # a primeira entrada do digest é o próprio remetente
+        sender_name, sender_heartbeat = digest[0]
+        self._merge(sender_name, addr[0], addr[1], protocol.PROTOCOL_VERSION, sender_heartbeat, 0)
+        remote = dict(digest)
+        known = self.device.known_devices
+        requests = [name for name, heartbeat in digest[1:]
+                    if name != self.device.name and (name not in known or known[name].heartbeat < heartbeat)]
+        now = time.monotonic()
+        entries = [self._entry(d, now) for d in self.device.known_devices.values()
+                   if d.protocol_version and d.name != sender_name and remote.get(d.name, -1) < d.heartbeat]
+        if remote.get(self.device.name, -1) < self.heartbeat:
+            entries.insert(0, self._own_entry())
+        if entries or requests:
+            payload = protocol.encode_members(entries, requests)
+            self.device._sendto(protocol.encode(protocol.GOSSIP_ACK, "", payload=payload), addr)
+
+    def handle_ack(self, payload: bytes, addr: tuple):
+        entries, requests = protocol.decode_members(payload)
+        self._merge_all(entries, addr)
+        if requests:
+            now = time.monotonic()
+            known = self.device.known_devices
+            reply = [self._entry(known[name], now) for name in requests if name in known]
+            if self.device.name in requests:
+                reply.insert(0, self._own_entry())
+            if reply:
+                payload = protocol.encode_members(reply)
+                self.device._sendto(protocol.encode(protocol.GOSSIP_ACK2, "", payload=payload), addr)
+
+    def handle_ack2(self, payload: bytes, addr: tuple):
+        entries, _ = protocol.decode_members(payload)
+        self._merge_all(entries, addr)
+
+    def _merge_all(self, entries: List[tuple], addr: tuple):
+        for name, ip, port, version, heartbeat, age_ms in entries:
+            # ip e porta ausentes: a entrada descreve o próprio remetente
+            self._merge(name, ip or addr[0], port or addr[1], version, heartbeat, age_ms)
+
+    def _merge(self, name: str, ip: str, port: int, version: int, heartbeat: int, age_ms: int):
+        """Aceita a entrada se ela for mais nova que a conhecida e ainda não tiver expirado"""
+        if name == self.device.name or age_ms / 1000 >= self.device_timeout:
+            return
+        known = self.device.known_devices.get(name)
+        if known and known.heartbeat >= heartbeat:
+            return
+        self.device.known_devices.update(name, ip, port, version, heartbeat, time.monotonic() - age_ms / 1000)
+
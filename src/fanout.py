@@ -0,0 +1,620 @@
+import logging
+import os
+import socket
+import struct
+from typing import Dict, List, Optional, Tuple
+
+import codec
+import datagram
+import protocol
+import source
+import transfer
+from congestion import INITIAL_RTO, MAX_RETRIES
+from transfer import GroupMember, GroupTransfer, IncomingTransfer
+
+log = logging.getLogger(__name__)
+
+# Porta dos grupos multicast de envio para vários destinos; o grupo de cada envio
+# é 239.255.43.x, com x tirado do id da transferência
+FANOUT_PORT = 5998
+GROUP_PREFIX = "239.255.43."
+# O receptor relata o que falta a cada REPORT_CHUNKS blocos, ao ver um buraco novo ou
+# REPORT_DELAY depois do último bloco
+REPORT_CHUNKS = 8
+REPORT_DELAY = 0.005
+MAX_REPORT_RANGES = 64
+# Destino sem relatório por esse tempo deixa de segurar a janela dos demais
+MEMBER_SILENCE = 2.0
+
+
+def group_address(msg_id: str, port: int = FANOUT_PORT) -> Tuple[str, int]:
+    return GROUP_PREFIX + str(int(msg_id, 16) & 0xFF), port
+
+
+class FanOut:
+    """Envio de um arquivo para vários dispositivos de uma vez.
+
+    Todos os destinos recebem a mesma transferência (mesmo id, tamanho de
+    bloco e codec), então cada bloco é lido do mapeamento e montado uma
+    única vez. Os blocos novos vão em um só datagrama para o grupo multicast
+    da transferência e, por unicast, só para quem não conseguiu entrar nele.
+    Em vez de um ACK por bloco, cada receptor manda de tempos em tempos um
+    relatório (NACK com FLAG_CHUNK_ACK) com o próximo bloco esperado e os
+    intervalos que faltam; os pedidos de todos os destinos entram em uma
+    única fila de reparo, em que cada bloco aparece uma vez, e o reparo sai
+    pelo grupo quando mais de um destino o pediu. O fim segue o caminho do
+    envio individual: END por destino e "reparar" para o que ainda faltar.
+
+    Do lado do receptor, cuida do socket do grupo e dos relatórios.
+    """
+
+    def __init__(self, device, port: Optional[int] = FANOUT_PORT):
+        self.device = device
+        # None: os envios em grupo usam só unicast e este lado nunca entra em grupos
+        self.port = port
+        self.groups: Dict[str, GroupTransfer] = {}
+        # porta -> socket que escuta os grupos; (grupo, porta) -> transferências que o usam
+        self.endpoints: Dict[int, datagram.DatagramEndpoint] = {}
+        self.memberships: Dict[tuple, int] = {}
+        self.multicast_ready = False
+
+    def stop(self):
+        for g in self.groups.values():
+            if g.status not in transfer.FINAL_STATES:
+                self._close(g, transfer.CANCELADA)
+        for endpoint in self.endpoints.values():
+            endpoint.close()
+            endpoint.sock.close()
+        self.endpoints.clear()
+        self.memberships.clear()
+
+    # --- remetente ---
+
+    def send(self, target_names: List[str], filename: str) -> bool:
+        device = self.device
+        if not os.path.isfile(filename):
+            print(f"Arquivo '{filename}' não encontrado")
+            return False
+        ok = True
+        members: Dict[tuple, GroupMember] = {}
+        for name in dict.fromkeys(target_names):
+            info = device.known_devices.get(name)
+            if info is None:
+                print(f"Dispositivo {name} não encontrado")
+                ok = False
+            elif not info.protocol_version:
+                # peers antigos não entendem o envio em grupo: recebem um envio individual
+                ok = device._send_file(name, filename) and ok
+            else:
+                addr = (info.ip, info.port)
+                members[addr] = GroupMember(name, addr, device._rtt_for(addr))
+        if len(members) < 2:
+            for m in members.values():
+                ok = device._send_file(m.name, filename) and ok
+            return ok
+        msg_id = protocol.new_transfer_id(*device.shard)
+        group = group_address(msg_id, self.port) if self.port and self._enable_multicast() else None
+        g = GroupTransfer(
+            msg_id=msg_id,
+            filename=filename,
+            filesize=os.path.getsize(filename),
+            # o mesmo bloco serve para todos: o menor que cabe em todos os caminhos
+            chunk_size=min([device.max_chunk_size] + [protocol.max_chunk_size(addr) for addr in members]),
+            members=members,
+            group=group
+        )
+        self.groups[msg_id] = g
+        device.loop.create_task(self._prepare(g))
+        print(f"Envio de {os.path.basename(filename)} para {len(members)} dispositivos (id {msg_id})")
+        return ok
+
+    def _enable_multicast(self) -> bool:
+        if not self.multicast_ready:
+            try:
+                self.device.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+                self.device.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+                self.multicast_ready = True
+            except OSError as e:
+                print(f"Multicast indisponível ({e}); envios em grupo usarão unicast")
+        return self.multicast_ready
+
+    async def _prepare(self, g: GroupTransfer):
+        """Hash e teste de compressão fora do loop, depois o FILE para cada destino"""
+        device = self.device
+        try:
+            offered = await device.loop.run_in_executor(None, codec.offer, g.filename,
+                                                        device.compression, device.compression_level)
+            g.file_hash = await device.loop.run_in_executor(None, source.file_hash, g.filename)
+        except Exception as e:
+            print(f"Erro ao enviar FILE: {e}")
+            self._close(g, transfer.FALHOU)
+            return
+        # o bloco é comprimido uma vez para todos, então o codec não pode variar por
+        # destino: só zlib, que todo receptor binário sabe descomprimir
+        g.codecs = [codec.ZLIB] if offered else []
+        g.codec = g.codecs[0] if g.codecs else codec.STORED
+        if g.status != transfer.AGUARDANDO:
+            return
+        for m in g.members.values():
+            self._send_file_request(g, m)
+
+    def _send_file_request(self, g: GroupTransfer, m: GroupMember):
+        payload, flags = protocol.encode_file_info(os.path.basename(g.filename), g.filesize, g.chunk_size,
+                                                   bytes.fromhex(g.file_hash), g.codecs,
+                                                   group=g.group or protocol.NO_GROUP)
+        self._send_member(g, m, protocol.encode(protocol.FILE, g.msg_id, payload=payload, flags=flags))
+
+    def _send_end(self, g: GroupTransfer, m: GroupMember):
+        if m.status != transfer.FINALIZANDO:
+            m.status = transfer.FINALIZANDO
+            m.retries = 0
+        self._send_member(g, m, protocol.encode(protocol.END, g.msg_id, payload=bytes.fromhex(g.file_hash)))
+
+    def _send_member(self, g: GroupTransfer, m: GroupMember, message: bytes):
+        """FILE e END são confiáveis por destino, com o mesmo backoff das demais mensagens"""
+        loop = self.device.loop
+        self.device._sendto(message, m.addr)
+        if m.timer:
+            m.timer.cancel()
+        m.timer = loop.call_later(m.rtt.timeout(m.retries), self._on_member_timeout, g, m)
+        m.sent_at = loop.time()
+
+    def _on_member_timeout(self, g: GroupTransfer, m: GroupMember):
+        m.timer = None
+        if m.status not in (transfer.AGUARDANDO, transfer.FINALIZANDO):
+            return
+        if m.retries >= MAX_RETRIES:
+            print(f"{m.name} não responde; envio {g.msg_id} segue sem ele")
+            self._finish_member(g, m, transfer.FALHOU)
+            return
+        m.retries += 1
+        if m.status == transfer.AGUARDANDO:
+            self._send_file_request(g, m)
+        else:
+            self._send_end(g, m)
+
+    def handle_ack(self, msg_id: str, payload: bytes, flags: int, addr: tuple) -> bool:
+        """ACK do FILE ou do END de um destino; False se o id não é de um envio em grupo"""
+        is_end = msg_id.endswith("_END")
+        g = self.groups.get(msg_id[:-4] if is_end else msg_id)
+        if g is None:
+            return False
+        m = g.members.get(addr)
+        if m is None or m.status in transfer.FINAL_STATES:
+            return True
+        now = self.device.loop.time()
+        if is_end:
+            if m.status == transfer.FINALIZANDO and m.retries == 0:
+                m.rtt.update(now - m.sent_at)
+            # também chega com o destino ainda em AGUARDANDO, se ele já tinha o arquivo inteiro
+            print(f"{m.name} recebeu {os.path.basename(g.filename)}")
+            self._finish_member(g, m, transfer.CONCLUIDA)
+            return True
+        if m.status != transfer.AGUARDANDO or not payload:
+            return True
+        if m.retries == 0:
+            m.rtt.update(now - m.sent_at)
+        if m.timer:
+            m.timer.cancel()
+            m.timer = None
+        m.retries = 0
+        chunk_size, recv_window, chosen, held = protocol.decode_file_ack(payload, flags)
+        if 0 < chunk_size < g.chunk_size or chosen != g.codec:
+            # o destino não aceita o bloco ou o codec do grupo; o parcial dele fica no
+            # disco e o envio individual o retoma
+            print(f"{m.name} vai receber {os.path.basename(g.filename)} em um envio individual")
+            self._finish_member(g, m, transfer.CANCELADA)
+            self.device._send_nack(g.msg_id, addr, True, "envio_individual")
+            self.device._send_file(m.name, g.filename)
+            return True
+        m.window = max(1, min(self.device.window_size, recv_window // g.chunk_size))
+        m.joined = bool(flags & protocol.FLAG_GROUP) and g.group is not None
+        for a, b in held:
+            m.held.update(range(a, b + 1))
+        while m.cum in m.held:
+            m.cum += 1
+        m.status = transfer.ATIVA
+        m.last_report = now
+        if g.status == transfer.AGUARDANDO:
+            self._start(g)
+        return True
+
+    def _start(self, g: GroupTransfer):
+        """Começa os blocos quando todos os destinos responderam (ou desistiram) ao FILE"""
+        if any(m.status == transfer.AGUARDANDO for m in g.members.values()):
+            return
+        if not any(m.status == transfer.ATIVA for m in g.members.values()):
+            self._check_done(g)
+            return
+        try:
+            g.source = source.FileSource(g.filename, g.chunk_size, hashing=False)
+        except Exception as e:
+            print(f"Erro ao enviar arquivo: {e}")
+            self._abort(g, transfer.FALHOU, "erro_de_leitura")
+            return
+        g.status = transfer.ATIVA
+        self._pump(g)
+
+    def handle_report(self, msg_id: str, cum: int, missing: List[Tuple[int, int]], addr: tuple):
+        """Relatório de um destino: avança o cumulativo dele e enfileira os reparos"""
+        g = self.groups.get(msg_id)
+        m = g.members.get(addr) if g else None
+        if m is None or m.status != transfer.ATIVA:
+            return
+        self.device.metrics.nack_received(addr, msg_id)
+        now = self.device.loop.time()
+        floor = self._floor(g, now)
+        m.last_report = now
+        m.cum = max(m.cum, cum)
+        since = now - self._holdoff(m)
+        lost = False
+        for a, b in missing:
+            for seq in range(max(a, m.cum), min(b, g.next_seq - 1) + 1):
+                lost = self._queue_repair(g, m, seq, since) or lost
+        new_floor = self._floor(g, now)
+        g.cc.on_ack(new_floor - floor)
+        if lost:
+            g.cc.on_loss(floor, g.next_seq)
+        if new_floor > floor:
+            for seq in [seq for seq in g.repaired if seq < new_floor]:
+                del g.repaired[seq]
+        if m.cum >= g.total_chunks:
+            self._send_end(g, m)
+        self._pump(g)
+
+    @staticmethod
+    def _holdoff(m: GroupMember) -> float:
+        # um reparo mais recente que isso ainda pode estar a caminho do destino
+        return (m.rtt.srtt or 0.0) + REPORT_DELAY
+
+    @staticmethod
+    def _queue_repair(g: GroupTransfer, m: GroupMember, seq: int, since: float) -> bool:
+        """Enfileira o reparo de seq para m; True se o bloco entrou agora na fila"""
+        last = g.repaired.get(seq)
+        if last is not None and last[0] > since and m.addr in last[1]:
+            return False
+        requesters = g.repair_for.get(seq)
+        if requesters is not None:
+            requesters.add(m.addr)
+            return False
+        g.repair_for[seq] = {m.addr}
+        g.repair.append(seq)
+        return True
+
+    def handle_nack(self, msg_id: str, reason: str, addr: tuple) -> bool:
+        """NACK de um destino: pedido de reparo depois do END ou desistência"""
+        is_end = msg_id.endswith("_END")
+        g = self.groups.get(msg_id[:-4] if is_end else msg_id)
+        if g is None:
+            return False
+        m = g.members.get(addr)
+        if m is None or m.status in transfer.FINAL_STATES:
+            return True
+        if is_end and reason.startswith("reparar"):
+            if m.status == transfer.FINALIZANDO and g.source is not None:
+                ranges = protocol.parse_ranges(reason[len("reparar"):].strip())
+                if m.timer:
+                    m.timer.cancel()
+                    m.timer = None
+                m.status = transfer.ATIVA
+                now = self.device.loop.time()
+                m.last_report = now
+                if ranges:
+                    m.cum = min(m.cum, ranges[0][0])
+                since = now - self._holdoff(m)
+                for a, b in ranges:
+                    for seq in range(a, min(b, g.total_chunks - 1) + 1):
+                        self._queue_repair(g, m, seq, since)
+                print(f"Reenviando blocos pedidos por {m.name}")
+                self._pump(g)
+            return True
+        if is_end:
+            print(f"Transferência de arquivo para {m.name} falhou por integridade!")
+        self._finish_member(g, m, transfer.CANCELADA if reason == "cancelado" else transfer.FALHOU)
+        return True
+
+    def _floor(self, g: GroupTransfer, now: float) -> int:
+        """Menor cumulativo entre os destinos que estão relatando: a base da janela do grupo"""
+        active = [m for m in g.members.values() if m.status == transfer.ATIVA]
+        live = [m for m in active if now - m.last_report < MEMBER_SILENCE] or active
+        return min((m.cum for m in live), default=g.next_seq)
+
+    def _window(self, g: GroupTransfer, now: float) -> int:
+        active = [m for m in g.members.values() if m.status == transfer.ATIVA]
+        live = [m for m in active if now - m.last_report < MEMBER_SILENCE] or active
+        window = min((m.window for m in live), default=1)
+        return min(window, max(1, int(g.cc.cwnd)))
+
+    @staticmethod
+    def _srtt(g: GroupTransfer) -> Optional[float]:
+        # o pacing segue o destino mais distante
+        samples = [m.rtt.srtt for m in g.members.values()
+                   if m.status == transfer.ATIVA and m.rtt.srtt is not None]
+        return max(samples) if samples else None
+
+    def _pump(self, g: GroupTransfer):
+        """Envia reparos e blocos novos enquanto a janela do grupo e o pacing permitem"""
+        loop = self.device.loop
+        if g.pacing_timer:
+            g.pacing_timer.cancel()
+            g.pacing_timer = None
+        if g.status != transfer.ATIVA:
+            return
+        now = loop.time()
+        self._check_silent(g, now)
+        srtt = self._srtt(g)
+        limit = self._floor(g, now) + self._window(g, now)
+        while True:
+            if not g.repair and (g.next_seq >= g.total_chunks or g.next_seq >= limit):
+                break
+            delay = g.cc.pacing_delay(srtt)
+            if delay > 0:
+                g.pacing_timer = loop.call_later(max(delay, 0.0005), self._pump, g)
+                return
+            if g.repair:
+                seq = g.repair.popleft()
+                targets = [g.members[addr] for addr in g.repair_for.pop(seq, ())
+                           if g.members[addr].status == transfer.ATIVA]
+                # o reparo só vai pelo grupo se mais de um destino do grupo o pediu
+                use_group = sum(1 for m in targets if m.joined) > 1
+                if targets:
+                    g.repaired[seq] = (now, {m.addr for m in targets})
+                    for m in targets:
+                        self.device.metrics.retransmitted(m.addr)
+                    self.device.metrics.retransmitted(None, g.msg_id)
+            else:
+                seq = g.next_seq
+                g.next_seq += 1
+                targets = [m for m in g.members.values() if m.status == transfer.ATIVA and seq not in m.held]
+                use_group = True
+                if targets:
+                    log.debug("Enviando bloco %d/%d do arquivo %s para %d destinos", seq + 1, g.total_chunks,
+                              g.filename, len(targets))
+            if not targets:
+                continue
+            try:
+                self._send_chunk(g, seq, targets, use_group)
+            except Exception as e:
+                print(f"Erro ao enviar arquivo: {e}")
+                self._abort(g, transfer.FALHOU, "erro_de_leitura")
+                return
+            g.cc.on_send(srtt)
+        self._arm_probe(g, now)
+
+    def _arm_probe(self, g: GroupTransfer, now: float):
+        """(Re)arma a sonda a partir do último avanço da base da janela"""
+        floor = self._floor(g, now)
+        if g.probe_timer is not None:
+            if g.probe_floor == floor:
+                return
+            g.probe_timer.cancel()
+        active = [m for m in g.members.values() if m.status == transfer.ATIVA]
+        if not active:
+            g.probe_timer = None
+            return
+        # destinos sem medida de RTT (FILE retransmitido) ficam com o RTO inicial, longo demais aqui
+        wait = max((m.rtt.rto for m in active if m.rtt.samples), default=INITIAL_RTO) + REPORT_DELAY
+        g.probe_timer = self.device.loop.call_later(wait, self._on_probe, g, floor)
+        g.probe_floor = floor
+
+    def _send_chunk(self, g: GroupTransfer, seq: int, targets: List[GroupMember], use_group: bool):
+        data = self.device._encode_chunk(g, seq)
+        size = datagram.buffer_size(data)
+        unicast = targets
+        if use_group and g.group is not None and any(m.joined for m in targets):
+            if self._send_group(g, data):
+                unicast = [m for m in targets if not m.joined]
+                self.device.metrics.sent(g.group, size)
+            g.datagrams += 1
+            self.device.metrics.chunk_sent(g.msg_id, size)
+        for m in unicast:
+            self.device._sendto(data, m.addr)
+            self.device.metrics.chunk_sent(g.msg_id, size)
+        g.datagrams += len(unicast)
+
+    def _send_group(self, g: GroupTransfer, data: datagram.Buffers) -> bool:
+        """Um datagrama para todos os destinos do grupo; se o multicast falhar, todos passam a unicast"""
+        sock = self.device.socket
+        try:
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                sock.sendto(data, g.group)
+            else:
+                sock.sendmsg(data, (), 0, g.group)
+        except (BlockingIOError, InterruptedError):
+            pass  # como um descarte na rede: os relatórios pedem o bloco de novo
+        except OSError as e:
+            print(f"Multicast indisponível ({e}); envio {g.msg_id} segue por unicast")
+            g.group = None
+            for m in g.members.values():
+                m.joined = False
+            return False
+        return True
+
+    def _check_silent(self, g: GroupTransfer, now: float):
+        """Um destino do grupo que não relata nada provavelmente não recebe o multicast"""
+        if g.next_seq == 0:
+            return
+        for m in g.members.values():
+            if m.joined and m.status == transfer.ATIVA and now - m.last_report >= MEMBER_SILENCE:
+                print(f"Sem relatórios de {m.name}; blocos seguem para ele por unicast")
+                m.joined = False
+
+    def _on_probe(self, g: GroupTransfer, floor: int):
+        """Nada pôde sair por um RTO: os relatórios só cobrem o que está abaixo do maior bloco
+        recebido, então perdas no fim da janela (ou do arquivo) precisam ser sondadas"""
+        g.probe_timer = None
+        if g.status != transfer.ATIVA:
+            return
+        now = self.device.loop.time()
+        if not g.repair and g.next_seq >= g.total_chunks:
+            # cada destino responde ao END com o que ainda falta
+            for m in g.members.values():
+                if m.status == transfer.ATIVA:
+                    self._send_end(g, m)
+            return
+        if not g.repair and self._floor(g, now) == floor:
+            # janela parada: reenvia o primeiro bloco que falta a quem está atrás
+            g.cc.on_timeout(floor, g.next_seq)
+            for m in g.members.values():
+                if m.status == transfer.ATIVA and m.cum == floor:
+                    self._queue_repair(g, m, floor, now)
+        self._pump(g)
+
+    def _finish_member(self, g: GroupTransfer, m: GroupMember, status: str):
+        if m.timer:
+            m.timer.cancel()
+            m.timer = None
+        m.status = status
+        if g.status == transfer.AGUARDANDO:
+            self._start(g)
+        elif not self._check_done(g):
+            self._pump(g)
+
+    def _check_done(self, g: GroupTransfer) -> bool:
+        if g.active_members():
+            return False
+        done = [m for m in g.members.values() if m.status == transfer.CONCLUIDA]
+        if g.status not in transfer.FINAL_STATES:
+            print(f"Envio {g.msg_id} encerrado: {len(done)} de {len(g.members)} destinos receberam "
+                  f"{os.path.basename(g.filename)} ({g.datagrams} datagramas para {g.total_chunks} blocos)")
+        self._close(g, transfer.CONCLUIDA if done else transfer.FALHOU)
+        return True
+
+    def _abort(self, g: GroupTransfer, status: str, reason: str):
+        for m in g.active_members():
+            self.device._send_nack(g.msg_id, m.addr, True, reason)
+            if m.timer:
+                m.timer.cancel()
+                m.timer = None
+            m.status = status
+        self._close(g, status)
+
+    def _close(self, g: GroupTransfer, status: str):
+        for timer in (g.pacing_timer, g.probe_timer):
+            if timer:
+                timer.cancel()
+        g.pacing_timer = g.probe_timer = None
+        for m in g.members.values():
+            if m.timer:
+                m.timer.cancel()
+                m.timer = None
+        g.repair.clear()
+        g.repair_for.clear()
+        g.repaired.clear()
+        if g.source is not None:
+            g.source.close()
+            g.source = None
+        if g.status not in transfer.FINAL_STATES:
+            g.status = status
+
+    def find(self, msg_id: str) -> Optional[GroupTransfer]:
+        if msg_id in self.groups:
+            return self.groups[msg_id]
+        matches = [g for g in self.groups.values() if g.msg_id.startswith(msg_id)]
+        return matches[0] if len(matches) == 1 else None
+
+    def pause(self, g: GroupTransfer) -> bool:
+        if g.status != transfer.ATIVA:
+            return False
+        g.status = transfer.PAUSADA
+        return True
+
+    def resume(self, g: GroupTransfer) -> bool:
+        if g.status != transfer.PAUSADA:
+            return False
+        g.status = transfer.ATIVA
+        self._pump(g)
+        return True
+
+    def cancel(self, g: GroupTransfer) -> bool:
+        if g.status in transfer.FINAL_STATES:
+            return False
+        self._abort(g, transfer.CANCELADA, "cancelado")
+        print(f"Transferência {g.msg_id} cancelada")
+        return True
+
+    def list(self) -> List[dict]:
+        return [{'id': g.msg_id, 'direcao': 'envio', 'arquivo': g.filename,
+                 'peer': ",".join(m.name for m in g.members.values()), 'status': g.status,
+                 'bytes': g.progress(), 'tamanho': g.filesize}
+                for g in self.groups.values()]
+
+    # --- receptor ---
+
+    def accept(self, t: IncomingTransfer, group: Tuple[str, int]):
+        """Marca t como parte de um envio em grupo e entra no grupo multicast, se houver"""
+        t.group = group
+        if group != protocol.NO_GROUP and self.port is not None:
+            t.joined = self._join(group)
+
+    def _join(self, group: Tuple[str, int]) -> bool:
+        ip, port = group
+        try:
+            endpoint = self.endpoints.get(port)
+            if endpoint is None:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+                # vários dispositivos na mesma máquina escutam a mesma porta de grupo
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if hasattr(socket, "SO_REUSEPORT"):
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                if self.device.rcvbuf:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.device.rcvbuf)
+                sock.bind(('', port))
+                sock.setblocking(False)
+                endpoint = datagram.DatagramEndpoint(self.device.loop, sock, self.device._handle_message,
+                                                     self.device._on_socket_error, self.device.recv_batch)
+                endpoint.start()
+                self.endpoints[port] = endpoint
+            if not self.memberships.get(group):
+                mreq = struct.pack("4s4s", socket.inet_aton(ip), socket.inet_aton("0.0.0.0"))
+                endpoint.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        except OSError as e:
+            print(f"Não foi possível entrar no grupo {ip}:{port} ({e}); recebendo por unicast")
+            return False
+        self.memberships[group] = self.memberships.get(group, 0) + 1
+        return True
+
+    def release(self, t: IncomingTransfer):
+        """A transferência terminou: para os relatórios e sai do grupo quando ninguém mais o usa"""
+        if t.report_timer:
+            t.report_timer.cancel()
+            t.report_timer = None
+        if not t.joined:
+            return
+        t.joined = False
+        count = self.memberships.get(t.group, 0) - 1
+        if count > 0:
+            self.memberships[t.group] = count
+            return
+        self.memberships.pop(t.group, None)
+        endpoint = self.endpoints.get(t.group[1])
+        if endpoint is not None:
+            mreq = struct.pack("4s4s", socket.inet_aton(t.group[0]), socket.inet_aton("0.0.0.0"))
+            try:
+                endpoint.sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, mreq)
+            except OSError:
+                pass
+
+    def on_chunk(self, t: IncomingTransfer, seq: int):
+        """Bloco de um envio em grupo: relata em lote, não bloco a bloco"""
+        gap = seq > t.highest_seq + 1
+        t.highest_seq = max(t.highest_seq, seq)
+        t.unreported += 1
+        if gap or t.unreported >= REPORT_CHUNKS or t.receiver.complete:
+            self._send_report(t)
+        elif t.report_timer is None:
+            t.report_timer = self.device.loop.call_later(REPORT_DELAY, self._send_report, t)
+
+    def _send_report(self, t: IncomingTransfer):
+        if t.report_timer:
+            t.report_timer.cancel()
+            t.report_timer = None
+        t.unreported = 0
+        if t.status != transfer.ATIVA:
+            return
+        receiver = t.receiver
+        missing = receiver.missing_ranges(MAX_REPORT_RANGES, receiver.next_expected, t.highest_seq)
+        report = protocol.encode(protocol.NACK, t.msg_id, receiver.next_expected,
+                                 protocol.encode_sack(missing), protocol.FLAG_CHUNK_ACK)
+        self.device.metrics.nack_sent(t.addr, t.msg_id)
+        self.device._sendto(report, t.addr)
@@ -1,4 +1,7 @@
+import logging
 import sys
+import metrics
+from cluster import DeviceCluster
 from device import Device
 
 def print_menu():
@@ -7,15 +10,54 @@ def print_menu():
     print("2. talk <nome> <mensagem> ")
     print("3. sendfile <nome> <nome-arquivo>")
     print("4. sair")
+    print("5. transfers")
+    print("6. pause <id>")
+    print("7. resume <id>")
+    print("8. cancel <id>")
+    print("9. sendmany <nome1,nome2,...> <nome-arquivo>")
+    print("10. stats [arquivo.json]")
+
+def format_time(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.1f} ms"
+
+def print_stats(snapshot):
+    total = snapshot["total"]
+    print(f"\nTempo ativo: {snapshot['tempo_ativo']:.1f}s")
+    print(f"Pacotes: {total['pacotes_enviados']} enviados ({total['bytes_enviados']} bytes), "
+          f"{total['pacotes_recebidos']} recebidos ({total['bytes_recebidos']} bytes)")
+    print(f"Retransmissões: {total['retransmissoes']} | Duplicatas: {total['duplicatas']} | "
+          f"NACKs: {total['nacks_enviados']} enviados, {total['nacks_recebidos']} recebidos")
+    print(f"Vazão: envio {total['taxa_envio'] / 1024:.1f} KB/s, recepção {total['taxa_recepcao'] / 1024:.1f} KB/s")
+    for key, label in (("rtt", "RTT"), ("latencia_blocos", "Latência dos blocos")):
+        h = snapshot[key]
+        print(f"{label}: p50 {format_time(h['p50'])}, p99 {format_time(h['p99'])}, "
+              f"máx {format_time(h['max'])} ({h['amostras']} amostras)")
+    for addr, peer in snapshot["peers"].items():
+        print(f"  {peer['nome'] or '?'} ({addr}) | {peer['pacotes_enviados']}/{peer['pacotes_recebidos']} pacotes | "
+              f"retransmissões {peer['retransmissoes']} | duplicatas {peer['duplicatas']} | "
+              f"RTT p50 {format_time(peer['rtt']['p50'])}")
+    for msg_id, t in snapshot["transferencias"].items():
+        print(f"  {msg_id} | {t['bytes_enviados']} bytes enviados, {t['bytes_recebidos']} recebidos | "
+              f"{(t['taxa_envio'] + t['taxa_recepcao']) / 1024:.1f} KB/s | retransmissões {t['retransmissoes']} | "
+              f"latência dos blocos p50 {format_time(t['latencia_blocos']['p50'])}")
 
 def main():
-    if len(sys.argv) < 2 or len(sys.argv) > 3:
-        print("Uso: python main.py <nome_do_dispositivo> [porta]")
+    # --log=<nível> (debug, info, warning...): debug mostra cada bloco e confirmação
+    options = [arg for arg in sys.argv[1:] if arg.startswith("--log=")]
+    args = [sys.argv[0]] + [arg for arg in sys.argv[1:] if arg not in options]
+    level = getattr(logging, options[-1][len("--log="):].upper(), None) if options else logging.WARNING
+    if len(args) < 2 or len(args) > 4 or not isinstance(level, int):
+        print("Uso: python main.py <nome_do_dispositivo> [porta] [workers] [--log=debug|info|warning]")
         sys.exit(1)
-    device_name = sys.argv[1]
-    port = int(sys.argv[2]) if len(sys.argv) == 3 else 5000
+    metrics.setup_logging(level)
+    device_name = args[1]
+    port = int(args[2]) if len(args) >= 3 else 5000
+    workers = int(args[3]) if len(args) == 4 else 1
     print(f"Iniciando dispositivo {device_name} na porta {port}...")
-    device = Device(device_name, port)
+    if workers > 1:
+        device = DeviceCluster(device_name, port, workers)
+    else:
+        device = Device(device_name, port)
     device.start()
     try:
         while True:
@@ -55,6 +97,46 @@ def main():
                     print(f"Solicitação de envio de arquivo enviada para {target_name}")
                 else:
                     print(f"Falha ao enviar solicitação de arquivo para {target_name}")
+            elif command.startswith("9") or command.startswith("sendmany "):
+                if command.startswith("9"):
+                    parts = input("Digite os destinatários separados por vírgula e o nome do arquivo "
+                                  "(ex: dispositivo2,dispositivo3 teste.txt): ").strip().split(" ", 1)
+                else:
+                    parts = command.split(" ", 2)[1:]
+                if len(parts) != 2:
+                    print("Uso: sendmany <nome1,nome2,...> <nome-arquivo>")
+                    continue
+                target_names = [name for name in parts[0].split(",") if name]
+                if device.send_file_many(target_names, parts[1]):
+                    print(f"Envio de {parts[1]} iniciado para {', '.join(target_names)}")
+                else:
+                    print(f"Falha ao enviar {parts[1]} para algum dos destinos")
+            elif command == "5" or command == "transfers":
+                transfers = device.list_transfers()
+                if not transfers:
+                    print("Nenhuma transferência.")
+                for t in transfers:
+                    print(f"  {t['id']} | {t['direcao']} | {t['arquivo']} | {t['peer']} | "
+                          f"{t['status']} | {t['bytes']}/{t['tamanho']} bytes")
+            elif command.split(" ", 1)[0] in ("6", "7", "8", "pause", "resume", "cancel"):
+                action, _, transfer_id = command.partition(" ")
+                if not transfer_id:
+                    transfer_id = input("Digite o id da transferência: ").strip()
+                if action in ("6", "pause"):
+                    ok = device.pause_transfer(transfer_id)
+                elif action in ("7", "resume"):
+                    ok = device.resume_transfer(transfer_id)
+                else:
+                    ok = device.cancel_transfer(transfer_id)
+                if not ok:
+                    print(f"Não foi possível alterar a transferência {transfer_id}")
+            elif command.split(" ", 1)[0] in ("10", "stats"):
+                _, _, filename = command.partition(" ")
+                if filename:
+                    if device.export_stats(filename.strip()):
+                        print(f"Métricas gravadas em {filename.strip()}")
+                else:
+                    print_stats(device.stats())
             elif command == "4" or command == "sair":
                 print("Saindo...")
                 break
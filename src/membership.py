@@ -0,0 +1,142 @@
+import heapq
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+DEVICE_TIMEOUT = 10.0
+
+
+class DeviceInfo:
+    """Registro de um dispositivo conhecido; os instantes são de time.monotonic()"""
+
+    __slots__ = ("name", "ip", "port", "protocol_version", "heartbeat", "last_seen", "deadline")
+
+    def __init__(self, name: str, ip: str, port: int, protocol_version: int = 0,
+                 heartbeat: int = 0, last_seen: float = 0.0, deadline: float = 0.0):
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.protocol_version = protocol_version
+        self.heartbeat = heartbeat
+        self.last_seen = last_seen
+        self.deadline = deadline
+
+    @property
+    def addr(self) -> Tuple[str, int]:
+        return (self.ip, self.port)
+
+    def age(self, now: float = None) -> float:
+        """Segundos desde o último sinal de vida"""
+        return (time.monotonic() if now is None else now) - self.last_seen
+
+    def __repr__(self) -> str:
+        return (f"DeviceInfo(name={self.name!r}, ip={self.ip!r}, port={self.port}, "
+                f"protocol_version={self.protocol_version}, heartbeat={self.heartbeat})")
+
+
+class Membership:
+    """Tabela de dispositivos indexada por nome e por (ip, porta).
+
+    Cada atualização empurra o novo prazo de expiração em um heap; entradas
+    antigas do mesmo dispositivo ficam no heap e são descartadas quando
+    chegam ao topo (remoção preguiçosa). Assim atualizar, procurar e expirar
+    custam O(log n) no pior caso, sem varrer a tabela. Todas as operações
+    tomam o mesmo lock; os callbacks de entrada e saída rodam fora dele.
+    """
+
+    def __init__(self, timeout: float = DEVICE_TIMEOUT,
+                 on_join: Optional[Callable[[DeviceInfo], None]] = None,
+                 on_leave: Optional[Callable[[DeviceInfo], None]] = None):
+        self.timeout = timeout
+        self.on_join = on_join
+        self.on_leave = on_leave
+        self._lock = threading.RLock()
+        self._by_name: Dict[str, DeviceInfo] = {}
+        self._by_addr: Dict[Tuple[str, int], DeviceInfo] = {}
+        # (prazo, nome); só vale se o prazo ainda for o do registro atual
+        self._expiry: List[Tuple[float, str]] = []
+
+    def update(self, name: str, ip: str, port: int, protocol_version: int = 0,
+               heartbeat: int = 0, last_seen: float = None) -> DeviceInfo:
+        """Registra um sinal de vida do dispositivo, criando-o se for novo"""
+        now = time.monotonic()
+        last_seen = now if last_seen is None else min(last_seen, now)
+        with self._lock:
+            info = self._by_name.get(name)
+            is_new = info is None
+            if is_new:
+                info = self._by_name[name] = DeviceInfo(name, ip, port)
+            elif info.addr != (ip, port):
+                if self._by_addr.get(info.addr) is info:
+                    del self._by_addr[info.addr]
+            info.ip = ip
+            info.port = port
+            info.protocol_version = protocol_version
+            info.heartbeat = heartbeat
+            info.last_seen = max(info.last_seen, last_seen)
+            info.deadline = info.last_seen + self.timeout
+            self._by_addr[info.addr] = info
+            heapq.heappush(self._expiry, (info.deadline, name))
+        if is_new and self.on_join:
+            self.on_join(info)
+        return info
+
+    def remove(self, name: str) -> Optional[DeviceInfo]:
+        with self._lock:
+            info = self._pop(name)
+        if info and self.on_leave:
+            self.on_leave(info)
+        return info
+
+    def _pop(self, name: str) -> Optional[DeviceInfo]:
+        info = self._by_name.pop(name, None)
+        if info and self._by_addr.get(info.addr) is info:
+            del self._by_addr[info.addr]
+        return info
+
+    def expire(self, now: float = None) -> List[DeviceInfo]:
+        """Remove os dispositivos cujo prazo passou e os devolve"""
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                deadline, name = heapq.heappop(self._expiry)
+                info = self._by_name.get(name)
+                if info is not None and info.deadline == deadline:
+                    self._pop(name)
+                    expired.append(info)
+        if self.on_leave:
+            for info in expired:
+                self.on_leave(info)
+        return expired
+
+    def next_deadline(self) -> Optional[float]:
+        """Instante da próxima entrada do heap (pode ser uma entrada já superada)"""
+        with self._lock:
+            return self._expiry[0][0] if self._expiry else None
+
+    def get(self, name: str) -> Optional[DeviceInfo]:
+        with self._lock:
+            return self._by_name.get(name)
+
+    def by_addr(self, addr: tuple) -> Optional[DeviceInfo]:
+        """Identifica o dispositivo que enviou um datagrama"""
+        with self._lock:
+            return self._by_addr.get((addr[0], addr[1]))
+
+    def values(self) -> List[DeviceInfo]:
+        """Cópia dos registros, segura para iterar enquanto a tabela muda"""
+        with self._lock:
+            return list(self._by_name.values())
+
+    def __getitem__(self, name: str) -> DeviceInfo:
+        with self._lock:
+            return self._by_name[name]
+
+    def __contains__(self, name: str) -> bool:
+        with self._lock:
+            return name in self._by_name
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._by_name)
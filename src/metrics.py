@@ -0,0 +1,333 @@
+import bisect
+import json
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Iterable, List, Optional
+
+# Limites superiores (segundos) das faixas dos histogramas de tempo; acima do último, "inf"
+TIME_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+# Vazão "ao vivo": bytes dos últimos RATE_WINDOW segundos, somados em fatias de RATE_SLOT
+RATE_WINDOW = 5.0
+RATE_SLOT = 0.5
+# Transferências com contadores próprios; as mais antigas saem primeiro
+MAX_TRANSFERS = 256
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+COUNTER_NAMES = {
+    "packets_sent": "pacotes_enviados",
+    "packets_received": "pacotes_recebidos",
+    "bytes_sent": "bytes_enviados",
+    "bytes_received": "bytes_recebidos",
+    "retransmissions": "retransmissoes",
+    "duplicates": "duplicatas",
+    "nacks_sent": "nacks_enviados",
+    "nacks_received": "nacks_recebidos",
+}
+
+
+def setup_logging(level: int = logging.WARNING):
+    """Saída dos loggers dos módulos; abaixo de WARNING aparecem os eventos por pacote"""
+    logging.basicConfig(level=level, format=LOG_FORMAT)
+    logging.getLogger().setLevel(level)
+
+
+class Histogram:
+    """Contagem de amostras por faixa, com mínimo, máximo e soma"""
+
+    __slots__ = ("bounds", "counts", "count", "total", "low", "high")
+
+    def __init__(self, bounds: Iterable[float] = TIME_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.low = None
+        self.high = None
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.low is None or value < self.low:
+            self.low = value
+        if self.high is None or value > self.high:
+            self.high = value
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """Estimativa pelo limite da faixa onde cai o percentil, dentro de [mínimo, máximo]"""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                bound = self.bounds[index] if index < len(self.bounds) else self.high
+                return min(max(bound, self.low), self.high)
+        return self.high
+
+    def to_dict(self) -> dict:
+        faixas = {str(bound): count for bound, count in zip(self.bounds, self.counts)}
+        faixas["inf"] = self.counts[-1]
+        return {
+            "amostras": self.count,
+            "media": self.total / self.count if self.count else None,
+            "min": self.low,
+            "max": self.high,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "faixas": faixas,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Histogram":
+        faixas = dict(data["faixas"])
+        overflow = faixas.pop("inf", 0)
+        h = cls(float(bound) for bound in faixas)
+        h.counts = list(faixas.values()) + [overflow]
+        h.count = data["amostras"]
+        h.total = (data["media"] or 0.0) * h.count
+        h.low = data["min"]
+        h.high = data["max"]
+        return h
+
+    def merge(self, other: "Histogram"):
+        if other.bounds != self.bounds:
+            raise ValueError("histogramas com faixas diferentes")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        if other.low is not None and (self.low is None or other.low < self.low):
+            self.low = other.low
+        if other.high is not None and (self.high is None or other.high > self.high):
+            self.high = other.high
+
+
+class Rate:
+    """Bytes por segundo na janela mais recente"""
+
+    __slots__ = ("started", "slots")
+
+    def __init__(self, now: float):
+        self.started = now
+        # [início da fatia, bytes]
+        self.slots: Deque[list] = deque()
+
+    def add(self, nbytes: int, now: float):
+        slot = now - now % RATE_SLOT
+        if self.slots and self.slots[-1][0] == slot:
+            self.slots[-1][1] += nbytes
+            return
+        self.slots.append([slot, nbytes])
+        self._trim(now)
+
+    def _trim(self, now: float):
+        while self.slots and self.slots[0][0] <= now - RATE_WINDOW:
+            self.slots.popleft()
+
+    def per_second(self, now: float) -> float:
+        self._trim(now)
+        elapsed = min(RATE_WINDOW, now - self.started)
+        if elapsed <= 0:
+            return 0.0
+        return sum(nbytes for _, nbytes in self.slots) / elapsed
+
+
+class Stats:
+    """Contadores de um peer ou de uma transferência"""
+
+    __slots__ = tuple(COUNTER_NAMES) + ("sent_rate", "received_rate")
+
+    def __init__(self, now: float):
+        for name in COUNTER_NAMES:
+            setattr(self, name, 0)
+        self.sent_rate = Rate(now)
+        self.received_rate = Rate(now)
+
+    def to_dict(self, now: float) -> dict:
+        data = {label: getattr(self, name) for name, label in COUNTER_NAMES.items()}
+        data["taxa_envio"] = self.sent_rate.per_second(now)
+        data["taxa_recepcao"] = self.received_rate.per_second(now)
+        return data
+
+
+class PeerStats(Stats):
+    __slots__ = ("rtt",)
+
+    def __init__(self, now: float):
+        super().__init__(now)
+        self.rtt = Histogram()
+
+
+class TransferStats(Stats):
+    __slots__ = ("started", "chunk_latency")
+
+    def __init__(self, now: float):
+        super().__init__(now)
+        self.started = now
+        # do primeiro envio de um bloco até o ACK (só blocos não retransmitidos)
+        self.chunk_latency = Histogram()
+
+
+class Metrics:
+    """Contadores do protocolo por peer e por transferência, histogramas de RTT e
+    de latência dos blocos e vazão recente.
+
+    Só é alterado dentro do event loop do dispositivo, então dispensa lock;
+    snapshot() devolve um dicionário pronto para JSON.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.peers: Dict[tuple, PeerStats] = {}
+        self.transfers: "OrderedDict[str, TransferStats]" = OrderedDict()
+        self.chunk_latency = Histogram()
+
+    def peer(self, addr: tuple) -> PeerStats:
+        stats = self.peers.get(addr)
+        if stats is None:
+            stats = self.peers[addr] = PeerStats(self.clock())
+        return stats
+
+    def transfer(self, msg_id: str) -> TransferStats:
+        stats = self.transfers.get(msg_id)
+        if stats is None:
+            stats = self.transfers[msg_id] = TransferStats(self.clock())
+            while len(self.transfers) > MAX_TRANSFERS:
+                self.transfers.popitem(last=False)
+        return stats
+
+    def sent(self, addr: tuple, nbytes: int):
+        stats = self.peer(addr)
+        stats.packets_sent += 1
+        stats.bytes_sent += nbytes
+        stats.sent_rate.add(nbytes, self.clock())
+
+    def received(self, addr: tuple, nbytes: int):
+        stats = self.peer(addr)
+        stats.packets_received += 1
+        stats.bytes_received += nbytes
+        stats.received_rate.add(nbytes, self.clock())
+
+    def chunk_sent(self, msg_id: str, nbytes: int):
+        stats = self.transfer(msg_id)
+        stats.packets_sent += 1
+        stats.bytes_sent += nbytes
+        stats.sent_rate.add(nbytes, self.clock())
+
+    def chunk_received(self, msg_id: str, nbytes: int):
+        stats = self.transfer(msg_id)
+        stats.packets_received += 1
+        stats.bytes_received += nbytes
+        stats.received_rate.add(nbytes, self.clock())
+
+    def chunk_acked(self, msg_id: str, latency: float):
+        self.transfer(msg_id).chunk_latency.observe(latency)
+        self.chunk_latency.observe(latency)
+
+    def retransmitted(self, addr: Optional[tuple], msg_id: Optional[str] = None, count: int = 1):
+        if addr is not None:
+            self.peer(addr).retransmissions += count
+        if msg_id:
+            self.transfer(msg_id).retransmissions += count
+
+    def duplicate(self, addr: tuple, msg_id: Optional[str] = None, count: int = 1):
+        self.peer(addr).duplicates += count
+        if msg_id:
+            self.transfer(msg_id).duplicates += count
+
+    def nack_sent(self, addr: tuple, msg_id: Optional[str] = None):
+        self.peer(addr).nacks_sent += 1
+        if msg_id:
+            self.transfer(msg_id).nacks_sent += 1
+
+    def nack_received(self, addr: tuple, msg_id: Optional[str] = None):
+        self.peer(addr).nacks_received += 1
+        if msg_id:
+            self.transfer(msg_id).nacks_received += 1
+
+    def snapshot(self, names: Optional[Dict[tuple, str]] = None) -> dict:
+        """Estado atual; names dá o nome de cada endereço conhecido"""
+        now = self.clock()
+        names = names or {}
+        peers = {}
+        total = dict.fromkeys(list(COUNTER_NAMES.values()) + ["taxa_envio", "taxa_recepcao"], 0)
+        rtt = Histogram()
+        for addr, stats in self.peers.items():
+            data = stats.to_dict(now)
+            for key in total:
+                total[key] += data[key]
+            data["nome"] = names.get(addr)
+            data["rtt"] = stats.rtt.to_dict()
+            rtt.merge(stats.rtt)
+            peers[f"{addr[0]}:{addr[1]}"] = data
+        transfers = {}
+        for msg_id, stats in self.transfers.items():
+            data = stats.to_dict(now)
+            data["duracao"] = now - stats.started
+            data["latencia_blocos"] = stats.chunk_latency.to_dict()
+            transfers[msg_id] = data
+        return {
+            "instante": time.time(),
+            "tempo_ativo": now - self.started,
+            "total": total,
+            "rtt": rtt.to_dict(),
+            "latencia_blocos": self.chunk_latency.to_dict(),
+            "peers": peers,
+            "transferencias": transfers,
+        }
+
+
+def merge_snapshots(snapshots: List[dict]) -> dict:
+    """Junta os snapshots dos workers de um DeviceCluster: soma contadores e histogramas"""
+    merged = {"instante": time.time(), "tempo_ativo": 0.0, "total": {}, "peers": {}, "transferencias": {}}
+    if snapshots:
+        merged["dispositivo"] = snapshots[0].get("dispositivo")
+    histograms = {"rtt": Histogram(), "latencia_blocos": Histogram()}
+    peer_rtt: Dict[str, Histogram] = {}
+    # soma dos pesos já aplicados à média do RTT de cada peer
+    peer_weight: Dict[str, int] = {}
+    for snapshot in snapshots:
+        merged["tempo_ativo"] = max(merged["tempo_ativo"], snapshot["tempo_ativo"])
+        _add_counters(merged["total"], snapshot["total"])
+        merged["total"]["descartados_no_envio"] = (merged["total"].get("descartados_no_envio", 0)
+                                                   + snapshot["total"].get("descartados_no_envio", 0))
+        for key, h in histograms.items():
+            h.merge(Histogram.from_dict(snapshot[key]))
+        for addr, data in snapshot["peers"].items():
+            peer = merged["peers"].setdefault(addr, {"nome": data["nome"]})
+            peer["nome"] = peer["nome"] or data["nome"]
+            # o RTT estimado é a média dos workers, ponderada pelos pacotes que cada um
+            # enviou ao peer (o peso é o do próprio snapshot, não o total já somado)
+            if data.get("srtt") is not None:
+                weight = max(data["pacotes_enviados"], 1)
+                previous = peer_weight.get(addr, 0)
+                for key in ("srtt", "rto"):
+                    peer[key] = (peer.get(key, 0.0) * previous + data[key] * weight) / (previous + weight)
+                peer_weight[addr] = previous + weight
+            _add_counters(peer, data)
+            peer_rtt.setdefault(addr, Histogram()).merge(Histogram.from_dict(data["rtt"]))
+        # cada transferência fica em um único worker
+        merged["transferencias"].update(snapshot["transferencias"])
+    for addr, h in peer_rtt.items():
+        merged["peers"][addr]["rtt"] = h.to_dict()
+    for key, h in histograms.items():
+        merged[key] = h.to_dict()
+    return merged
+
+
+def _add_counters(target: dict, source: dict):
+    for key in list(COUNTER_NAMES.values()) + ["taxa_envio", "taxa_recepcao"]:
+        target[key] = target.get(key, 0) + source[key]
+
+
+def export(snapshot: dict, filename: str):
+    """Grava o snapshot em JSON (troca atômica, para quem lê o arquivo periodicamente)"""
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "w") as f:
+        json.dump(snapshot, f, indent=2, ensure_ascii=False)
+    os.replace(temp_filename, filename)
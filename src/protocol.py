@@ -0,0 +1,383 @@
+import hashlib
+import socket
+import struct
+import secrets
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+# Formato binário (versão 1): cabeçalho fixo seguido dos bytes crus do payload.
+#   magic (1) | versão (1) | tipo (1) | flags (1) | transfer id (8) | seq (4) | tamanho (4)
+# O byte mágico não é ASCII, então mensagens do formato texto antigo nunca
+# são confundidas com mensagens binárias.
+MAGIC = 0xD1
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!BBBBQII")
+
+HEARTBEAT = 1
+TALK = 2
+ACK = 3
+FILE = 4
+CHUNK = 5
+END = 6
+NACK = 7
+GOSSIP_SYN = 8
+GOSSIP_ACK = 9
+GOSSIP_ACK2 = 10
+SIG = 11
+
+TYPE_NAMES = {
+    HEARTBEAT: "HEARTBEAT",
+    TALK: "TALK",
+    ACK: "ACK",
+    FILE: "FILE",
+    CHUNK: "CHUNK",
+    END: "END",
+    NACK: "NACK",
+    GOSSIP_SYN: "GOSSIP_SYN",
+    GOSSIP_ACK: "GOSSIP_ACK",
+    GOSSIP_ACK2: "GOSSIP_ACK2",
+    SIG: "SIG",
+}
+
+# A mensagem se refere ao END da transferência (equivale ao sufixo "_END" do formato texto)
+FLAG_END = 0x01
+# ACK de bloco: seq carrega a confirmação cumulativa e o payload os intervalos SACK
+# NACK: relatório de um receptor de envio em grupo; seq é o próximo bloco esperado e o
+# payload traz os intervalos que faltam abaixo do maior bloco recebido
+FLAG_CHUNK_ACK = 0x02
+# FILE: o SHA-256 do arquivo vem logo após FILE_INFO (permite retomar a transferência)
+# CHUNK: o payload começa com o hash do bloco, verificado pelo receptor na chegada
+FLAG_HASH = 0x04
+# FILE: oferta de codecs de compressão; ACK do FILE: codec escolhido pelo receptor;
+# CHUNK: os dados do bloco estão comprimidos com o codec negociado
+FLAG_COMPRESSED = 0x08
+# FILE: o remetente fornece a assinatura dos blocos (mensagens SIG); ACK do FILE: o
+# receptor vai procurar os blocos em arquivos locais e pede que o remetente espere
+FLAG_DELTA = 0x10
+# FILE: envio para vários destinos com o mesmo id; GROUP_INFO traz o grupo multicast
+# (0.0.0.0 se só unicast). ACK do FILE: o receptor entrou no grupo
+FLAG_GROUP = 0x20
+# TALK: lote de mensagens de uma sessão (números de sequência de 64 bits por peer); com
+# FLAG_CHUNK_ACK, o lote começa com a confirmação da sessão no sentido contrário.
+# ACK: confirmação cumulativa de uma sessão de mensagens
+FLAG_SESSION = 0x40
+
+MAX_DATAGRAM = 65507
+CHUNK_HASH_SIZE = 16
+MAX_CHUNK_SIZE = MAX_DATAGRAM - HEADER.size - CHUNK_HASH_SIZE
+IP_UDP_OVERHEAD = 28
+DEFAULT_MTU = 1500
+RECV_BUFFER_SIZE = 65535
+
+FILE_INFO = struct.Struct("!QI")
+FILE_HASH_SIZE = 32
+SACK_RANGE = struct.Struct("!II")
+# ACK do FILE: tamanho de bloco aceito e bytes que o receptor consegue enfileirar
+FILE_ACK_INFO = struct.Struct("!II")
+# Envio para vários destinos: endereço e porta do grupo multicast dos blocos
+GROUP_INFO = struct.Struct("!4sH")
+NO_GROUP = ("0.0.0.0", 0)
+# Gossip: digest (nome -> contador de heartbeat) e entradas completas de membros
+DIGEST_ENTRY = struct.Struct("!Q")
+MEMBER_ENTRY = struct.Struct("!4sHBQI")
+# SIG: Adler-32 e hash curto de cada bloco; o pedido de uma página vai sem payload
+SIG_ENTRY = struct.Struct("!I16s")
+COUNT = struct.Struct("!H")
+# Lote de TALK: seq mais antigo ainda sem confirmação e seq da primeira mensagem; cada
+# mensagem vem precedida do seu tamanho (COUNT) e as seguintes têm seqs consecutivos
+TALK_BATCH = struct.Struct("!QQ")
+# Confirmação de sessão: id da sessão, próximo seq esperado e quantidade de intervalos
+# SACK, dados como deslocamentos a partir dele
+TALK_ACK = struct.Struct("!QQB")
+
+# IP_MTU só existe no Linux; o valor é o mesmo de <linux/in.h>
+IP_MTU = getattr(socket, "IP_MTU", 14)
+
+
+@dataclass
+class Packet:
+    kind: int
+    flags: int
+    transfer_id: int
+    seq: int
+    payload: bytes
+
+    @property
+    def msg_id(self) -> str:
+        """Identificador no formato usado internamente pelo dispositivo"""
+        msg_id = format_id(self.transfer_id)
+        if self.flags & FLAG_END:
+            msg_id += "_END"
+        return msg_id
+
+
+def new_transfer_id(shard: int = 0, shards: int = 1) -> str:
+    """Gera um identificador de 64 bits, representado em hexadecimal.
+
+    Com shards > 1, os 32 bits menos significativos ficam congruentes a
+    shard módulo shards: é por eles que o roteador do DeviceCluster escolhe
+    o worker que recebe as mensagens da transferência.
+    """
+    transfer_id = secrets.randbits(64)
+    if shards > 1:
+        low = transfer_id & 0xFFFFFFFF
+        low -= low % shards - shard
+        if low > 0xFFFFFFFF:
+            low -= shards
+        transfer_id = (transfer_id & ~0xFFFFFFFF) | low
+    return format_id(transfer_id)
+
+
+def format_id(transfer_id: int) -> str:
+    return f"{transfer_id:016x}"
+
+
+def parse_id(msg_id: str) -> Tuple[int, int]:
+    """Converte um identificador interno em (transfer id, flags)"""
+    flags = 0
+    if msg_id.endswith("_END"):
+        msg_id = msg_id[:-4]
+        flags |= FLAG_END
+    return int(msg_id, 16), flags
+
+
+def is_binary(data: bytes) -> bool:
+    return len(data) >= HEADER.size and data[0] == MAGIC
+
+
+def encode(kind: int, msg_id: str, seq: int = 0, payload: bytes = b"", flags: int = 0) -> bytes:
+    """Monta uma mensagem binária"""
+    return encode_header(kind, msg_id, seq, len(payload), flags) + payload
+
+
+def encode_header(kind: int, msg_id: str, seq: int, length: int, flags: int = 0) -> bytes:
+    """Só o cabeçalho, para enviar junto com o payload por sendmsg sem concatenar"""
+    transfer_id, id_flags = parse_id(msg_id) if msg_id else (0, 0)
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, kind, flags | id_flags, transfer_id, seq, length)
+
+
+def decode(data: bytes) -> Packet:
+    """Interpreta uma mensagem binária"""
+    magic, version, kind, flags, transfer_id, seq, length = HEADER.unpack_from(data)
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"versão de protocolo não suportada: {version}")
+    if kind not in TYPE_NAMES:
+        raise ValueError(f"tipo de mensagem desconhecido: {kind}")
+    payload = data[HEADER.size:HEADER.size + length]
+    if len(payload) != length:
+        raise ValueError("mensagem truncada")
+    return Packet(kind, flags, transfer_id, seq, payload)
+
+
+def encode_file_info(filename: str, filesize: int, chunk_size: int, file_hash: bytes = b"",
+                     codecs: List[int] = (), delta: bool = False,
+                     group: Optional[Tuple[str, int]] = None) -> Tuple[bytes, int]:
+    """Payload e flags do FILE"""
+    flags = FLAG_DELTA if delta else 0
+    payload = FILE_INFO.pack(filesize, chunk_size)
+    if file_hash:
+        flags |= FLAG_HASH
+        payload += file_hash
+    if codecs:
+        flags |= FLAG_COMPRESSED
+        payload += bytes([len(codecs)]) + bytes(codecs)
+    if group is not None:
+        flags |= FLAG_GROUP
+        payload += GROUP_INFO.pack(socket.inet_aton(group[0]), group[1])
+    return payload + filename.encode(), flags
+
+
+def decode_file_info(payload: bytes, flags: int = 0) -> Tuple[str, int, int, Optional[bytes], List[int],
+                                                               Optional[Tuple[str, int]]]:
+    filesize, chunk_size = FILE_INFO.unpack_from(payload)
+    offset = FILE_INFO.size
+    file_hash = None
+    codecs = []
+    group = None
+    if flags & FLAG_HASH:
+        file_hash = bytes(payload[offset:offset + FILE_HASH_SIZE])
+        offset += FILE_HASH_SIZE
+    if flags & FLAG_COMPRESSED:
+        count = payload[offset]
+        codecs = list(payload[offset + 1:offset + 1 + count])
+        offset += 1 + count
+    if flags & FLAG_GROUP:
+        ip, port = GROUP_INFO.unpack_from(payload, offset)
+        group = (socket.inet_ntoa(ip), port)
+        offset += GROUP_INFO.size
+    return bytes(payload[offset:]).decode(), filesize, chunk_size, file_hash, codecs, group
+
+
+def encode_file_ack(chunk_size: int, recv_window: int, codec: int = 0,
+                    held: List[Tuple[int, int]] = (), delta: bool = False,
+                    group: bool = False) -> Tuple[bytes, int]:
+    """Payload e flags do ACK do FILE: bloco aceito, janela, codec escolhido e blocos já recebidos"""
+    payload = FILE_ACK_INFO.pack(chunk_size, recv_window)
+    flags = FLAG_DELTA if delta else 0
+    if group:
+        flags |= FLAG_GROUP
+    if codec:
+        flags |= FLAG_COMPRESSED
+        payload += bytes([codec])
+    return payload + encode_sack(held), flags
+
+
+def decode_file_ack(payload: bytes, flags: int = 0) -> Tuple[int, int, int, List[Tuple[int, int]]]:
+    chunk_size, recv_window = FILE_ACK_INFO.unpack_from(payload)
+    offset = FILE_ACK_INFO.size
+    codec = 0
+    if flags & FLAG_COMPRESSED:
+        codec = payload[offset]
+        offset += 1
+    return chunk_size, recv_window, codec, decode_sack(payload[offset:])
+
+
+def encode_talk_batch(base: int, first: int, messages: List[bytes]) -> bytes:
+    return TALK_BATCH.pack(base, first) + b"".join(COUNT.pack(len(m)) + m for m in messages)
+
+
+def decode_talk_batch(payload: bytes, offset: int = 0) -> Tuple[int, int, List[bytes]]:
+    base, first = TALK_BATCH.unpack_from(payload, offset)
+    offset += TALK_BATCH.size
+    messages = []
+    while offset < len(payload):
+        (size,) = COUNT.unpack_from(payload, offset)
+        offset += COUNT.size
+        message = bytes(payload[offset:offset + size])
+        if len(message) != size:
+            raise ValueError("lote de mensagens truncado")
+        messages.append(message)
+        offset += size
+    return base, first, messages
+
+
+def encode_talk_ack(session_id: int, cum: int, ranges: List[Tuple[int, int]] = ()) -> bytes:
+    """Confirmação de sessão; ranges são seqs absolutos acima de cum já recebidos"""
+    return TALK_ACK.pack(session_id, cum, len(ranges)) + encode_sack([(a - cum, b - cum) for a, b in ranges])
+
+
+def decode_talk_ack(payload: bytes, offset: int = 0) -> Tuple[int, int, List[Tuple[int, int]], int]:
+    """(id da sessão, próximo seq esperado, intervalos recebidos, offset do que vem depois)"""
+    session_id, cum, count = TALK_ACK.unpack_from(payload, offset)
+    offset += TALK_ACK.size
+    end = offset + count * SACK_RANGE.size
+    ranges = [(cum + a, cum + b) for a, b in decode_sack(payload[offset:end])]
+    return session_id, cum, ranges, end
+
+
+def sig_entries_per_page(chunk_size: int) -> int:
+    """Entradas por página de SIG: a página não passa do tamanho de um bloco, que já cabe no caminho"""
+    return max(1, chunk_size // SIG_ENTRY.size)
+
+
+def chunk_hash(data: bytes) -> bytes:
+    """Hash curto de um bloco, usado para descartar blocos corrompidos na chegada"""
+    return hashlib.blake2b(data, digest_size=CHUNK_HASH_SIZE).digest()
+
+
+def encode_sack(ranges: List[Tuple[int, int]]) -> bytes:
+    return b"".join(SACK_RANGE.pack(a, b) for a, b in ranges)
+
+
+def decode_sack(payload: bytes) -> List[Tuple[int, int]]:
+    return [SACK_RANGE.unpack_from(payload, offset) for offset in range(0, len(payload), SACK_RANGE.size)]
+
+
+def format_ranges(ranges: List[Tuple[int, int]]) -> str:
+    """Intervalos no formato texto "a-b,c-d" (SACK do formato texto e pedidos de reparo)"""
+    return ",".join(f"{a}-{b}" for a, b in ranges)
+
+
+def parse_ranges(text: str) -> List[Tuple[int, int]]:
+    return [tuple(int(x) for x in item.split("-")) for item in text.split(",") if item]
+
+
+def path_mtu(addr: tuple) -> int:
+    """Consulta o MTU do caminho até addr (Linux); usa 1500 quando indisponível"""
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect(addr)
+        return probe.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return DEFAULT_MTU
+    finally:
+        probe.close()
+
+
+def max_chunk_size(addr: tuple) -> int:
+    """Maior bloco que cabe em um único datagrama sem fragmentação até addr"""
+    return max(1, min(path_mtu(addr) - IP_UDP_OVERHEAD - HEADER.size - CHUNK_HASH_SIZE, MAX_CHUNK_SIZE))
+
+
+def _pack_name(name: str) -> bytes:
+    raw = name.encode()[:255]
+    return bytes([len(raw)]) + raw
+
+
+def _unpack_name(payload: bytes, offset: int) -> Tuple[str, int]:
+    size = payload[offset]
+    end = offset + 1 + size
+    return bytes(payload[offset + 1:end]).decode(), end
+
+
+def encode_digest(entries: List[Tuple[str, int]], limit: int = MAX_DATAGRAM - HEADER.size) -> bytes:
+    """Digest de gossip: (nome, contador) por membro; para de crescer ao atingir limit bytes"""
+    parts = []
+    size = 0
+    for name, heartbeat in entries:
+        part = _pack_name(name) + DIGEST_ENTRY.pack(heartbeat)
+        if size + len(part) > limit:
+            break
+        parts.append(part)
+        size += len(part)
+    return b"".join(parts)
+
+
+def decode_digest(payload: bytes) -> List[Tuple[str, int]]:
+    entries = []
+    offset = 0
+    while offset < len(payload):
+        name, offset = _unpack_name(payload, offset)
+        (heartbeat,) = DIGEST_ENTRY.unpack_from(payload, offset)
+        offset += DIGEST_ENTRY.size
+        entries.append((name, heartbeat))
+    return entries
+
+
+def encode_members(entries: List[tuple], requests: List[str] = (),
+                   limit: int = MAX_DATAGRAM - HEADER.size) -> bytes:
+    """Entradas completas (nome, ip, porta, versão, contador, idade em ms) seguidas dos nomes pedidos"""
+    parts = []
+    size = COUNT.size
+    for name, ip, port, version, heartbeat, age_ms in entries:
+        part = _pack_name(name) + MEMBER_ENTRY.pack(socket.inet_aton(ip or "0.0.0.0"), port, version,
+                                                    heartbeat, min(age_ms, 0xFFFFFFFF))
+        if size + len(part) > limit:
+            break
+        parts.append(part)
+        size += len(part)
+    count = len(parts)
+    for name in requests:
+        part = _pack_name(name)
+        if size + len(part) > limit:
+            break
+        parts.append(part)
+        size += len(part)
+    return COUNT.pack(count) + b"".join(parts)
+
+
+def decode_members(payload: bytes) -> Tuple[List[tuple], List[str]]:
+    (count,) = COUNT.unpack_from(payload)
+    offset = COUNT.size
+    entries = []
+    for _ in range(count):
+        name, offset = _unpack_name(payload, offset)
+        ip, port, version, heartbeat, age_ms = MEMBER_ENTRY.unpack_from(payload, offset)
+        offset += MEMBER_ENTRY.size
+        ip = socket.inet_ntoa(ip)
+        entries.append((name, None if ip == "0.0.0.0" else ip, port, version, heartbeat, age_ms))
+    requests = []
+    while offset < len(payload):
+        name, offset = _unpack_name(payload, offset)
+        requests.append(name)
+    return entries, requests
@@ -0,0 +1,245 @@
+import fcntl
+import os
+import hashlib
+import struct
+from typing import List, Optional, Tuple
+
+import protocol
+
+# Cabeçalho do arquivo de estado: tamanho do arquivo, tamanho do bloco e SHA-256 esperado.
+# Depois dele vêm o bitmap de blocos recebidos e o hash de cada bloco.
+STATE_HEADER = struct.Struct("!QI32s")
+
+
+class FileReceiver:
+    """Grava os blocos recebidos direto em um arquivo pré-alocado.
+
+    Cada bloco é escrito no seu offset assim que chega, e um bitmap guarda
+    quais blocos já foram recebidos. O SHA-256 é calculado em ordem à medida
+    que o prefixo contíguo cresce, então a memória usada não depende do
+    tamanho do arquivo. O arquivo final só aparece com o rename atômico de
+    commit().
+
+    Quando o SHA-256 do arquivo é conhecido de antemão (file_hash), o bitmap
+    e o hash de cada bloco também são gravados em um arquivo de estado ao
+    lado do parcial. Se a transferência for interrompida, um novo
+    FileReceiver para o mesmo conteúdo retoma a partir deles; blocos que não
+    batem com o hash guardado são descartados por verify() e pedidos de novo.
+    O prefixo recuperado ainda precisa passar pelo SHA-256: catch_up() o relê
+    do disco e pode rodar fora do event loop, antes de qualquer write().
+
+    O parcial pertence a um único receptor: o arquivo de estado fica com um
+    flock exclusivo enquanto ele está aberto, e o parcial sem estado é criado
+    com O_EXCL. Se outro receptor (mesmo de outro processo no mesmo
+    diretório) já o tem, o construtor levanta FileExistsError.
+    """
+
+    def __init__(self, dest_filename: str, filesize: int, chunk_size: int, temp_filename: str,
+                 file_hash: Optional[bytes] = None, state_filename: Optional[str] = None):
+        self.dest_filename = dest_filename
+        self.temp_filename = temp_filename
+        self.state_filename = state_filename if file_hash else None
+        self.filesize = filesize
+        self.chunk_size = chunk_size
+        self.file_hash = file_hash
+        self.next_expected = 0
+        self.sha256 = hashlib.sha256()
+        self.fd = None
+        self.state_fd = self._lock_state() if self.state_filename else None
+        try:
+            self.resumed = self._load_state()
+            if self.resumed:
+                self.fd = os.open(temp_filename, os.O_RDWR)
+            else:
+                self._init_state(chunk_size)
+                # com o lock do estado o parcial antigo é nosso; sem ele, só um parcial novo
+                exclusive = os.O_TRUNC if self.state_fd is not None else os.O_EXCL
+                self.fd = os.open(temp_filename, os.O_RDWR | os.O_CREAT | exclusive, 0o644)
+                try:
+                    if filesize:
+                        os.posix_fallocate(self.fd, 0, filesize)
+                except (AttributeError, OSError):
+                    os.ftruncate(self.fd, filesize)
+                if self.state_fd is not None:
+                    os.ftruncate(self.state_fd, 0)
+                    os.pwrite(self.state_fd, STATE_HEADER.pack(filesize, self.chunk_size, file_hash)
+                              + bytes(self.bitmap) + bytes(self.total_chunks * protocol.CHUNK_HASH_SIZE), 0)
+        except BaseException:
+            self.close()
+            raise
+
+    def _lock_state(self) -> int:
+        """Abre o arquivo de estado com lock exclusivo; sem o lock, o parcial é de outro receptor"""
+        fd = os.open(self.state_filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # o dono anterior apaga o estado antes de soltar o lock: se o caminho já
+            # aponta para outro arquivo, o lock obtido vale para um arquivo removido
+            if os.fstat(fd).st_ino != os.stat(self.state_filename).st_ino:
+                raise BlockingIOError
+        except OSError:
+            os.close(fd)
+            raise FileExistsError(f"parcial em uso: {self.temp_filename}")
+        return fd
+
+    def _init_state(self, chunk_size: int):
+        self.chunk_size = chunk_size
+        self.total_chunks = (self.filesize + chunk_size - 1) // chunk_size
+        self.bitmap = bytearray((self.total_chunks + 7) // 8)
+        self.received_count = 0
+
+    def _load_state(self) -> bool:
+        """Recupera o bitmap de uma tentativa anterior com o mesmo conteúdo"""
+        fd = self.state_fd
+        if fd is None or not os.path.exists(self.temp_filename):
+            return False
+        header = os.pread(fd, STATE_HEADER.size, 0)
+        if len(header) == STATE_HEADER.size:
+            filesize, chunk_size, file_hash = STATE_HEADER.unpack(header)
+            # o bloco da tentativa anterior vale se não for maior que o proposto agora
+            if filesize == self.filesize and file_hash == self.file_hash and 0 < chunk_size <= self.chunk_size \
+                    and os.path.getsize(self.temp_filename) == filesize:
+                self._init_state(chunk_size)
+                bitmap = os.pread(fd, len(self.bitmap), STATE_HEADER.size)
+                if len(bitmap) == len(self.bitmap):
+                    self.bitmap[:] = bitmap
+                    self.received_count = sum(bin(b).count("1") for b in self.bitmap)
+                    return True
+        return False
+
+    def __contains__(self, seq: int) -> bool:
+        return 0 <= seq < self.total_chunks and bool(self.bitmap[seq >> 3] & (1 << (seq & 7)))
+
+    def write(self, seq: int, data: bytes, digest: bytes = None) -> bool:
+        """Grava um bloco; retorna False se ele já tinha sido recebido"""
+        if seq in self:
+            return False
+        os.pwrite(self.fd, data, seq * self.chunk_size)
+        self.bitmap[seq >> 3] |= 1 << (seq & 7)
+        self.received_count += 1
+        if self.state_fd is not None:
+            # sem fsync: se o sistema cair antes dos dados irem para o disco,
+            # verify() encontra o bloco inválido e ele é pedido de novo
+            if digest:
+                os.pwrite(self.state_fd, digest, self._digest_offset(seq))
+            os.pwrite(self.state_fd, self.bitmap[seq >> 3:(seq >> 3) + 1], STATE_HEADER.size + (seq >> 3))
+        if seq == self.next_expected:
+            self.sha256.update(data)
+            self.next_expected += 1
+            self._advance()
+        return True
+
+    def catch_up(self):
+        """Passa pelo hash o prefixo contíguo recebido numa tentativa anterior (lê do disco)"""
+        self._advance()
+
+    def _advance(self):
+        # blocos que chegaram fora de ordem (ou de uma tentativa anterior) são relidos do disco para entrar no hash
+        while self.next_expected in self:
+            offset = self.next_expected * self.chunk_size
+            self.sha256.update(os.pread(self.fd, self.chunk_size, offset))
+            self.next_expected += 1
+
+    def _digest_offset(self, seq: int) -> int:
+        return STATE_HEADER.size + len(self.bitmap) + seq * protocol.CHUNK_HASH_SIZE
+
+    def held_ranges(self, limit: int) -> List[Tuple[int, int]]:
+        """Intervalos de blocos já recebidos, no máximo limit"""
+        return self._ranges(True, limit)
+
+    def missing_ranges(self, limit: int, start: int = 0, end: Optional[int] = None) -> List[Tuple[int, int]]:
+        """Intervalos de blocos que ainda faltam entre start e end (inclusive), no máximo limit"""
+        return self._ranges(False, limit, start, end)
+
+    def _ranges(self, received: bool, limit: int, start: int = 0, end: Optional[int] = None) -> List[Tuple[int, int]]:
+        ranges = []
+        stop = self.total_chunks if end is None else min(end + 1, self.total_chunks)
+        seq = start
+        while seq < stop and len(ranges) < limit:
+            if (seq in self) == received:
+                first = seq
+                while seq + 1 < stop and (seq + 1 in self) == received:
+                    seq += 1
+                ranges.append((first, seq))
+            seq += 1
+        return ranges
+
+    def block_digests(self) -> Optional[bytes]:
+        """Hashes de todos os blocos, como guardados no arquivo de estado"""
+        if self.state_fd is None:
+            return None
+        return os.pread(self.state_fd, self.total_chunks * protocol.CHUNK_HASH_SIZE, self._digest_offset(0))
+
+    @property
+    def resumable(self) -> bool:
+        return self.state_fd is not None
+
+    def verify(self) -> int:
+        """Relê os blocos gravados e descarta os que não batem com o hash guardado; devolve quantos"""
+        if self.state_fd is None:
+            return 0
+        bad = 0
+        for seq in range(self.total_chunks):
+            if seq not in self:
+                continue
+            digest = os.pread(self.state_fd, protocol.CHUNK_HASH_SIZE, self._digest_offset(seq))
+            if not any(digest):
+                continue  # bloco sem hash conhecido; só o SHA-256 final o cobre
+            if protocol.chunk_hash(os.pread(self.fd, self.chunk_size, seq * self.chunk_size)) != digest:
+                self.bitmap[seq >> 3] &= ~(1 << (seq & 7))
+                self.received_count -= 1
+                os.pwrite(self.state_fd, self.bitmap[seq >> 3:(seq >> 3) + 1], STATE_HEADER.size + (seq >> 3))
+                bad += 1
+        if bad:
+            self.sha256 = hashlib.sha256()
+            self.next_expected = 0
+            self._advance()
+        return bad
+
+    @property
+    def complete(self) -> bool:
+        return self.received_count == self.total_chunks
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
+
+    def commit(self, dest_filename: str = None) -> str:
+        """Fecha o arquivo temporário e o renomeia atomicamente para o destino"""
+        dest_filename = dest_filename or self.dest_filename
+        os.fsync(self.fd)
+        # renomeia e apaga o estado ainda com o lock, para ninguém retomar o parcial no meio
+        os.replace(self.temp_filename, dest_filename)
+        self._remove(self.state_filename)
+        self.close()
+        return dest_filename
+
+    def abort(self):
+        """Descarta o arquivo parcial"""
+        if self.state_filename and self.state_fd is None:
+            # já fechado: desde então o parcial pode ter sido retomado por outro receptor
+            try:
+                self.state_fd = self._lock_state()
+            except FileExistsError:
+                self.close()
+                return
+        self._remove(self.temp_filename)
+        self._remove(self.state_filename)
+        self.close()
+
+    def close(self):
+        """Fecha os arquivos; o parcial e o estado continuam no disco para uma retomada"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.state_fd is not None:
+            os.close(self.state_fd)
+            self.state_fd = None
+
+    @staticmethod
+    def _remove(filename: Optional[str]):
+        if not filename:
+            return
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,124 @@
+import hashlib
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# Leitura antecipada: a cada PREFETCH_SIZE bytes consumidos, pede ao kernel o trecho seguinte
+PREFETCH_SIZE = 1024 * 1024
+# Hashes de arquivos já lidos, por (caminho, tamanho, mtime)
+HASH_CACHE_SIZE = 256
+
+_hash_cache: "OrderedDict[tuple, str]" = OrderedDict()
+_hash_lock = threading.Lock()
+
+
+def _cache_key(filename: str) -> tuple:
+    st = os.stat(filename)
+    return (os.path.realpath(filename), st.st_size, st.st_mtime_ns)
+
+
+def cached_hash(filename: str) -> Optional[str]:
+    """SHA-256 já calculado para o conteúdo atual do arquivo, se houver"""
+    try:
+        key = _cache_key(filename)
+    except OSError:
+        return None
+    with _hash_lock:
+        digest = _hash_cache.get(key)
+        if digest is not None:
+            _hash_cache.move_to_end(key)
+        return digest
+
+
+def _store_hash(key: tuple, digest: str):
+    with _hash_lock:
+        _hash_cache[key] = digest
+        _hash_cache.move_to_end(key)
+        while len(_hash_cache) > HASH_CACHE_SIZE:
+            _hash_cache.popitem(last=False)
+
+
+def file_hash(filename: str) -> str:
+    """SHA-256 do arquivo, lido uma única vez pelo mmap; reaproveita o cache se o arquivo não mudou"""
+    digest = cached_hash(filename)
+    if digest is None:
+        source = FileSource(filename, PREFETCH_SIZE)
+        try:
+            digest = source.hexdigest()
+        finally:
+            source.close()
+    return digest
+
+
+class FileSource:
+    """Arquivo de origem de um envio, mapeado em memória.
+
+    chunk() devolve memoryviews do mapeamento, sem copiar; os blocos podem
+    ser relidos a qualquer momento, então as retransmissões não precisam
+    guardar a mensagem montada. O SHA-256 é atualizado conforme os blocos
+    são pedidos em ordem, de modo que no fim da primeira passada o hash já
+    está pronto; hexdigest() só lê o que ainda não passou pelo hash (blocos
+    pulados na retomada, por exemplo). Com hashing=False (o hash já é
+    conhecido, ou não interessa) chunk() não toca no hash. O kernel é
+    avisado do acesso sequencial e o trecho seguinte é pedido antes de ser
+    necessário.
+    """
+
+    def __init__(self, filename: str, chunk_size: int, hashing: bool = True):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.hashing = hashing
+        with open(filename, 'rb') as f:
+            self._key = _cache_key(filename)
+            self.size = os.fstat(f.fileno()).st_size
+            # mmap não aceita tamanho zero
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self.view = memoryview(self.map) if self.map is not None else memoryview(b"")
+        self.sha256 = hashlib.sha256()
+        self.hashed_until = 0
+        self.prefetched_until = 0
+        if self.map is not None and hasattr(mmap, "MADV_SEQUENTIAL"):
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+        self._prefetch(0)
+
+    def chunk(self, seq: int) -> memoryview:
+        """Bloco seq como memoryview do arquivo"""
+        offset = seq * self.chunk_size
+        data = self.view[offset:offset + self.chunk_size]
+        if self.hashing and offset == self.hashed_until:
+            self.sha256.update(data)
+            self.hashed_until += len(data)
+        if offset + self.chunk_size > self.prefetched_until:
+            self._prefetch(offset)
+        return data
+
+    def _prefetch(self, offset: int):
+        if self.map is None or not hasattr(mmap, "MADV_WILLNEED") or offset >= self.size:
+            return
+        start = offset - offset % mmap.PAGESIZE
+        length = min(PREFETCH_SIZE, self.size - start)
+        self.map.madvise(mmap.MADV_WILLNEED, start, length)
+        self.prefetched_until = start + length
+
+    def hexdigest(self) -> str:
+        """Completa o hash com o que ainda não foi lido e o devolve"""
+        while self.hashed_until < self.size:
+            end = min(self.hashed_until + PREFETCH_SIZE, self.size)
+            self.sha256.update(self.view[self.hashed_until:end])
+            self.hashed_until = end
+        digest = self.sha256.hexdigest()
+        _store_hash(self._key, digest)
+        return digest
+
+    def close(self):
+        self.view.release()
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # blocos ainda na fila de envio do socket; o mapeamento é
+                # desfeito quando a última referência sumir
+                pass
+            self.map = None
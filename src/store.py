@@ -0,0 +1,186 @@
+import os
+import struct
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import protocol
+
+# Diretório padrão do índice
+STORE_DIR = ".blocos"
+# Limite do índice em disco (≈ 500 mil hashes de bloco)
+STORE_SIZE = 8 * 1024 * 1024
+# Cabeçalho de cada entrada: tamanho do arquivo, tamanho do bloco, mtime e tamanho do caminho.
+# Depois vêm o caminho e o hash de cada bloco.
+ENTRY_HEADER = struct.Struct("!QIqH")
+ENTRY_SUFFIX = ".idx"
+
+
+class StoredFile:
+    """Arquivo salvo por este dispositivo, conhecido pelo SHA-256 do conteúdo"""
+
+    __slots__ = ("file_hash", "path", "size", "chunk_size", "mtime_ns", "digests", "index_size")
+
+    def __init__(self, file_hash: str, path: str, size: int, chunk_size: int, mtime_ns: int,
+                 digests: bytes, index_size: int = 0):
+        self.file_hash = file_hash
+        self.path = path
+        self.size = size
+        self.chunk_size = chunk_size
+        self.mtime_ns = mtime_ns
+        self.digests = digests
+        self.index_size = index_size
+
+    def block_digests(self):
+        step = protocol.CHUNK_HASH_SIZE
+        for seq in range(len(self.digests) // step):
+            yield seq, self.digests[seq * step:(seq + 1) * step]
+
+    def unchanged(self) -> bool:
+        """O arquivo continua no disco com o conteúdo indexado"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return st.st_size == self.size and st.st_mtime_ns == self.mtime_ns
+
+
+class ChunkStore:
+    """Índice endereçado por conteúdo dos arquivos recebidos e de seus blocos.
+
+    Cada arquivo salvo ganha uma entrada <sha256>.idx no diretório do store
+    com o caminho, o mtime e o hash de cada bloco; em memória, os blocos
+    ficam indexados pelo hash para que um envio posterior encontre, em
+    qualquer arquivo salvo, os blocos que já existem aqui. Entradas cujo
+    arquivo mudou ou sumiu são descartadas ao serem consultadas. O total em
+    disco é limitado a max_bytes; as entradas menos usadas saem primeiro.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = STORE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self._files: "OrderedDict[str, StoredFile]" = OrderedDict()
+        # hash do bloco -> (hash do arquivo, seq)
+        self._blocks: Dict[bytes, Tuple[str, int]] = {}
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.stat(path).st_mtime_ns, self._read_entry(name[:-len(ENTRY_SUFFIX)], path)))
+            except (OSError, ValueError, struct.error):
+                self._remove_entry_file(name[:-len(ENTRY_SUFFIX)])
+        # o mtime da entrada marca o último uso: as mais antigas ficam no começo da fila LRU
+        for _, entry in sorted(entries, key=lambda e: e[0]):
+            self._insert(entry)
+        self._evict()
+
+    @staticmethod
+    def _read_entry(file_hash: str, path: str) -> StoredFile:
+        with open(path, 'rb') as f:
+            data = f.read()
+        size, chunk_size, mtime_ns, path_len = ENTRY_HEADER.unpack_from(data)
+        offset = ENTRY_HEADER.size
+        file_path = data[offset:offset + path_len].decode()
+        digests = data[offset + path_len:]
+        if len(digests) % protocol.CHUNK_HASH_SIZE:
+            raise ValueError("entrada truncada")
+        return StoredFile(file_hash, file_path, size, chunk_size, mtime_ns, digests, len(data))
+
+    def _entry_path(self, file_hash: str) -> str:
+        return os.path.join(self.directory, file_hash + ENTRY_SUFFIX)
+
+    def add(self, path: str, file_hash: str, chunk_size: int, digests: bytes):
+        """Indexa um arquivo recém-salvo; digests são os hashes dos blocos, em ordem"""
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        encoded_path = path.encode()
+        data = ENTRY_HEADER.pack(st.st_size, chunk_size, st.st_mtime_ns, len(encoded_path)) + encoded_path + digests
+        entry = StoredFile(file_hash, path, st.st_size, chunk_size, st.st_mtime_ns, digests, len(data))
+        with self._lock:
+            # o mesmo caminho com outro conteúdo deixa de valer
+            for old in [f for f in self._files.values() if f.path == path or f.file_hash == file_hash]:
+                self._drop(old)
+            with open(self._entry_path(file_hash), 'wb') as f:
+                f.write(data)
+            self._insert(entry)
+            self._evict()
+
+    def _insert(self, entry: StoredFile):
+        self._files[entry.file_hash] = entry
+        self.total_bytes += entry.index_size
+        for seq, digest in entry.block_digests():
+            if any(digest):
+                self._blocks.setdefault(digest, (entry.file_hash, seq))
+
+    def _drop(self, entry: StoredFile):
+        if self._files.pop(entry.file_hash, None) is None:
+            return
+        self.total_bytes -= entry.index_size
+        for _, digest in entry.block_digests():
+            if self._blocks.get(digest, (None,))[0] == entry.file_hash:
+                del self._blocks[digest]
+        self._remove_entry_file(entry.file_hash)
+
+    def _remove_entry_file(self, file_hash: str):
+        try:
+            os.remove(self._entry_path(file_hash))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self._files and self.total_bytes > self.max_bytes:
+            self._drop(next(iter(self._files.values())))
+
+    def _touch(self, entry: StoredFile):
+        if next(reversed(self._files)) == entry.file_hash:
+            return  # já é a mais recente; evita um utime por bloco consultado
+        self._files.move_to_end(entry.file_hash)
+        try:
+            os.utime(self._entry_path(entry.file_hash))
+        except OSError:
+            pass
+
+    def _valid(self, file_hash: str) -> Optional[StoredFile]:
+        entry = self._files.get(file_hash)
+        if entry is not None and not entry.unchanged():
+            self._drop(entry)
+            return None
+        return entry
+
+    def find_file(self, file_hash: str) -> Optional[StoredFile]:
+        """Arquivo salvo com exatamente este conteúdo, se ainda estiver intacto"""
+        with self._lock:
+            entry = self._valid(file_hash)
+            if entry is not None:
+                self._touch(entry)
+            return entry
+
+    def find_block(self, digest: bytes) -> Optional[Tuple[str, int]]:
+        """(caminho, offset) de um bloco salvo com este hash"""
+        with self._lock:
+            location = self._blocks.get(digest)
+            if location is None:
+                return None
+            entry = self._valid(location[0])
+            if entry is None:
+                return None
+            self._touch(entry)
+            return entry.path, location[1] * entry.chunk_size
+
+    def files_named(self, filename: str) -> List[str]:
+        """Arquivos salvos com este nome, do uso mais recente para o mais antigo"""
+        with self._lock:
+            return [entry.path for entry in reversed(self._files.values())
+                    if os.path.basename(entry.path) == filename and entry.unchanged()]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._files)
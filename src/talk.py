@@ -0,0 +1,350 @@
+import asyncio
+import logging
+import secrets
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+import protocol
+from congestion import MAX_RETRIES
+
+log = logging.getLogger(__name__)
+
+# Mensagens para o mesmo peer enviadas dentro desse intervalo saem juntas em um datagrama
+COALESCE_DELAY = 0.002
+# O receptor confirma ACK_DELAY depois da primeira mensagem não confirmada ou a cada
+# ACK_EVERY mensagens, o que vier antes; duplicatas são confirmadas na hora
+ACK_DELAY = 0.01
+ACK_EVERY = 16
+# Mensagens sem confirmação por sessão; é também a janela de duplicatas do receptor
+TALK_WINDOW = 1024
+MAX_ACK_RANGES = 4
+# Espaço reservado em cada lote para a confirmação que pode ir junto
+ACK_ROOM = protocol.TALK_ACK.size + MAX_ACK_RANGES * protocol.SACK_RANGE.size
+MAX_MESSAGE = (protocol.MAX_DATAGRAM - protocol.HEADER.size - protocol.TALK_BATCH.size - ACK_ROOM
+               - protocol.COUNT.size)
+
+
+@dataclass
+class OutgoingSession:
+    """Mensagens enviadas a um peer"""
+    session_id: str
+    addr: tuple
+    # maior lote que cabe em um datagrama sem fragmentar
+    limit: int
+    next_seq: int = 0
+    # seq -> [mensagem, instante do primeiro envio, retransmitida], em ordem de seq
+    unacked: Dict[int, list] = field(default_factory=dict)
+    # seqs acima da confirmação cumulativa que o peer já tem (SACK)
+    sacked: Set[int] = field(default_factory=set)
+    queue: Deque[bytes] = field(default_factory=deque)
+    queued_bytes: int = 0
+    retries: int = 0
+    flush_timer: Optional[asyncio.TimerHandle] = None
+    retransmit_timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def base(self) -> int:
+        """Menor seq ainda sem confirmação; tudo abaixo já está resolvido"""
+        return next(iter(self.unacked), self.next_seq)
+
+
+@dataclass
+class IncomingSession:
+    """Mensagens recebidas de um peer"""
+    session_id: str
+    # todas as mensagens abaixo de next_seq já chegaram
+    next_seq: int = 0
+    # recebidas acima de next_seq, no máximo TALK_WINDOW adiante
+    above: Set[int] = field(default_factory=set)
+    unacked: int = 0
+    ack_timer: Optional[asyncio.TimerHandle] = None
+
+
+class TalkSessions:
+    """Mensagens TALK para peers binários, em sessões com números de sequência por peer.
+
+    Cada peer tem uma sessão de envio, com id de 64 bits e seqs consecutivos
+    a partir de zero. Mensagens enviadas em até COALESCE_DELAY saem juntas
+    em um único TALK, até o MTU do caminho. O receptor guarda a confirmação
+    cumulativa e os seqs recebidos acima dela, o que descarta as
+    retransmissões já exibidas, e confirma com atraso, muitas mensagens de
+    uma vez; se tiver algo a mandar para o mesmo peer antes disso, a
+    confirmação vai junto do lote. O remetente reenvia, no prazo do RTT do
+    peer, só o que o receptor ainda não tem.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.outgoing: Dict[tuple, OutgoingSession] = {}
+        self.incoming: Dict[tuple, IncomingSession] = {}
+
+    def stop(self):
+        for s in self.outgoing.values():
+            self._cancel_timers(s)
+        for peer in self.incoming.values():
+            if peer.ack_timer:
+                peer.ack_timer.cancel()
+        self.outgoing.clear()
+        self.incoming.clear()
+
+    def forget(self, addr: tuple):
+        """O peer saiu: descarta o estado de recepção e a sessão de envio, se não houver pendências"""
+        peer = self.incoming.pop(addr, None)
+        if peer and peer.ack_timer:
+            peer.ack_timer.cancel()
+        s = self.outgoing.get(addr)
+        if s and not s.unacked and not s.queue:
+            self._cancel_timers(s)
+            del self.outgoing[addr]
+
+    @staticmethod
+    def _cancel_timers(s: OutgoingSession):
+        for timer in (s.flush_timer, s.retransmit_timer):
+            if timer:
+                timer.cancel()
+        s.flush_timer = s.retransmit_timer = None
+
+    def _peer_name(self, addr: tuple) -> str:
+        info = self.device.known_devices.by_addr(addr)
+        return info.name if info else f"{addr[0]}:{addr[1]}"
+
+    # --- envio ---
+
+    def send(self, addr: tuple, message: bytes) -> bool:
+        """Enfileira uma mensagem; o lote sai ao fim da janela de agrupamento ou quando enche"""
+        if len(message) > MAX_MESSAGE:
+            print(f"Mensagem grande demais ({len(message)} bytes; máximo {MAX_MESSAGE})")
+            return False
+        s = self.outgoing.get(addr)
+        if s is not None and not s.unacked and not s.queue and self._realign(s):
+            self._cancel_timers(s)
+            s = None
+        if s is None:
+            limit = (protocol.path_mtu(addr) - protocol.IP_UDP_OVERHEAD - protocol.HEADER.size
+                     - protocol.TALK_BATCH.size - ACK_ROOM)
+            s = self.outgoing[addr] = OutgoingSession(self._new_session_id(addr), addr, limit)
+        s.queue.append(message)
+        s.queued_bytes += protocol.COUNT.size + len(message)
+        if s.queued_bytes >= s.limit:
+            self._flush(s)
+        elif s.flush_timer is None:
+            s.flush_timer = self.device.loop.call_later(COALESCE_DELAY, self._flush, s)
+        return True
+
+    def _new_session_id(self, addr: tuple) -> str:
+        index, shards = self.device.shard
+        peer = self.incoming.get(addr)
+        if peer is not None:
+            low = int(peer.session_id, 16) & 0xFFFFFFFF
+            if low % shards == index:
+                # mesmos 32 bits baixos da sessão do peer: nos dois lados, o lote e a
+                # confirmação que vai junto dele caem no mesmo worker de um DeviceCluster
+                return protocol.format_id((secrets.randbits(32) << 32) | low)
+        return protocol.new_transfer_id(index, shards)
+
+    def _realign(self, s: OutgoingSession) -> bool:
+        """A sessão ociosa deve ser trocada por uma com os 32 bits baixos da sessão do peer?
+
+        Só o lado com os bits maiores troca, para os dois não ficarem trocando um
+        pelo outro. Sem o alinhamento, as confirmações não vão junto dos lotes.
+        """
+        peer = self.incoming.get(s.addr)
+        if peer is None:
+            return False
+        low = int(peer.session_id, 16) & 0xFFFFFFFF
+        index, shards = self.device.shard
+        return low < int(s.session_id, 16) & 0xFFFFFFFF and low % shards == index
+
+    def _flush(self, s: OutgoingSession):
+        if s.flush_timer:
+            s.flush_timer.cancel()
+            s.flush_timer = None
+        now = self.device.loop.time()
+        batch: List[bytes] = []
+        size = 0
+        first = s.next_seq
+        while s.queue and len(s.unacked) < TALK_WINDOW:
+            entry = protocol.COUNT.size + len(s.queue[0])
+            if batch and size + entry > s.limit:
+                self._send_batch(s, first, batch)
+                batch, size, first = [], 0, s.next_seq
+            message = s.queue.popleft()
+            s.queued_bytes -= entry
+            s.unacked[s.next_seq] = [message, now, False]
+            s.next_seq += 1
+            batch.append(message)
+            size += entry
+        if batch:
+            self._send_batch(s, first, batch)
+        if s.unacked and s.retransmit_timer is None:
+            self._arm_retransmit(s)
+
+    def _send_batch(self, s: OutgoingSession, first: int, messages: List[bytes]):
+        flags = protocol.FLAG_SESSION
+        payload = protocol.encode_talk_batch(s.base, first, messages)
+        ack = self._piggyback(s)
+        if ack:
+            flags |= protocol.FLAG_CHUNK_ACK
+            payload = ack + payload
+        self.device._sendto(protocol.encode(protocol.TALK, s.session_id, len(messages), payload, flags), s.addr)
+
+    def _piggyback(self, s: OutgoingSession) -> bytes:
+        """Confirmação pendente para o peer, se ela puder ir dentro do lote"""
+        peer = self.incoming.get(s.addr)
+        if peer is None or not peer.unacked:
+            return b""
+        if (int(peer.session_id, 16) ^ int(s.session_id, 16)) & 0xFFFFFFFF:
+            # num DeviceCluster do outro lado, o lote iria para um worker que não conhece a sessão
+            return b""
+        return self._ack_payload(peer)
+
+    def _arm_retransmit(self, s: OutgoingSession):
+        timeout = self.device._rtt_for(s.addr).timeout(s.retries)
+        s.retransmit_timer = self.device.loop.call_later(timeout, self._on_retransmit, s)
+
+    def _on_retransmit(self, s: OutgoingSession):
+        s.retransmit_timer = None
+        if self.outgoing.get(s.addr) is not s or not s.unacked:
+            return
+        if s.retries >= MAX_RETRIES:
+            print(f"{len(s.unacked)} mensagem(ns) para {self._peer_name(s.addr)} não confirmada(s) "
+                  f"após {s.retries + 1} tentativas")
+            # o próximo lote leva a nova base e o receptor deixa de esperar por elas
+            s.unacked.clear()
+            s.sacked.clear()
+            s.retries = 0
+            if s.queue:
+                self._flush(s)
+            return
+        s.retries += 1
+        self.device.metrics.retransmitted(s.addr, count=len(s.unacked) - len(s.sacked))
+        batch: List[bytes] = []
+        size = first = previous = 0
+        for seq, entry in s.unacked.items():
+            if seq in s.sacked:
+                continue
+            entry[2] = True
+            length = protocol.COUNT.size + len(entry[0])
+            if batch and (seq != previous + 1 or size + length > s.limit):
+                self._send_batch(s, first, batch)
+                batch, size = [], 0
+            if not batch:
+                first = seq
+            batch.append(entry[0])
+            size += length
+            previous = seq
+        if batch:
+            self._send_batch(s, first, batch)
+        self._arm_retransmit(s)
+
+    def handle_ack(self, payload: bytes, addr: tuple):
+        session_id, cum, ranges, _ = protocol.decode_talk_ack(payload)
+        self._on_ack(protocol.format_id(session_id), cum, ranges, addr)
+
+    def _on_ack(self, session_id: str, cum: int, ranges: List[Tuple[int, int]], addr: tuple):
+        s = self.outgoing.get(addr)
+        if s is None or s.session_id != session_id:
+            return
+        acked = []
+        for seq in s.unacked:
+            if seq >= cum:
+                break
+            acked.append(seq)
+        now = self.device.loop.time()
+        sample = None
+        for seq in acked:
+            _, sent_at, retransmitted = s.unacked.pop(seq)
+            if not retransmitted:
+                # algoritmo de Karn: só mede RTT de mensagens não retransmitidas
+                sample = now - sent_at
+        s.sacked = {seq for seq in s.sacked if seq >= cum}
+        for a, b in ranges:
+            s.sacked.update(seq for seq in range(max(a, cum), b + 1) if seq in s.unacked)
+        if not acked:
+            return
+        if sample is not None:
+            self.device._rtt_for(addr).update(sample)
+        s.retries = 0
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Mensagens %d-%d para %s confirmadas", acked[0], acked[-1], self._peer_name(addr))
+        if s.retransmit_timer:
+            s.retransmit_timer.cancel()
+            s.retransmit_timer = None
+        if s.queue and s.flush_timer is None:
+            self._flush(s)
+        elif s.unacked:
+            self._arm_retransmit(s)
+
+    # --- recepção ---
+
+    def handle_batch(self, packet: protocol.Packet, addr: tuple):
+        payload = packet.payload
+        offset = 0
+        if packet.flags & protocol.FLAG_CHUNK_ACK:
+            session_id, cum, ranges, offset = protocol.decode_talk_ack(payload)
+            self._on_ack(protocol.format_id(session_id), cum, ranges, addr)
+        base, first, messages = protocol.decode_talk_batch(payload, offset)
+        peer = self.incoming.get(addr)
+        if peer is None or peer.session_id != packet.msg_id:
+            # primeira mensagem do peer ou sessão nova (o peer reiniciou)
+            if peer and peer.ack_timer:
+                peer.ack_timer.cancel()
+            peer = self.incoming[addr] = IncomingSession(packet.msg_id, base)
+        if base > peer.next_seq:
+            # o remetente desistiu das mensagens abaixo de base
+            peer.next_seq = base
+            peer.above = {seq for seq in peer.above if seq >= base}
+            self._advance(peer)
+        duplicates = 0
+        for seq, data in enumerate(messages, first):
+            if seq < peer.next_seq or seq in peer.above:
+                duplicates += 1
+                continue
+            if seq >= peer.next_seq + TALK_WINDOW:
+                continue  # além da janela: o remetente reenvia quando ela andar
+            if seq == peer.next_seq:
+                peer.next_seq += 1
+                self._advance(peer)
+            else:
+                peer.above.add(seq)
+            peer.unacked += 1
+            self.device._show_talk(data.decode(errors="replace"), addr)
+        if duplicates:
+            self.device.metrics.duplicate(addr, count=duplicates)
+        if duplicates or peer.unacked >= ACK_EVERY:
+            # duplicata: a confirmação anterior se perdeu e o remetente está reenviando
+            self._send_ack(peer, addr)
+        elif peer.unacked and peer.ack_timer is None:
+            peer.ack_timer = self.device.loop.call_later(ACK_DELAY, self._on_ack_timer, peer, addr)
+
+    @staticmethod
+    def _advance(peer: IncomingSession):
+        while peer.next_seq in peer.above:
+            peer.above.remove(peer.next_seq)
+            peer.next_seq += 1
+
+    def _on_ack_timer(self, peer: IncomingSession, addr: tuple):
+        peer.ack_timer = None
+        if self.incoming.get(addr) is peer and peer.unacked:
+            self._send_ack(peer, addr)
+
+    def _ack_payload(self, peer: IncomingSession) -> bytes:
+        if peer.ack_timer:
+            peer.ack_timer.cancel()
+            peer.ack_timer = None
+        peer.unacked = 0
+        ranges = []
+        for seq in sorted(peer.above):
+            if ranges and seq == ranges[-1][1] + 1:
+                ranges[-1][1] = seq
+            elif len(ranges) < MAX_ACK_RANGES:
+                ranges.append([seq, seq])
+            else:
+                break
+        return protocol.encode_talk_ack(int(peer.session_id, 16), peer.next_seq, ranges)
+
+    def _send_ack(self, peer: IncomingSession, addr: tuple):
+        ack = protocol.encode(protocol.ACK, peer.session_id, payload=self._ack_payload(peer),
+                              flags=protocol.FLAG_SESSION)
+        self.device._sendto(ack, addr)
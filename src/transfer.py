@@ -0,0 +1,352 @@
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from asyncio import TimerHandle
+from typing import Deque, Dict, Iterator, List, Optional, Set
+
+from congestion import CongestionControl, RttEstimator
+from receiver import FileReceiver
+from source import FileSource
+
+# Estados de uma transferência
+AGUARDANDO = "aguardando"    # FILE enviado, esperando o ACK do receptor
+COMPARANDO = "comparando"    # receptor procurando em arquivos locais os blocos que já tem
+RETOMANDO = "retomando"      # receptor relendo o que já tinha recebido de uma tentativa anterior
+NA_FILA = "na_fila"          # limite de transferências simultâneas atingido
+ATIVA = "ativa"
+PAUSADA = "pausada"
+FINALIZANDO = "finalizando"  # todos os blocos confirmados, esperando o ACK do END
+CONCLUIDA = "concluida"
+FALHOU = "falhou"
+CANCELADA = "cancelada"
+
+FINAL_STATES = (CONCLUIDA, FALHOU, CANCELADA)
+
+MAX_ACTIVE_TRANSFERS = 8
+MAX_INCOMING_TRANSFERS = 32
+MAX_BYTES_IN_FLIGHT = 8 * 1024 * 1024
+SCHEDULER_QUANTUM = 64 * 1024
+
+
+@dataclass
+class OutgoingTransfer:
+    msg_id: str
+    filename: str
+    filesize: int
+    target_name: str
+    addr: tuple
+    binary: bool
+    chunk_size: int
+    window: int
+    rtt: RttEstimator
+    cc: CongestionControl = field(default_factory=CongestionControl)
+    status: str = AGUARDANDO
+    next_seq: int = 0
+    acked_until: int = 0
+    highest_sacked: int = -1
+    dup_acks: int = 0
+    source: Optional[FileSource] = None
+    # SHA-256 do arquivo, calculado antes do FILE quando o destino entende o formato binário
+    file_hash: Optional[str] = None
+    # codecs oferecidos no FILE e o escolhido pelo receptor (0: sem compressão)
+    codecs: List[int] = field(default_factory=list)
+    codec: int = 0
+    # seq -> (timer de retransmissão, tentativas, instante do envio); a mensagem é remontada a partir do arquivo
+    pending_chunks: Dict[int, tuple] = field(default_factory=dict)
+    # blocos que o receptor já tinha de uma tentativa anterior e não precisam ser enviados
+    held: Set[int] = field(default_factory=set)
+    # blocos que o receptor pediu de novo depois do END (corrompidos no disco dele)
+    repair: Deque[int] = field(default_factory=deque)
+    # transferência delta: assinatura dos blocos, páginas pedidas antes de ela ficar
+    # pronta e o prazo para reenviar o FILE enquanto o receptor compara
+    signatures: Optional[bytes] = None
+    sig_waiting: Set[int] = field(default_factory=set)
+    delta_timer: Optional[TimerHandle] = None
+
+    @property
+    def total_chunks(self) -> int:
+        return (self.filesize + self.chunk_size - 1) // self.chunk_size
+
+    @property
+    def bytes_in_flight(self) -> int:
+        return len(self.pending_chunks) * self.chunk_size
+
+    def has_chunks(self) -> bool:
+        return bool(self.repair) or self.next_seq < self.total_chunks
+
+    def take_next_seq(self) -> int:
+        """Próximo bloco a enviar: primeiro os reparos, depois os novos que o receptor ainda não tem"""
+        if self.repair:
+            return self.repair.popleft()
+        seq = self.next_seq
+        self.skip_held(seq + 1)
+        return seq
+
+    def skip_held(self, seq: int):
+        while seq in self.held:
+            seq += 1
+        self.next_seq = seq
+
+    def window_open(self) -> bool:
+        """Há bloco para enviar e espaço na janela (menor entre a do receptor e a de congestionamento)"""
+        return (self.status == ATIVA and self.has_chunks()
+                and len(self.pending_chunks) < min(self.window, max(1, int(self.cc.cwnd))))
+
+    def can_send(self) -> bool:
+        return self.window_open() and self.cc.pacing_delay(self.rtt.srtt) == 0
+
+    def progress(self) -> int:
+        return min(self.acked_until * self.chunk_size, self.filesize)
+
+
+@dataclass
+class IncomingTransfer:
+    msg_id: str
+    filename: str
+    filesize: int
+    addr: tuple
+    binary: bool
+    # None enquanto o conteúdo é copiado de um arquivo local idêntico (nenhum parcial é criado)
+    receiver: Optional[FileReceiver]
+    status: str = ATIVA
+    codec: int = 0
+    file_hash: Optional[bytes] = None
+    # bloco aceito no FILE; com um receiver, vale o dele (a retomada pode usar um menor)
+    chunk_size: int = 0
+    # transferência delta: páginas da assinatura recebidas e pedidas (timer, tentativas)
+    signatures: Dict[int, bytes] = field(default_factory=dict)
+    sig_requests: Dict[int, tuple] = field(default_factory=dict)
+    next_sig_page: int = 0
+    # envio para vários destinos: grupo multicast anunciado no FILE, se este lado entrou
+    # nele e relatórios de blocos faltantes, enviados em lote em vez de um ACK por bloco
+    group: Optional[tuple] = None
+    joined: bool = False
+    highest_seq: int = -1
+    unreported: int = 0
+    report_timer: Optional[TimerHandle] = None
+
+    @property
+    def total_chunks(self) -> int:
+        return self.receiver.total_chunks
+
+    @property
+    def committed(self) -> bool:
+        return self.status == CONCLUIDA
+
+    def progress(self) -> int:
+        if self.receiver is None:
+            return self.filesize if self.committed else 0
+        return min(self.receiver.received_count * self.receiver.chunk_size, self.filesize)
+
+
+@dataclass
+class GroupMember:
+    """Um destino de um envio para vários dispositivos"""
+    name: str
+    addr: tuple
+    rtt: RttEstimator
+    status: str = AGUARDANDO
+    # recebe os blocos novos pelo grupo multicast; senão, por unicast
+    joined: bool = False
+    # próximo bloco esperado, segundo o último relatório
+    cum: int = 0
+    held: Set[int] = field(default_factory=set)
+    window: int = 0
+    last_report: float = 0.0
+    # retransmissão do FILE ou do END para este destino
+    retries: int = 0
+    timer: Optional[TimerHandle] = None
+    sent_at: float = 0.0
+
+
+@dataclass
+class GroupTransfer:
+    """Um arquivo enviado a vários destinos com o mesmo id: cada bloco é lido e montado uma vez"""
+    msg_id: str
+    filename: str
+    filesize: int
+    chunk_size: int
+    members: Dict[tuple, GroupMember]
+    # (endereço, porta) do grupo multicast, ou None para só unicast
+    group: Optional[tuple]
+    cc: CongestionControl = field(default_factory=CongestionControl)
+    binary: bool = True
+    status: str = AGUARDANDO
+    file_hash: Optional[str] = None
+    codecs: List[int] = field(default_factory=list)
+    codec: int = 0
+    source: Optional[FileSource] = None
+    next_seq: int = 0
+    # fila única de reparo: cada bloco entra uma vez, com os destinos que o pediram
+    repair: Deque[int] = field(default_factory=deque)
+    repair_for: Dict[int, Set[tuple]] = field(default_factory=dict)
+    # seq -> (instante, destinos) do último reparo, para não repetir um reparo ainda em trânsito
+    repaired: Dict[int, tuple] = field(default_factory=dict)
+    # datagramas de bloco enviados, somando grupo e unicast
+    datagrams: int = 0
+    pacing_timer: Optional[TimerHandle] = None
+    # sonda perdas que nenhum relatório cobre (fim da janela ou do arquivo)
+    probe_timer: Optional[TimerHandle] = None
+    probe_floor: int = 0
+
+    @property
+    def total_chunks(self) -> int:
+        return (self.filesize + self.chunk_size - 1) // self.chunk_size
+
+    def active_members(self) -> List[GroupMember]:
+        return [m for m in self.members.values() if m.status not in FINAL_STATES]
+
+    def progress(self) -> int:
+        """Bytes que todos os destinos ainda ativos ou concluídos já têm"""
+        done = [self.total_chunks if m.status == CONCLUIDA else m.cum
+                for m in self.members.values() if m.status not in (FALHOU, CANCELADA)]
+        return min(min(done, default=0) * self.chunk_size, self.filesize)
+
+
+class TransferManager:
+    """Guarda as transferências por id e reparte a capacidade de envio entre os peers.
+
+    O escalonamento é um deficit round robin em dois níveis: cada peer recebe
+    um quantum de bytes por rodada e, dentro do peer, as transferências se
+    revezam. Assim um peer com muitas transferências não ganha mais banda que
+    os outros.
+    """
+
+    def __init__(self, max_active: int = MAX_ACTIVE_TRANSFERS,
+                 max_incoming: int = MAX_INCOMING_TRANSFERS,
+                 max_bytes_in_flight: int = MAX_BYTES_IN_FLIGHT,
+                 quantum: int = SCHEDULER_QUANTUM):
+        self.max_active = max_active
+        self.max_incoming = max_incoming
+        self.max_bytes_in_flight = max_bytes_in_flight
+        self.quantum = quantum
+        self.outgoing: Dict[str, OutgoingTransfer] = {}
+        self.incoming: Dict[str, IncomingTransfer] = {}
+        self.bytes_in_flight = 0
+        self.active_count = 0
+        self.queue: Deque[OutgoingTransfer] = deque()
+        # addr -> fila de transferências do peer; a ordem do dict é o anel de peers
+        self.peers: "OrderedDict[tuple, Deque[OutgoingTransfer]]" = OrderedDict()
+        self.deficits: Dict[tuple, int] = {}
+
+    def add_outgoing(self, transfer: OutgoingTransfer) -> bool:
+        """Registra um envio; retorna False se ele precisa esperar na fila"""
+        self.outgoing[transfer.msg_id] = transfer
+        if self.active_count >= self.max_active:
+            transfer.status = NA_FILA
+            self.queue.append(transfer)
+            return False
+        self._admit(transfer)
+        return True
+
+    def _admit(self, transfer: OutgoingTransfer):
+        transfer.status = AGUARDANDO
+        self.active_count += 1
+        self.peers.setdefault(transfer.addr, deque()).append(transfer)
+        self.deficits.setdefault(transfer.addr, 0)
+
+    def release(self, transfer: OutgoingTransfer, status: str) -> List[OutgoingTransfer]:
+        """Encerra um envio e devolve os que saíram da fila para ocupar a vaga"""
+        if transfer.status in FINAL_STATES:
+            return []
+        was_queued = transfer.status == NA_FILA
+        transfer.status = status
+        self.chunks_done(len(transfer.pending_chunks) * transfer.chunk_size)
+        if was_queued:
+            self.queue.remove(transfer)
+            return []
+        self.active_count -= 1
+        ring = self.peers.get(transfer.addr)
+        if ring is not None:
+            ring.remove(transfer)
+            if not ring:
+                del self.peers[transfer.addr]
+                del self.deficits[transfer.addr]
+        promoted = []
+        while self.queue and self.active_count < self.max_active:
+            next_transfer = self.queue.popleft()
+            self._admit(next_transfer)
+            promoted.append(next_transfer)
+        return promoted
+
+    def can_accept_incoming(self) -> bool:
+        active = sum(1 for t in self.incoming.values() if t.status in (ATIVA, COMPARANDO, RETOMANDO))
+        return active < self.max_incoming
+
+    def chunk_sent(self, nbytes: int):
+        self.bytes_in_flight += nbytes
+
+    def chunks_done(self, nbytes: int):
+        self.bytes_in_flight = max(0, self.bytes_in_flight - nbytes)
+
+    def schedule(self) -> Iterator[OutgoingTransfer]:
+        """Gera, em ordem justa, a transferência que deve enviar o próximo bloco.
+
+        Quem consome o gerador envia exatamente um bloco da transferência
+        recebida e chama chunk_sent() antes de pedir a próxima.
+        """
+        while self.peers and self.bytes_in_flight < self.max_bytes_in_flight:
+            eligible = False
+            for addr in list(self.peers):
+                ring = self.peers.get(addr)
+                if not ring:
+                    continue
+                if not any(t.can_send() for t in ring):
+                    # peer sem nada para enviar não acumula crédito
+                    self.deficits[addr] = 0
+                    continue
+                eligible = True
+                self.deficits[addr] += self.quantum
+                while self.bytes_in_flight < self.max_bytes_in_flight:
+                    transfer = self._next_in_ring(ring)
+                    if transfer is None or self.deficits[addr] < transfer.chunk_size:
+                        break
+                    self.deficits[addr] -= transfer.chunk_size
+                    yield transfer
+                    if addr not in self.peers:
+                        # o consumidor encerrou a última transferência do peer (erro no envio)
+                        break
+                if addr in self.peers:
+                    self.peers.move_to_end(addr)
+            if not eligible:
+                return
+
+    def pacing_delay(self) -> Optional[float]:
+        """Menor espera até alguma transferência bloqueada só pelo pacing poder enviar"""
+        if self.bytes_in_flight >= self.max_bytes_in_flight:
+            return None
+        now = time.monotonic()
+        delays = [t.cc.pacing_delay(t.rtt.srtt, now)
+                  for ring in self.peers.values() for t in ring if t.window_open()]
+        return min(delays) if delays else None
+
+    def _next_in_ring(self, ring: Deque[OutgoingTransfer]) -> Optional[OutgoingTransfer]:
+        for _ in range(len(ring)):
+            transfer = ring[0]
+            ring.rotate(-1)
+            if transfer.can_send():
+                return transfer
+        return None
+
+    def find(self, msg_id: str):
+        """Procura a transferência pelo id completo ou por um prefixo único"""
+        if msg_id in self.outgoing:
+            return self.outgoing[msg_id]
+        if msg_id in self.incoming:
+            return self.incoming[msg_id]
+        matches = [t for t in list(self.outgoing.values()) + list(self.incoming.values())
+                   if t.msg_id.startswith(msg_id)]
+        return matches[0] if len(matches) == 1 else None
+
+    def list(self) -> List[dict]:
+        """Resumo de todas as transferências conhecidas"""
+        result = []
+        for t in self.outgoing.values():
+            result.append({'id': t.msg_id, 'direcao': 'envio', 'arquivo': t.filename,
+                           'peer': t.target_name, 'status': t.status,
+                           'bytes': t.progress(), 'tamanho': t.filesize})
+        for t in self.incoming.values():
+            result.append({'id': t.msg_id, 'direcao': 'recebimento', 'arquivo': t.filename,
+                           'peer': f"{t.addr[0]}:{t.addr[1]}", 'status': t.status,
+                           'bytes': t.progress(), 'tamanho': t.filesize})
+        return result
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# os módulos do projeto são importados direto de src/, como em `python src/main.py`
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
@@ -0,0 +1,62 @@
+import cluster
+import transfer
+from membership import Membership
+
+
+class FakeDevice:
+    def __init__(self):
+        self.known_devices = Membership()
+        self.running = True
+        self.transfers = {}
+
+    def list_transfers(self):
+        return [dict(t) for t in self.transfers.values()]
+
+    def _call_in_loop(self, func, *args):
+        return func(*args)
+
+
+class CountingDict(dict):
+    """Faz o papel do dicionário do Manager e conta o que passa por ele"""
+
+    def __init__(self):
+        super().__init__()
+        self.updated = 0
+
+    def update(self, other):
+        self.updated += len(other)
+        super().update(other)
+
+
+def add(device: FakeDevice, msg_id: str, status: str):
+    device.transfers[msg_id] = {'id': msg_id, 'direcao': 'envio', 'arquivo': 'a.bin', 'peer': 'b',
+                                'status': status, 'bytes': 0, 'tamanho': 10}
+
+
+def test_sync_pushes_only_changes():
+    device, shared = FakeDevice(), CountingDict()
+    sync = cluster._WorkerSync(device, 1, {}, shared)
+    add(device, "t1", transfer.ATIVA)
+    add(device, "t2", transfer.ATIVA)
+    sync.sync()
+    assert shared.updated == 2 and shared["t1"]["worker"] == 1
+    sync.sync()
+    assert shared.updated == 2
+    device.transfers["t1"]["bytes"] = 5
+    sync.sync()
+    assert shared.updated == 3 and shared["t1"]["bytes"] == 5
+
+
+def test_finished_transfers_are_retired(monkeypatch):
+    monkeypatch.setattr(cluster, "FINISHED_RETENTION", 2)
+    device, shared = FakeDevice(), CountingDict()
+    sync = cluster._WorkerSync(device, 1, {}, shared)
+    add(device, "ativa", transfer.ATIVA)
+    for i in range(4):
+        add(device, f"t{i}", transfer.CONCLUIDA)
+        sync.sync()
+    assert set(shared) == {"ativa", "t2", "t3"}
+    # as retiradas continuam no worker, mas não voltam para o coordenador
+    sync.sync()
+    assert set(shared) == {"ativa", "t2", "t3"}
+    assert len(sync.pushed) == 3
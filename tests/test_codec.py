@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+import codec
+
+TEXT = b"linha de texto que se repete bastante\n" * 200
+
+
+@pytest.mark.parametrize("name", [codec.NAMES[c] for c in codec.available()] + ["none"])
+def test_round_trip(name):
+    chosen = codec.parse(name)
+    packed = codec.compress(chosen, TEXT)
+    if chosen != codec.STORED:
+        assert len(packed) < len(TEXT)
+    assert codec.decompress(chosen, packed, len(TEXT)) == TEXT
+
+
+@pytest.mark.parametrize("chosen", codec.available())
+def test_decompress_refuses_oversized_output(chosen):
+    packed = codec.compress(chosen, TEXT)
+    with pytest.raises(Exception):
+        codec.decompress(chosen, packed, len(TEXT) // 2)
+
+
+def test_decompress_rejects_truncated_zlib():
+    packed = codec.compress(codec.ZLIB, TEXT)
+    with pytest.raises(ValueError):
+        codec.decompress(codec.ZLIB, packed[:len(packed) // 2], len(TEXT))
+
+
+def test_parse():
+    assert codec.parse("auto") in codec.available()
+    assert codec.parse("none") == codec.STORED
+    with pytest.raises(ValueError):
+        codec.parse("brotli")
+
+
+def test_offer(tmp_path):
+    text = tmp_path / "texto.txt"
+    text.write_bytes(TEXT * 10)
+    noise = tmp_path / "ruido.bin"
+    noise.write_bytes(os.urandom(200_000))
+    empty = tmp_path / "vazio"
+    empty.write_bytes(b"")
+    assert codec.offer(str(text), codec.ZLIB) == [codec.ZLIB]
+    assert codec.offer(str(noise), codec.ZLIB) == []
+    assert codec.offer(str(empty), codec.ZLIB) == []
+    assert codec.offer(str(text), codec.STORED) == []
+    if codec.LZMA in codec.available():
+        assert codec.offer(str(text), codec.LZMA) == [codec.LZMA, codec.ZLIB]
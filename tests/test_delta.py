@@ -0,0 +1,127 @@
+import hashlib
+import os
+import random
+import socket
+import time
+
+import delta
+import protocol
+import transfer
+from device import Device
+from store import ChunkStore
+
+CHUNK = 64
+
+
+def write(path, data: bytes) -> str:
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_shifted_blocks_are_found(tmp_path):
+    rng = random.Random(1)
+    old = bytes(rng.getrandbits(8) for _ in range(20 * CHUNK))
+    # inserção no começo: todos os blocos do arquivo novo aparecem deslocados na versão antiga
+    new = old[7:] + b"fim"
+    base = write(tmp_path / "antigo.bin", old)
+    signatures = delta.signature(write(tmp_path / "novo.bin", new), CHUNK)
+    found = delta.find_blocks(signatures, CHUNK, len(new), [base])
+    full_blocks = len(new) // CHUNK
+    assert sorted(found) == list(range(full_blocks))
+    for seq, (path, offset) in found.items():
+        assert path == base
+        assert offset == seq * CHUNK + 7
+        digest = protocol.SIG_ENTRY.unpack_from(signatures, seq * protocol.SIG_ENTRY.size)[1]
+        assert delta.read_block(path, offset, CHUNK, digest) == new[seq * CHUNK:(seq + 1) * CHUNK]
+
+
+def test_rolling_checksum_matches_direct_adler32(tmp_path):
+    rng = random.Random(2)
+    data = bytes(rng.getrandbits(8) for _ in range(4 * CHUNK))
+    base = write(tmp_path / "base.bin", data)
+    # um bloco por deslocamento: cada um só é achado se o Adler-32 deslizante bater com o calculado direto
+    for shift in (1, 13, CHUNK - 1, 2 * CHUNK + 5):
+        block = data[shift:shift + CHUNK]
+        signatures = delta.signature(write(tmp_path / "bloco.bin", block), CHUNK)
+        assert delta.find_blocks(signatures, CHUNK, CHUNK, [base]) == {0: (base, shift)}
+
+
+def test_budget_limits_rolling_to_aligned_blocks(tmp_path):
+    rng = random.Random(3)
+    old = bytes(rng.getrandbits(8) for _ in range(8 * CHUNK))
+    base = write(tmp_path / "antigo.bin", old)
+    shifted = delta.signature(write(tmp_path / "deslocado.bin", old[3:3 + 2 * CHUNK]), CHUNK)
+    assert delta.find_blocks(shifted, CHUNK, 2 * CHUNK, [base], budget=0) == {}
+    aligned = delta.signature(write(tmp_path / "alinhado.bin", old[2 * CHUNK:4 * CHUNK]), CHUNK)
+    assert delta.find_blocks(aligned, CHUNK, 2 * CHUNK, [base], budget=0) == {0: (base, 2 * CHUNK),
+                                                                              1: (base, 3 * CHUNK)}
+
+
+def test_store_provides_last_short_block(tmp_path):
+    data = os.urandom(3 * CHUNK + 10)
+    saved = write(tmp_path / "salvo.bin", data)
+    store = ChunkStore(str(tmp_path / "blocos"))
+    digests = b"".join(protocol.chunk_hash(data[i:i + CHUNK]) for i in range(0, len(data), CHUNK))
+    store.add(saved, hashlib.sha256(data).hexdigest(), CHUNK, digests)
+    signatures = delta.signature(write(tmp_path / "novo.bin", data), CHUNK)
+    found = delta.find_blocks(signatures, CHUNK, len(data), [], store)
+    assert found == {seq: (saved, seq * CHUNK) for seq in range(4)}
+
+
+def test_read_block_rejects_changed_data(tmp_path):
+    data = os.urandom(2 * CHUNK)
+    path = write(tmp_path / "base.bin", data)
+    digest = protocol.chunk_hash(data[:CHUNK])
+    assert delta.read_block(path, 0, CHUNK, digest) == data[:CHUNK]
+    assert delta.read_block(path, CHUNK, CHUNK, digest) is None
+    assert delta.read_block(path, CHUNK + 1, CHUNK, digest) is None
+    assert delta.read_block(str(tmp_path / "sumiu.bin"), 0, CHUNK, digest) is None
+
+
+def test_copy_file_checks_hash(tmp_path):
+    data = os.urandom(1000)
+    src = write(tmp_path / "origem.bin", data)
+    temp, dest = str(tmp_path / "temp.part"), str(tmp_path / "destino.bin")
+    assert not delta.copy_file(src, temp, dest, hashlib.sha256(b"outro").hexdigest())
+    assert not os.path.exists(temp) and not os.path.exists(dest)
+    assert delta.copy_file(src, temp, dest, hashlib.sha256(data).hexdigest())
+    assert (tmp_path / "destino.bin").read_bytes() == data
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_identical_content_opens_no_partial(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "origem").mkdir()
+    first = write(tmp_path / "origem" / "a.bin", os.urandom(300_000))
+    second = write(tmp_path / "origem" / "b.bin", (tmp_path / "origem" / "a.bin").read_bytes())
+    a_port, b_port = free_port(), free_port()
+    a = Device("a", a_port, multicast_group=None, seeds=[("127.0.0.1", b_port)], store_dir=None, fanout_port=None)
+    b = Device("b", b_port, multicast_group=None, seeds=[("127.0.0.1", a_port)],
+               store_dir=str(tmp_path / "blocos"), fanout_port=None)
+    opened = []
+    open_receiver = b._open_receiver
+    monkeypatch.setattr(b, "_open_receiver", lambda *args: opened.append(args[1]) or open_receiver(*args))
+    a.start()
+    b.start()
+    try:
+        deadline = time.monotonic() + 5
+        while "b" not in a.known_devices and time.monotonic() < deadline:
+            time.sleep(0.02)
+        for path in (first, second):
+            assert a.send_file("b", path)
+            deadline = time.monotonic() + 20
+            while a.list_transfers()[-1]["status"] not in transfer.FINAL_STATES and time.monotonic() < deadline:
+                time.sleep(0.02)
+            assert a.list_transfers()[-1]["status"] == transfer.CONCLUIDA
+    finally:
+        a.stop()
+        b.stop()
+    # o segundo envio é copiado do primeiro arquivo salvo, sem parcial
+    assert opened == ["a.bin"]
+    assert (tmp_path / "b.bin").read_bytes() == (tmp_path / "a.bin").read_bytes()
+    assert not list(tmp_path.glob("temp_*"))
@@ -0,0 +1,57 @@
+import protocol
+from discovery import Discovery
+from membership import Membership
+
+
+class FakeDevice:
+    def __init__(self, name: str, port: int):
+        self.name = name
+        self.port = port
+        self.known_devices = Membership()
+        self.sent = []
+
+    def _sendto(self, data: bytes, addr: tuple):
+        self.sent.append((protocol.decode(data), addr))
+
+
+def test_own_entry_uses_observed_address():
+    # b escuta na 7001, mas a vê atrás de uma tradução de endereço em 10.0.0.9:8001
+    a, b = FakeDevice("a", 7000), FakeDevice("b", 7001)
+    a_discovery, b_discovery = Discovery(a), Discovery(b)
+    payload = protocol.encode_members([b_discovery._own_entry()])
+    a_discovery.handle_ack(payload, ("10.0.0.9", 8001))
+    assert a.known_devices["b"].addr == ("10.0.0.9", 8001)
+
+
+def test_relayed_entries_keep_their_address():
+    a = FakeDevice("a", 7000)
+    discovery = Discovery(a)
+    entries = [("c", "10.0.0.3", 7003, 1, 5, 100)]
+    discovery.handle_ack2(protocol.encode_members(entries), ("10.0.0.2", 7002))
+    assert a.known_devices["c"].addr == ("10.0.0.3", 7003)
+
+
+def test_syn_registers_sender_and_answers_with_newer_entries():
+    a = FakeDevice("a", 7000)
+    discovery = Discovery(a)
+    a.known_devices.update("c", "10.0.0.3", 7003, 1, 9)
+    digest = protocol.encode_digest([("b", 3), ("c", 2), ("d", 4)])
+    discovery.handle_syn(digest, ("10.0.0.2", 7002))
+    assert a.known_devices["b"].addr == ("10.0.0.2", 7002)
+    packet, addr = a.sent[-1]
+    assert packet.kind == protocol.GOSSIP_ACK and addr == ("10.0.0.2", 7002)
+    entries, requests = protocol.decode_members(packet.payload)
+    assert [e[0] for e in entries] == ["a", "c"]
+    assert entries[0][1:3] == (None, 0)
+    assert requests == ["d"]
+
+
+def test_stale_entries_are_ignored():
+    a = FakeDevice("a", 7000)
+    discovery = Discovery(a)
+    a.known_devices.update("c", "10.0.0.3", 7003, 1, 9)
+    discovery.handle_ack2(protocol.encode_members([("c", "10.0.0.4", 7004, 1, 8, 0)]), ("10.0.0.2", 7002))
+    assert a.known_devices["c"].addr == ("10.0.0.3", 7003)
+    # expirada pela idade relatada
+    discovery.handle_ack2(protocol.encode_members([("e", "10.0.0.5", 7005, 1, 1, 60_000)]), ("10.0.0.2", 7002))
+    assert "e" not in a.known_devices
@@ -0,0 +1,114 @@
+import base64
+import hashlib
+import os
+import socket
+import threading
+import time
+
+import transfer
+from device import Device
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class BaselineReceiver(threading.Thread):
+    """Receptor no formato texto original: "ACK <id>" sem seq para o FILE e para cada
+    CHUNK, e "ACK <id>_END" quando o hash confere.
+
+    lose_chunks: seqs cuja primeira cópia é descartada (perda no caminho de ida);
+    lose_acks: seqs cujo primeiro ACK não é enviado (perda no caminho de volta).
+    """
+
+    def __init__(self, device_port: int, lose_chunks=(), lose_acks=()):
+        super().__init__(daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(0.1)
+        self.port = self.sock.getsockname()[1]
+        self.device_addr = ("127.0.0.1", device_port)
+        self.lose_chunks = set(lose_chunks)
+        self.lose_acks = set(lose_acks)
+        self.chunks = {}
+        self.result = None
+        self.running = True
+
+    def run(self):
+        last_heartbeat = 0.0
+        while self.running:
+            if time.monotonic() - last_heartbeat > 0.2:
+                self.sock.sendto(b"HEARTBEAT antigo", self.device_addr)
+                last_heartbeat = time.monotonic()
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            if data[:1] not in (b"F", b"C", b"E"):
+                continue  # gossip binário e heartbeats: aqui só interessa o arquivo
+            parts = data.decode().split()
+            if parts[0] == "FILE":
+                self.sock.sendto(f"ACK {parts[1]}".encode(), addr)
+            elif parts[0] == "CHUNK":
+                seq = int(parts[2])
+                if seq in self.lose_chunks:
+                    self.lose_chunks.discard(seq)
+                    continue
+                self.chunks.setdefault(seq, base64.b64decode(parts[3]))
+                if seq in self.lose_acks:
+                    self.lose_acks.discard(seq)
+                    continue
+                self.sock.sendto(f"ACK {parts[1]}".encode(), addr)
+            elif parts[0] == "END":
+                self.result = b"".join(self.chunks[seq] for seq in sorted(self.chunks))
+                if hashlib.sha256(self.result).hexdigest() == parts[2]:
+                    self.sock.sendto(f"ACK {parts[1]}_END".encode(), addr)
+                else:
+                    self.sock.sendto(f"NACK {parts[1]}_END hash_invalido".encode(), addr)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.sock.close()
+
+
+def send_to_baseline(lose_chunks=(), lose_acks=()):
+    filename = os.path.join(HERE, "teste-maior.txt")
+    port = free_port()
+    device = Device("novo", port, multicast_group=None, seeds=[], store_dir=None, fanout_port=None)
+    receiver = BaselineReceiver(port, lose_chunks, lose_acks)
+    receiver.start()
+    device.start()
+    try:
+        deadline = time.monotonic() + 5
+        while "antigo" not in device.known_devices and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert device.send_file("antigo", filename)
+        deadline = time.monotonic() + 60
+        status = None
+        while time.monotonic() < deadline:
+            status = device.list_transfers()[0]["status"]
+            if status in transfer.FINAL_STATES:
+                break
+            time.sleep(0.05)
+    finally:
+        device.stop()
+        receiver.stop()
+    with open(filename, "rb") as f:
+        return status, receiver.result, f.read()
+
+
+def test_send_file_to_baseline_receiver():
+    status, received, original = send_to_baseline()
+    assert status == transfer.CONCLUIDA
+    assert received == original
+
+
+def test_baseline_receiver_with_lost_chunks_and_acks():
+    status, received, original = send_to_baseline(lose_chunks={2, 9}, lose_acks={5, 20})
+    assert status == transfer.CONCLUIDA
+    assert received == original
@@ -0,0 +1,56 @@
+import time
+
+from membership import Membership
+
+
+def test_update_indexes_by_name_and_addr():
+    joined = []
+    members = Membership(10, on_join=joined.append)
+    members.update("a", "10.0.0.1", 5000, 1, 3)
+    members.update("a", "10.0.0.1", 5000, 1, 4)
+    assert [info.name for info in joined] == ["a"]
+    assert members["a"].heartbeat == 4
+    assert members.by_addr(("10.0.0.1", 5000)).name == "a"
+    assert len(members) == 1
+
+
+def test_address_change_moves_the_index():
+    members = Membership(10)
+    members.update("a", "10.0.0.1", 5000)
+    members.update("a", "10.0.0.1", 6000)
+    assert members.by_addr(("10.0.0.1", 5000)) is None
+    assert members.by_addr(("10.0.0.1", 6000)).name == "a"
+
+
+def test_expire_only_after_the_latest_deadline():
+    left = []
+    members = Membership(10, on_leave=left.append)
+    now = time.monotonic()
+    members.update("a", "10.0.0.1", 5000, last_seen=now - 8)
+    members.update("b", "10.0.0.2", 5000, last_seen=now - 8)
+    # um sinal de vida novo de "a" deixa a entrada antiga do heap sem efeito
+    members.update("a", "10.0.0.1", 5000, last_seen=now)
+    assert [info.name for info in members.expire(now + 5)] == ["b"]
+    assert "b" not in members and "a" in members
+    assert [info.name for info in left] == ["b"]
+    assert members.by_addr(("10.0.0.2", 5000)) is None
+    assert [info.name for info in members.expire(now + 11)] == ["a"]
+    assert len(members) == 0
+
+
+def test_last_seen_never_goes_back():
+    members = Membership(10)
+    now = time.monotonic()
+    members.update("a", "10.0.0.1", 5000, last_seen=now)
+    members.update("a", "10.0.0.1", 5000, heartbeat=2, last_seen=now - 5)
+    assert members["a"].last_seen == now
+    assert members["a"].heartbeat == 2
+
+
+def test_remove_calls_on_leave():
+    left = []
+    members = Membership(10, on_leave=left.append)
+    members.update("a", "10.0.0.1", 5000)
+    assert members.remove("a").name == "a"
+    assert members.remove("a") is None
+    assert [info.name for info in left] == ["a"]
@@ -0,0 +1,40 @@
+import pytest
+
+import metrics
+
+PEER = ("127.0.0.1", 7001)
+
+
+def worker_snapshot(packets: int, srtt: float, rto: float) -> dict:
+    m = metrics.Metrics()
+    for _ in range(packets):
+        m.sent(PEER, 100)
+    snapshot = m.snapshot({PEER: "b"})
+    peer = snapshot["peers"]["127.0.0.1:7001"]
+    peer["srtt"], peer["rto"] = srtt, rto
+    return snapshot
+
+
+def test_merge_sums_counters():
+    merged = metrics.merge_snapshots([worker_snapshot(3, 0.01, 0.2), worker_snapshot(5, 0.03, 0.4)])
+    peer = merged["peers"]["127.0.0.1:7001"]
+    assert peer["nome"] == "b"
+    assert peer["pacotes_enviados"] == merged["total"]["pacotes_enviados"] == 8
+    assert peer["bytes_enviados"] == 800
+
+
+def test_merge_weights_rtt_by_each_worker_packets():
+    merged = metrics.merge_snapshots([worker_snapshot(10, 0.01, 0.2), worker_snapshot(30, 0.05, 0.6)])
+    peer = merged["peers"]["127.0.0.1:7001"]
+    assert peer["srtt"] == pytest.approx((10 * 0.01 + 30 * 0.05) / 40)
+    assert peer["rto"] == pytest.approx((10 * 0.2 + 30 * 0.6) / 40)
+    # a ordem dos workers não muda o resultado
+    reversed_merge = metrics.merge_snapshots([worker_snapshot(30, 0.05, 0.6), worker_snapshot(10, 0.01, 0.2)])
+    assert reversed_merge["peers"]["127.0.0.1:7001"]["srtt"] == pytest.approx(peer["srtt"])
+
+
+def test_merge_ignores_workers_without_rtt():
+    without = worker_snapshot(50, 0.0, 0.0)
+    del without["peers"]["127.0.0.1:7001"]["srtt"], without["peers"]["127.0.0.1:7001"]["rto"]
+    merged = metrics.merge_snapshots([without, worker_snapshot(2, 0.02, 0.3)])
+    assert merged["peers"]["127.0.0.1:7001"]["srtt"] == pytest.approx(0.02)
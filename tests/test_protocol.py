@@ -0,0 +1,137 @@
+import pytest
+
+import protocol
+
+
+def test_header_round_trip():
+    data = protocol.encode(protocol.CHUNK, "00000000deadbeef", seq=7, payload=b"abc", flags=protocol.FLAG_HASH)
+    assert protocol.is_binary(data)
+    assert len(data) == protocol.HEADER.size + 3
+    packet = protocol.decode(data)
+    assert packet.kind == protocol.CHUNK
+    assert packet.transfer_id == 0xDEADBEEF
+    assert packet.seq == 7
+    assert packet.flags == protocol.FLAG_HASH
+    assert packet.payload == b"abc"
+    assert packet.msg_id == "00000000deadbeef"
+
+
+def test_end_suffix_becomes_flag():
+    packet = protocol.decode(protocol.encode(protocol.ACK, "0123456789abcdef_END"))
+    assert packet.flags & protocol.FLAG_END
+    assert packet.msg_id == "0123456789abcdef_END"
+
+
+def test_text_messages_are_not_binary():
+    assert not protocol.is_binary(b"HEARTBEAT dispositivo")
+    assert not protocol.is_binary(b"ACK 0123456789abcdef 4 6-9")
+
+
+def test_decode_rejects_bad_messages():
+    data = protocol.encode(protocol.TALK, "0000000000000001", payload=b"oi")
+    with pytest.raises(ValueError):
+        protocol.decode(data[:-1])
+    with pytest.raises(ValueError):
+        protocol.decode(bytes([protocol.MAGIC, protocol.PROTOCOL_VERSION + 1]) + data[2:])
+    with pytest.raises(ValueError):
+        protocol.decode(bytes([protocol.MAGIC, protocol.PROTOCOL_VERSION, 200]) + data[3:])
+
+
+def test_sack_round_trip():
+    ranges = [(3, 5), (9, 9), (12, 40)]
+    assert protocol.decode_sack(protocol.encode_sack(ranges)) == ranges
+    assert protocol.decode_sack(b"") == []
+
+
+def test_file_info_without_options():
+    payload, flags = protocol.encode_file_info("a.txt", 10, 512)
+    assert flags == 0
+    assert protocol.decode_file_info(payload, flags) == ("a.txt", 10, 512, None, [], None)
+
+
+def test_digest_respects_limit():
+    entries = [(f"disp{i}", i) for i in range(10)]
+    assert protocol.decode_digest(protocol.encode_digest(entries)) == entries
+    limited = protocol.decode_digest(protocol.encode_digest(entries, limit=3 * (1 + 5 + 8)))
+    assert limited == entries[:3]
+
+
+def test_members_round_trip():
+    entries = [("a", "10.0.0.1", 5000, 1, 42, 150), ("b", None, 0, 0, 7, 0)]
+    assert protocol.decode_members(protocol.encode_members(entries, ["c", "d"])) == (entries, ["c", "d"])
+
+
+def test_file_info_with_hash():
+    file_hash = bytes(range(32))
+    payload, flags = protocol.encode_file_info("a.bin", 10, 512, file_hash)
+    assert flags == protocol.FLAG_HASH
+    assert protocol.decode_file_info(payload, flags) == ("a.bin", 10, 512, file_hash, [], None)
+
+
+def test_text_ranges_round_trip():
+    ranges = [(0, 2), (7, 7)]
+    assert protocol.format_ranges(ranges) == "0-2,7-7"
+    assert protocol.parse_ranges("0-2,7-7") == ranges
+    assert protocol.parse_ranges("") == []
+
+
+def test_chunk_hash_size():
+    assert len(protocol.chunk_hash(b"bloco")) == protocol.CHUNK_HASH_SIZE
+    assert protocol.chunk_hash(b"bloco") != protocol.chunk_hash(b"bloc0")
+
+
+def test_file_info_offers_codecs():
+    payload, flags = protocol.encode_file_info("a.bin", 10, 512, codecs=[3, 1])
+    assert flags == protocol.FLAG_COMPRESSED
+    assert protocol.decode_file_info(payload, flags)[4] == [3, 1]
+
+
+def test_file_ack_round_trip():
+    payload, flags = protocol.encode_file_ack(1024, 65536, codec=1, held=[(0, 4), (8, 8)])
+    assert protocol.decode_file_ack(payload, flags) == (1024, 65536, 1, [(0, 4), (8, 8)])
+
+
+def test_header_only_matches_full_encode():
+    payload = b"x" * 10
+    header = protocol.encode_header(protocol.CHUNK, "00000000000000ff", 3, len(payload))
+    assert header + payload == protocol.encode(protocol.CHUNK, "00000000000000ff", 3, payload)
+
+
+def test_new_transfer_id_lands_in_shard():
+    for shard in range(4):
+        for _ in range(50):
+            transfer_id, _ = protocol.parse_id(protocol.new_transfer_id(shard, 4))
+            assert (transfer_id & 0xFFFFFFFF) % 4 == shard
+
+
+def test_delta_flag_on_file_and_ack():
+    payload, flags = protocol.encode_file_info("a.bin", 10, 512, bytes(32), delta=True)
+    assert flags & protocol.FLAG_DELTA
+    payload, flags = protocol.encode_file_ack(1024, 65536, delta=True)
+    assert flags & protocol.FLAG_DELTA
+    assert protocol.decode_file_ack(payload, flags) == (1024, 65536, 0, [])
+
+
+def test_file_info_round_trip():
+    file_hash = bytes(range(32))
+    payload, flags = protocol.encode_file_info("arquivo.bin", 123456, 1400, file_hash, [1, 2], delta=True,
+                                               group=("239.255.43.7", 5998))
+    assert flags & protocol.FLAG_HASH and flags & protocol.FLAG_COMPRESSED
+    assert flags & protocol.FLAG_DELTA and flags & protocol.FLAG_GROUP
+    assert protocol.decode_file_info(payload, flags) == ("arquivo.bin", 123456, 1400, file_hash, [1, 2],
+                                                         ("239.255.43.7", 5998))
+
+
+def test_talk_batch_round_trip():
+    messages = [b"oi", b"", "ação".encode()]
+    payload = protocol.encode_talk_batch(10, 12, messages)
+    assert protocol.decode_talk_batch(payload) == (10, 12, messages)
+    with pytest.raises(ValueError):
+        protocol.decode_talk_batch(payload[:-1])
+
+
+def test_talk_ack_ranges_are_relative_to_cum():
+    payload = protocol.encode_talk_ack(99, 1000, [(1002, 1003), (1010, 1010)]) + b"resto"
+    session_id, cum, ranges, end = protocol.decode_talk_ack(payload)
+    assert (session_id, cum, ranges) == (99, 1000, [(1002, 1003), (1010, 1010)])
+    assert payload[end:] == b"resto"
@@ -0,0 +1,143 @@
+import hashlib
+import os
+
+import pytest
+
+import protocol
+from receiver import FileReceiver
+
+CHUNK = 16
+
+
+def chunks(data: bytes):
+    return [data[i:i + CHUNK] for i in range(0, len(data), CHUNK)]
+
+
+def open_receiver(tmp_path, data: bytes, resumable: bool = False) -> FileReceiver:
+    file_hash = hashlib.sha256(data).digest() if resumable else None
+    return FileReceiver(str(tmp_path / "final.bin"), len(data), CHUNK, str(tmp_path / "parcial.part"),
+                        file_hash, str(tmp_path / "parcial.state"))
+
+
+def test_out_of_order_writes_and_hash(tmp_path):
+    data = os.urandom(10 * CHUNK + 5)
+    blocks = chunks(data)
+    receiver = open_receiver(tmp_path, data)
+    assert receiver.total_chunks == 11
+    for seq in [3, 0, 10, 1, 2, 5, 4, 9, 8, 7, 6]:
+        assert receiver.write(seq, blocks[seq])
+    assert receiver.complete
+    assert receiver.hexdigest() == hashlib.sha256(data).hexdigest()
+    receiver.commit()
+    assert (tmp_path / "final.bin").read_bytes() == data
+    assert not (tmp_path / "parcial.part").exists()
+
+
+def test_duplicate_write_is_rejected(tmp_path):
+    data = os.urandom(3 * CHUNK)
+    receiver = open_receiver(tmp_path, data)
+    assert receiver.write(1, chunks(data)[1])
+    assert not receiver.write(1, chunks(data)[1])
+    assert receiver.received_count == 1
+    receiver.abort()
+    assert not (tmp_path / "parcial.part").exists()
+
+
+def test_held_and_missing_ranges(tmp_path):
+    data = os.urandom(10 * CHUNK)
+    blocks = chunks(data)
+    receiver = open_receiver(tmp_path, data)
+    for seq in (0, 1, 2, 5, 8, 9):
+        receiver.write(seq, blocks[seq])
+    assert receiver.held_ranges(10) == [(0, 2), (5, 5), (8, 9)]
+    assert receiver.missing_ranges(10) == [(3, 4), (6, 7)]
+    assert receiver.missing_ranges(1) == [(3, 4)]
+    assert receiver.missing_ranges(10, start=5, end=6) == [(6, 6)]
+    receiver.abort()
+
+
+def test_resume_from_state_file(tmp_path):
+    data = os.urandom(8 * CHUNK + 3)
+    blocks = chunks(data)
+    first = open_receiver(tmp_path, data, resumable=True)
+    for seq in (0, 2, 3, 8):
+        first.write(seq, blocks[seq], protocol.chunk_hash(blocks[seq]))
+    first.close()
+
+    second = open_receiver(tmp_path, data, resumable=True)
+    assert second.resumed
+    assert second.received_count == 4
+    assert second.held_ranges(10) == [(0, 0), (2, 3), (8, 8)]
+    # o prefixo recuperado só entra no hash com catch_up(), que o dispositivo roda fora do loop
+    assert second.next_expected == 0
+    second.catch_up()
+    assert second.next_expected == 1
+    for seq in (1, 4, 5, 6, 7):
+        second.write(seq, blocks[seq], protocol.chunk_hash(blocks[seq]))
+    assert second.complete
+    assert second.hexdigest() == hashlib.sha256(data).hexdigest()
+    assert second.block_digests() == b"".join(protocol.chunk_hash(b) for b in blocks)
+    second.commit()
+    assert (tmp_path / "final.bin").read_bytes() == data
+    assert not (tmp_path / "parcial.state").exists()
+
+
+def test_resume_ignores_state_of_other_content(tmp_path):
+    data = os.urandom(4 * CHUNK)
+    first = open_receiver(tmp_path, data, resumable=True)
+    first.write(0, chunks(data)[0], protocol.chunk_hash(chunks(data)[0]))
+    first.close()
+    other = open_receiver(tmp_path, os.urandom(4 * CHUNK), resumable=True)
+    assert not other.resumed
+    assert other.received_count == 0
+    other.abort()
+
+
+def test_verify_drops_corrupted_blocks(tmp_path):
+    data = os.urandom(4 * CHUNK)
+    blocks = chunks(data)
+    receiver = open_receiver(tmp_path, data, resumable=True)
+    for seq, block in enumerate(blocks):
+        receiver.write(seq, block, protocol.chunk_hash(block))
+    os.pwrite(receiver.fd, b"\x00" * CHUNK, 2 * CHUNK)
+    assert receiver.verify() == 1
+    assert receiver.missing_ranges(10) == [(2, 2)]
+    receiver.write(2, blocks[2], protocol.chunk_hash(blocks[2]))
+    assert receiver.hexdigest() == hashlib.sha256(data).hexdigest()
+    receiver.abort()
+
+
+def test_empty_file(tmp_path):
+    receiver = open_receiver(tmp_path, b"")
+    assert receiver.total_chunks == 0
+    assert receiver.complete
+    assert receiver.hexdigest() == hashlib.sha256(b"").hexdigest()
+    receiver.commit()
+    assert (tmp_path / "final.bin").read_bytes() == b""
+
+
+def test_partial_in_use_is_not_shared(tmp_path):
+    data = os.urandom(4 * CHUNK)
+    first = open_receiver(tmp_path, data, resumable=True)
+    first.write(0, chunks(data)[0], protocol.chunk_hash(chunks(data)[0]))
+    with pytest.raises(FileExistsError):
+        open_receiver(tmp_path, data, resumable=True)
+    first.close()
+    second = open_receiver(tmp_path, data, resumable=True)
+    assert second.resumed
+    # o abort atrasado do primeiro não pode apagar a parcial que o segundo retomou
+    first.abort()
+    assert (tmp_path / "parcial.part").exists()
+    second.abort()
+    assert not (tmp_path / "parcial.part").exists()
+
+
+def test_partial_without_state_is_exclusive(tmp_path):
+    data = os.urandom(2 * CHUNK)
+    first = FileReceiver(str(tmp_path / "a.bin"), len(data), CHUNK, str(tmp_path / "parcial.part"))
+    with pytest.raises(FileExistsError):
+        FileReceiver(str(tmp_path / "b.bin"), len(data), CHUNK, str(tmp_path / "parcial.part"))
+    for seq, block in enumerate(chunks(data)):
+        first.write(seq, block)
+    first.commit()
+    assert (tmp_path / "a.bin").read_bytes() == data
@@ -0,0 +1,31 @@
+import hashlib
+import os
+
+import source
+
+CHUNK = 1000
+
+
+def test_incremental_hash_follows_sequential_chunks(tmp_path):
+    data = os.urandom(5 * CHUNK + 17)
+    path = tmp_path / "origem.bin"
+    path.write_bytes(data)
+    src = source.FileSource(str(path), CHUNK)
+    for seq in range(6):
+        assert bytes(src.chunk(seq)) == data[seq * CHUNK:(seq + 1) * CHUNK]
+    assert src.hashed_until == len(data)
+    assert src.hexdigest() == hashlib.sha256(data).hexdigest()
+    src.close()
+
+
+def test_chunks_without_hashing(tmp_path):
+    data = os.urandom(3 * CHUNK)
+    path = tmp_path / "origem.bin"
+    path.write_bytes(data)
+    src = source.FileSource(str(path), CHUNK, hashing=False)
+    for seq in range(3):
+        src.chunk(seq)
+    # o hash já é conhecido por quem envia: a passada de envio não o recalcula
+    assert src.hashed_until == 0
+    src.close()
+    assert source.file_hash(str(path)) == hashlib.sha256(data).hexdigest()
@@ -0,0 +1,177 @@
+import heapq
+
+import protocol
+import talk
+from congestion import RttEstimator
+from membership import Membership
+from metrics import Metrics
+
+A = ("127.0.0.1", 7000)
+B = ("127.0.0.1", 7001)
+
+
+class FakeLoop:
+    """Relógio e timers controlados pelo teste"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.timers = []
+        self.counter = 0
+
+    def time(self) -> float:
+        return self.now
+
+    def call_later(self, delay: float, callback, *args):
+        handle = FakeTimer(callback, args)
+        self.counter += 1
+        heapq.heappush(self.timers, (self.now + delay, self.counter, handle))
+        return handle
+
+    def advance(self, seconds: float):
+        end = self.now + seconds
+        while self.timers and self.timers[0][0] <= end:
+            when, _, handle = heapq.heappop(self.timers)
+            self.now = when
+            if not handle.cancelled:
+                handle.callback(*handle.args)
+        self.now = end
+
+
+class FakeTimer:
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeDevice:
+    def __init__(self, loop: FakeLoop):
+        self.loop = loop
+        self.shard = (0, 1)
+        self.known_devices = Membership()
+        self.metrics = Metrics(loop.time)
+        self.rtt = RttEstimator()
+        self.sent = []
+        self.shown = []
+        self.talk = talk.TalkSessions(self)
+
+    def _sendto(self, data: bytes, addr: tuple):
+        self.sent.append(data)
+
+    def _rtt_for(self, addr: tuple) -> RttEstimator:
+        return self.rtt
+
+    def _show_talk(self, message: str, addr: tuple):
+        self.shown.append(message)
+
+
+def deliver(data: bytes, device: FakeDevice, addr: tuple):
+    """Entrega um datagrama como o despacho do dispositivo faria"""
+    packet = protocol.decode(data)
+    if packet.kind == protocol.TALK:
+        device.talk.handle_batch(packet, addr)
+    elif packet.kind == protocol.ACK:
+        device.talk.handle_ack(packet.payload, addr)
+
+
+def take(device: FakeDevice) -> list:
+    sent, device.sent = device.sent, []
+    return sent
+
+
+def pair():
+    loop = FakeLoop()
+    return loop, FakeDevice(loop), FakeDevice(loop)
+
+
+def test_messages_are_coalesced_and_acked_once():
+    loop, a, b = pair()
+    for i in range(3):
+        assert a.talk.send(B, f"msg {i}".encode())
+    assert a.sent == []
+    loop.advance(talk.COALESCE_DELAY)
+    batches = take(a)
+    assert len(batches) == 1 and protocol.decode(batches[0]).seq == 3
+    deliver(batches[0], b, A)
+    assert b.shown == ["msg 0", "msg 1", "msg 2"]
+    # a confirmação espera ACK_DELAY para juntar mais mensagens
+    assert b.sent == []
+    loop.advance(talk.ACK_DELAY)
+    acks = take(b)
+    assert len(acks) == 1
+    deliver(acks[0], a, B)
+    assert not a.talk.outgoing[B].unacked
+
+
+def test_out_of_order_batches_are_tracked_above_the_cumulative_ack():
+    loop, a, b = pair()
+    first = []
+    for i in range(3):
+        a.talk.send(B, f"msg {i}".encode())
+        loop.advance(talk.COALESCE_DELAY)
+        first.extend(take(a))
+    deliver(first[2], b, A)
+    deliver(first[1], b, A)
+    peer = b.talk.incoming[A]
+    assert peer.next_seq == 0 and peer.above == {1, 2}
+    _, cum, ranges, _ = protocol.decode_talk_ack(b.talk._ack_payload(peer))
+    assert cum == 0 and ranges == [(1, 2)]
+    deliver(first[0], b, A)
+    assert peer.next_seq == 3 and peer.above == set()
+    assert b.shown == ["msg 2", "msg 1", "msg 0"]
+
+
+def test_retransmissions_are_not_shown_twice():
+    loop, a, b = pair()
+    a.talk.send(B, b"oi")
+    loop.advance(talk.COALESCE_DELAY)
+    batch = take(a)[0]
+    deliver(batch, b, A)
+    loop.advance(talk.ACK_DELAY)
+    take(b)  # a confirmação se perde
+    loop.advance(a.rtt.timeout(0))
+    retransmitted = take(a)
+    assert len(retransmitted) == 1
+    deliver(retransmitted[0], b, A)
+    assert b.shown == ["oi"]
+    assert b.metrics.peer(A).duplicates == 1
+    # duplicata: a confirmação sai na hora
+    acks = take(b)
+    assert len(acks) == 1
+    deliver(acks[0], a, B)
+    assert not a.talk.outgoing[B].unacked
+
+
+def test_ack_goes_inside_the_reply_batch():
+    loop, a, b = pair()
+    a.talk.send(B, b"pergunta")
+    loop.advance(talk.COALESCE_DELAY)
+    deliver(take(a)[0], b, A)
+    b.talk.send(A, b"resposta")
+    loop.advance(talk.COALESCE_DELAY)
+    reply = take(b)
+    assert len(reply) == 1
+    assert protocol.decode(reply[0]).flags & protocol.FLAG_CHUNK_ACK
+    deliver(reply[0], a, B)
+    assert a.shown == ["resposta"]
+    assert not a.talk.outgoing[B].unacked
+    # nenhuma confirmação separada fica pendente
+    loop.advance(talk.ACK_DELAY)
+    assert take(b) == []
+
+
+def test_new_session_from_restarted_peer_starts_over():
+    loop, a, b = pair()
+    a.talk.send(B, b"antes")
+    loop.advance(talk.COALESCE_DELAY)
+    deliver(take(a)[0], b, A)
+    # a reiniciou: sessão nova, seqs de novo a partir de zero
+    restarted = FakeDevice(loop)
+    restarted.talk.send(B, b"depois")
+    loop.advance(talk.COALESCE_DELAY)
+    deliver(take(restarted)[0], b, A)
+    assert b.shown == ["antes", "depois"]
+    assert b.talk.incoming[A].session_id == restarted.talk.outgoing[B].session_id
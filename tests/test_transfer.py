@@ -0,0 +1,63 @@
+import transfer
+from congestion import RttEstimator
+from transfer import OutgoingTransfer, TransferManager
+
+CHUNK = 1000
+
+
+def outgoing(manager: TransferManager, msg_id: str, addr: tuple, chunks: int = 100) -> OutgoingTransfer:
+    t = OutgoingTransfer(msg_id=msg_id, filename=msg_id, filesize=chunks * CHUNK, target_name=msg_id, addr=addr,
+                         binary=True, chunk_size=CHUNK, window=8, rtt=RttEstimator())
+    manager.add_outgoing(t)
+    t.status = transfer.ATIVA
+    return t
+
+
+def send_one(manager: TransferManager, t: OutgoingTransfer):
+    """O que o dispositivo faz com cada transferência devolvida por schedule()"""
+    seq = t.take_next_seq()
+    t.pending_chunks[seq] = (None, 0, 0.0)
+    manager.chunk_sent(t.chunk_size)
+
+
+def test_schedule_shares_between_peers():
+    manager = TransferManager(quantum=2 * CHUNK)
+    outgoing(manager, "a", ("127.0.0.1", 1))
+    outgoing(manager, "b1", ("127.0.0.1", 2))
+    outgoing(manager, "b2", ("127.0.0.1", 2))
+    order = []
+    for t in manager.schedule():
+        order.append(t.msg_id)
+        send_one(manager, t)
+    # cada peer recebe o mesmo quantum por rodada; dentro do peer, as transferências se revezam
+    assert order[:4] == ["a", "a", "b1", "b2"]
+
+
+def test_schedule_survives_release_during_iteration():
+    manager = TransferManager()
+    failing = outgoing(manager, "falha", ("127.0.0.1", 1))
+    other = outgoing(manager, "outra", ("127.0.0.1", 2))
+    sent = []
+    for t in manager.schedule():
+        if t is failing:
+            # erro no envio: o dispositivo encerra a transferência dentro do laço
+            manager.release(t, transfer.FALHOU)
+            continue
+        sent.append(t.msg_id)
+        send_one(manager, t)
+    assert failing.status == transfer.FALHOU
+    assert ("127.0.0.1", 1) not in manager.peers
+    assert sent and set(sent) == {"outra"}
+    assert len(other.pending_chunks) == len(sent)
+
+
+def test_release_promotes_queued_transfer():
+    manager = TransferManager(max_active=1)
+    first = outgoing(manager, "primeira", ("127.0.0.1", 1))
+    second = OutgoingTransfer(msg_id="segunda", filename="segunda", filesize=CHUNK, target_name="x",
+                              addr=("127.0.0.1", 2), binary=True, chunk_size=CHUNK, window=8, rtt=RttEstimator())
+    assert not manager.add_outgoing(second)
+    assert second.status == transfer.NA_FILA
+    assert manager.release(first, transfer.CONCLUIDA) == [second]
+    assert second.status == transfer.AGUARDANDO
+    assert manager.active_count == 1